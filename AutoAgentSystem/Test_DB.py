@@ -56,8 +56,8 @@ async def evaluate_dataset(dataset_path, num_examples=2):
 
         # 打印所有 sub agent 任務情況
         print("\n=== Sub-Agent 任務列表 ===")
-        for task in app.global_task_log:
-            print(f"Agent {task['agent']} 查詢: {task['task']} → 狀態: {task['status']}")
+        for task in app.task_registry:
+            print(f"Agent {task.agent} 查詢: {task.instructions} → 狀態: {task.status.value} ({task.duration or 0:.1f}s)")
 
         print("=== 子 Agent 回報完成 ===\n")
 
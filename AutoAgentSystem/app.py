@@ -7,7 +7,17 @@ import logging
 import time
 import uuid
 import events
+from dispatch import (
+    BoundedEventQueue,
+    EventQueueMetrics,
+    LaneStats,
+    ListenerIndex,
+    ListenerLane,
+    QueuePolicy,
+    StreamDeltaCoalescer,
+)
 from eventlogger import EventLogger
+from scheduler import ConcurrencyScheduler, EngineLimits, LimiterStats
 
 from collections.abc import AsyncIterable
 from pathlib import Path
@@ -21,11 +31,18 @@ from kani.engines import BaseEngine
 from base_kani import BaseKani
 from delegation.delegate_and_wait import DelegateWait
 from delegation.delegate_one import DelegateOne
-from kanis import DEFAULT_DELEGATE_PROMPT, DEFAULT_ROOT_PROMPT, create_root_kani
+from delegation.retry import RetryPolicy, RetryStats
+from dedup import TaskIndex
+from resultcache import SubtaskResultCache
+from tasks import TaskRegistry
+from historystore import HistoryStore, MemoryStats
+from budget import BudgetAccountant, BudgetLimits, ModelPrice, NodeUsage
+from kanis import DEFAULT_DELEGATE_PROMPT, DEFAULT_ROOT_PROMPT, SystemPromptGranularity, create_root_kani
 from tool_config import ToolConfigType, validate_tool_configs
 from utils import AUTOGENERATE_TITLE, AutogenerateTitle, generate_conversation_title
 from graphviz import Digraph
 
+from tools import SharedResources
 from tools.browsing.impl import Browsing, ArxivSearch
 
 log = logging.getLogger(__name__)
@@ -73,19 +90,39 @@ class AutoAgentSystem:
         root_kani_kwargs: dict = None,
         delegate_system_prompt: str | None = DEFAULT_DELEGATE_PROMPT,
         delegate_kani_kwargs: dict = None,
+        helper_history_token_limit: int | None = 16000,
+        system_prompt_time_granularity: SystemPromptGranularity = "minute",
         # delegation/function calling
         delegation_scheme: type | None = DelegateWait,
         max_delegation_depth: int = 4,
+        retry_policy: RetryPolicy = None,
+        subtask_timeout: float | None = None,
+        subtask_max_requests: int | None = None,
+        session_budget: BudgetLimits = None,
+        subtree_budget: BudgetLimits = None,
+        kani_budget: BudgetLimits = None,
+        model_prices: dict[str, ModelPrice] = None,
+        duplicate_task_cutoff: float | None = None,
+        result_cache: SubtaskResultCache | None = None,
+        compact_tasks_each_round: bool = False,
+        archive_compacted_tasks: bool = True,
+        spill_idle_histories: bool = False,
         tool_configs: ToolConfigType = None,
         root_has_tools: bool = False,
+        engine_limits: dict[str, EngineLimits] = None,
+        # events
+        stream_coalesce_window: float | None = None,
+        stream_coalesce_bytes: int | None = None,
+        event_queue_size: int = 0,
+        event_queue_policies: dict[type[events.BaseEvent], QueuePolicy] = None,
         # logging
         title: str | AutogenerateTitle | None = AUTOGENERATE_TITLE,
         log_dir: Path = None,
         clear_existing_log: bool = False,
+        log_kwargs: dict = None,
         session_id: str = None,
     ):
         self.visualizer = TreeVisualizer()
-        self.global_task_log = []  # 🧠 全局任務追蹤記憶體
         """
         :param root_engine: The engine to use for the root kani. Requires function calling. (default: gpt-4o)
             See :external+kani:doc:`engines` for a list of available engines and their capabilities.
@@ -94,20 +131,70 @@ class AutoAgentSystem:
         :param root_system_prompt: The system prompt for the root kani. See ``redel.kanis`` for default.
         :param root_kani_kwargs: Additional keyword args to pass to :class:`kani.Kani`.
         :param delegate_system_prompt: The system prompt for the each delegate kani. See ``redel.kanis`` for default.
+            Put ``{name}`` and ``{time}`` at the end so that sibling delegates share a prompt prefix (the tool schemas
+            and the rest of the system prompt) that providers can cache.
         :param delegate_kani_kwargs: Additional keyword args to pass to :class:`kani.Kani`.
+        :param helper_history_token_limit: When a delegate's chat history grows past this many tokens (e.g. because
+            it is re-tasked many times), its oldest function results are replaced by short excerpts until the history
+            is half this size (default 16000). The originals stay in the event log. If None, histories are not
+            compacted.
+        :param system_prompt_time_granularity: How often the current time in each kani's system prompt is updated:
+            ``"minute"`` (default), ``"hour"``, or ``"session"`` (rendered once, when the kani is first prompted). The
+            system prompt is only re-rendered when the time it shows changes.
         :param delegation_scheme: A class that each kani capable of delegation will use to provide the delegation tool.
             See ``redel.delegation`` for examples. Can be ``None`` to disable delegation.
         :param max_delegation_depth: The maximum delegation depth. Kanis created at this depth will not inherit from the
             ``delegation_scheme`` class.
+        :param retry_policy: How delegators retry and reassign helpers that fail (see :class:`.RetryPolicy`).
+        :param subtask_timeout: The default deadline (in seconds) of each delegated subtask, including the subtasks it
+            delegates (default None, no deadline). A helper that runs past its deadline is stopped and its parent gets
+            its partial result.
+        :param subtask_max_requests: The default number of model requests each delegated subtask (including the
+            subtasks it delegates) may make before it is stopped with a partial result (default None, no limit).
+        :param session_budget: The token/cost limits of the whole session (see :class:`.BudgetLimits`). Once a budget
+            is used up, the kani it covers can't delegate and must answer without calling more tools.
+        :param subtree_budget: The token/cost limits of each delegated subtree (a helper and its descendants).
+        :param kani_budget: The token/cost limits of each individual kani.
+        :param model_prices: A mapping of model names to their :class:`.ModelPrice`, used to compute costs for cost
+            limits and usage reports.
+        :param duplicate_task_cutoff: If set, the similarity (0-100) above which a delegated task is rejected as a near
+            duplicate of a task already delegated in this session, if the two differ only in function words (e.g. 90).
+            If None (the default), only exact duplicates (after normalizing case, punctuation, and whitespace) are
+            rejected.
+        :param result_cache: If set, the results of delegated subtasks are stored in this cache, and delegating a
+            subtask with a valid cached result returns it immediately instead of spawning a helper (default None). Pass
+            the same :class:`.SubtaskResultCache` to several sessions to share results between them.
+        :param compact_tasks_each_round: Whether to remove finished tasks from the app's :class:`.TaskRegistry` at the
+            end of each round (default False). Useful for long batch runs.
+        :param archive_compacted_tasks: Whether to append tasks removed from the task registry to ``tasks.jsonl`` in the
+            log directory (default True).
+        :param spill_idle_histories: Whether to write the chat history of each helper to disk when it finishes a task
+            and drop it from memory until the helper is given another task (default False). Useful for long sessions
+            with many helpers. Histories are stored in ``spilled_histories/`` in the log directory.
         :param tool_configs: A mapping of tool mixin classes to their configurations (see :class:`.ToolConfig`).
         :param root_has_tools: Whether the root kani should have access to the configured tools (default
             False).
+        :param engine_limits: A mapping of model names to the concurrency and token rate limits of requests to that
+            model, shared by every kani in the session (see :class:`.EngineLimits`). Models not in the mapping start at
+            3 concurrent requests with no token limit.
+        :param stream_coalesce_window: If set, buffer stream deltas from each kani for up to this many seconds and
+            dispatch them as a single :class:`.events.StreamDelta` (default None).
+        :param stream_coalesce_bytes: If set, buffer stream deltas from each kani until they reach this many bytes and
+            dispatch them as a single :class:`.events.StreamDelta` (default None). Can be combined with
+            ``stream_coalesce_window``; a buffer is flushed when either limit is hit.
+        :param event_queue_size: The maximum number of events to hold in memory waiting to be dispatched to listeners.
+            Past this, each event is handled according to its class' :class:`.QueuePolicy`. If 0, the queue is unbounded
+            (default).
+        :param event_queue_policies: A mapping of event classes to the :class:`.QueuePolicy` to use for them when the
+            event queue is full. By default, stream deltas and state changes are merged and all other events block.
         :param title: The title of this session. Set to ``redel.AUTOGENERATE_TITLE`` to automatically generate one
             (default), or ``None`` to disable title generation.
         :param log_dir: A path to a directory to save logs for this session. Defaults to
             ``$REDEL_HOME/instances/{session_id}/`` (default ``~/.redel/instances/{session_id}``).
         :param clear_existing_log: If the log directory has existing events, clear them before writing new events.
             Otherwise, append to existing events.
+        :param log_kwargs: Additional keyword args to pass to :class:`.EventLogger` (e.g. ``log_format``, or
+            ``writer`` and ``durability`` to configure how events are written).
         :param session_id: The ID of this session. Generally this should not be set manually; it is used for loading
             previous states.
         """
@@ -121,6 +208,8 @@ class AutoAgentSystem:
             delegate_kani_kwargs = {}
         if tool_configs is None:
             tool_configs = {}
+        if log_kwargs is None:
+            log_kwargs = {}
 
         validate_tool_configs(tool_configs)
 
@@ -132,9 +221,32 @@ class AutoAgentSystem:
         self.root_kani_kwargs = root_kani_kwargs
         self.delegate_system_prompt = delegate_system_prompt
         self.delegate_kani_kwargs = delegate_kani_kwargs
+        self.helper_history_token_limit = helper_history_token_limit
+        self.system_prompt_time_granularity = system_prompt_time_granularity
         # delegation/function calling
         self.delegation_scheme = delegation_scheme
         self.max_delegation_depth = max_delegation_depth
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.retry_stats = RetryStats()
+        self.subtask_timeout = subtask_timeout
+        self.subtask_max_requests = subtask_max_requests
+        self.session_budget = session_budget
+        self.subtree_budget = subtree_budget
+        self.kani_budget = kani_budget
+        self.model_prices = model_prices
+        self.budget = BudgetAccountant(
+            self,
+            session_limits=session_budget,
+            subtree_limits=subtree_budget,
+            kani_limits=kani_budget,
+            prices=model_prices,
+        )
+        self.duplicate_task_cutoff = duplicate_task_cutoff
+        self.task_index = TaskIndex(duplicate_task_cutoff)
+        self.result_cache = result_cache
+        self.compact_tasks_each_round = compact_tasks_each_round
+        self.archive_compacted_tasks = archive_compacted_tasks
+        self.spill_idle_histories = spill_idle_histories
         self.tool_configs = tool_configs
         # 註冊工具
         self.tool_configs.update({
@@ -148,25 +260,51 @@ class AutoAgentSystem:
             }
         })
         self.root_has_tools = root_has_tools
+        self.tool_resources = SharedResources()
+        self.engine_limits = engine_limits
+        self.scheduler = ConcurrencyScheduler(self, engine_limits)
+        # events
+        self.stream_coalesce_window = stream_coalesce_window
+        self.stream_coalesce_bytes = stream_coalesce_bytes
+        self.event_queue_size = event_queue_size
+        self.event_queue_policies = event_queue_policies
 
         # internals
         self._init_lock = asyncio.Lock()
 
         # events
-        self.listeners = []
-        self.event_queue = asyncio.Queue()
+        self.listeners = ListenerIndex()
+        self._lanes: dict[Callable, ListenerLane] = {}  # created lazily by the dispatch task
+        self.event_queue = BoundedEventQueue(event_queue_size, policies=event_queue_policies)
         self.dispatch_task = None
+        if stream_coalesce_window is not None or stream_coalesce_bytes is not None:
+            self.delta_coalescer = StreamDeltaCoalescer(
+                self.event_queue.put_nowait, window=stream_coalesce_window, max_bytes=stream_coalesce_bytes
+            )
+        else:
+            self.delta_coalescer = None
         # state
         self.session_id = session_id or f"{int(time.time())}-{uuid.uuid4()}"
         if title is AUTOGENERATE_TITLE:
             self.title = None
-            self.add_listener(self.create_title_listener)
+            self.subscribe(self.create_title_listener, events.RootMessage)
         else:
             self.title = title
         # logging
-        self.logger = EventLogger(self, self.session_id, log_dir=log_dir, clear_existing_log=clear_existing_log)
-        self.add_listener(self.logger.log_event)
+        self.log_kwargs = log_kwargs
+        self.logger = EventLogger(
+            self, self.session_id, log_dir=log_dir, clear_existing_log=clear_existing_log, **log_kwargs
+        )
+        self.add_listener(self.logger.log_event, stream_deltas=False)
+        self.subscribe(self.scheduler.on_tokens_used, events.TokensUsed)
+        # tasks
+        self.task_registry = TaskRegistry(
+            self, archive_path=self.logger.log_dir / "tasks.jsonl" if archive_compacted_tasks else None
+        )
+        if compact_tasks_each_round:
+            self.subscribe(self.task_registry.on_round_complete, events.RoundComplete)
         # kanis
+        self.history_store = HistoryStore(self.logger.log_dir / "spilled_histories") if spill_idle_histories else None
         self.kanis = WeakValueDictionary()
         self.root_kani = None
 
@@ -187,10 +325,30 @@ class AutoAgentSystem:
             "root_kani_kwargs": self.root_kani_kwargs,
             "delegate_system_prompt": self.delegate_system_prompt,
             "delegate_kani_kwargs": self.delegate_kani_kwargs,
+            "helper_history_token_limit": self.helper_history_token_limit,
+            "system_prompt_time_granularity": self.system_prompt_time_granularity,
             "delegation_scheme": self.delegation_scheme,
             "max_delegation_depth": self.max_delegation_depth,
+            "retry_policy": self.retry_policy,
+            "subtask_timeout": self.subtask_timeout,
+            "subtask_max_requests": self.subtask_max_requests,
+            "session_budget": self.session_budget,
+            "subtree_budget": self.subtree_budget,
+            "kani_budget": self.kani_budget,
+            "model_prices": self.model_prices,
+            "duplicate_task_cutoff": self.duplicate_task_cutoff,
+            "result_cache": self.result_cache,
+            "compact_tasks_each_round": self.compact_tasks_each_round,
+            "archive_compacted_tasks": self.archive_compacted_tasks,
+            "spill_idle_histories": self.spill_idle_histories,
             "tool_configs": self.tool_configs,
             "root_has_tools": self.root_has_tools,
+            "engine_limits": self.engine_limits,
+            "stream_coalesce_window": self.stream_coalesce_window,
+            "stream_coalesce_bytes": self.stream_coalesce_bytes,
+            "event_queue_size": self.event_queue_size,
+            "event_queue_policies": self.event_queue_policies,
+            "log_kwargs": self.log_kwargs,
         }
         config.update(kwargs)
         return config
@@ -316,7 +474,7 @@ class AutoAgentSystem:
 
         # register a new listener which passes events into a local queue
         q = asyncio.Queue()
-        self.add_listener(q.put)
+        self.add_listener(q.put, stream_deltas=False)
 
         # submit query to the kani to run in bg
         async def _task():
@@ -342,16 +500,37 @@ class AutoAgentSystem:
         self.remove_listener(q.put)
 
     # === events ===
-    def add_listener(self, callback: Callable[[events.BaseEvent], Awaitable[Any]]):
+    def add_listener(self, callback: Callable[[events.BaseEvent], Awaitable[Any]], *, stream_deltas: bool = True):
         """
         Add a listener which is called for every event dispatched by the system.
         The listener must be an asynchronous function that takes in an event in a single argument.
+
+        :param stream_deltas: Whether this listener should receive :class:`.events.StreamDelta` events. Listeners that
+            do not need stream deltas should set this to False so they are never scheduled for them.
+        """
+        self.listeners.add(callback, exclude=() if stream_deltas else (events.StreamDelta,))
+
+    def subscribe(
+        self,
+        callback: Callable[[events.BaseEvent], Awaitable[Any]],
+        *event_types: str | type[events.BaseEvent],
+        kani_id: str = None,
+    ):
         """
-        self.listeners.append(callback)
+        Add a listener which is only called for events of the given types.
+        The listener must be an asynchronous function that takes in an event in a single argument.
+
+        :param event_types: The event classes (or their ``type`` strings) to listen for. If none are given, listens for
+            all event types.
+        :param kani_id: If set, only events with this kani ID (i.e. events with an ``id`` field) are delivered.
+        """
+        self.listeners.add(callback, event_types or None, kani_id=kani_id)
 
     def remove_listener(self, callback):
-        """Remove a listener added by :meth:`add_listener`."""
+        """Remove a listener added by :meth:`add_listener` or :meth:`subscribe`."""
         self.listeners.remove(callback)
+        if (lane := self._lanes.pop(callback, None)) is not None:
+            lane.close()
 
     # async def _dispatch_task(self):
     #     while True:
@@ -372,18 +551,96 @@ class AutoAgentSystem:
                 break  # 直接跳出 loop
             else:
                 try:
-                    await asyncio.gather(*(callback(event) for callback in self.listeners), return_exceptions=True)
+                    # hand the event off to each listener's lane; the lanes call the listeners concurrently
+                    for callback in self.listeners.get(event):
+                        self._get_lane(callback).put_nowait(event)
+                except Exception:
+                    log.exception("Exception when dispatching event:")
                 finally:
                     self.event_queue.task_done()
 
+    def _get_lane(self, callback) -> ListenerLane:
+        lane = self._lanes.get(callback)
+        if lane is None:
+            lane = self._lanes[callback] = ListenerLane(
+                callback,
+                BoundedEventQueue(self.event_queue_size, policies=self.event_queue_policies),
+                name=getattr(callback, "__qualname__", repr(callback)),
+            )
+        return lane
+
     def dispatch(self, event: events.BaseEvent):
         """Dispatch an event to all listeners.
         Technically this just adds it to a queue and then an async background task dispatches it."""
+        if self.delta_coalescer is not None:
+            # flush any buffered deltas first so they are delivered before e.g. the message they make up
+            self.delta_coalescer.flush(getattr(event, "id", None))
         self.event_queue.put_nowait(event)
 
+    def dispatch_stream_delta(self, kani_id: str, delta: str, role: ChatRole):
+        """Dispatch a stream delta from the given kani, coalescing it with other deltas if configured.
+
+        This is a noop if no listener wants stream deltas."""
+        if not self.listeners.has_listeners("stream_delta", kani_id):
+            return
+        if self.delta_coalescer is not None:
+            self.delta_coalescer.add(kani_id, delta, role)
+        else:
+            self.event_queue.put_nowait(events.StreamDelta(id=kani_id, delta=delta, role=role))
+
     async def drain(self):
         """Wait until all events have finished processing."""
         await self.event_queue.join()
+        await asyncio.gather(*(lane.queue.join() for lane in list(self._lanes.values())))
+
+    async def backpressure(self):
+        """
+        Wait until the event queue has room if it is bounded and full.
+
+        Kani call this after dispatching their events so that slow listeners slow down the producers instead of letting
+        the queue grow without bound. This is a noop when called from within a listener.
+        """
+        if self.dispatch_task is None:
+            return
+        current = asyncio.current_task()
+        if current is self.dispatch_task or any(current is lane.task for lane in self._lanes.values()):
+            return
+        await self.event_queue.wait_for_room()
+        for lane in list(self._lanes.values()):
+            await lane.queue.wait_for_room()
+
+    def get_event_queue_metrics(self) -> EventQueueMetrics:
+        """Get the depth, drop, and merge counters of the event queue."""
+        return self.event_queue.metrics()
+
+    def get_listener_stats(self) -> list[LaneStats]:
+        """Get the queue depth and delivery lag of each listener's lane."""
+        return [lane.stats() for lane in self._lanes.values()]
+
+    def get_concurrency_stats(self) -> list[LimiterStats]:
+        """Get the concurrency limit and the in-flight, queued, and throttled request counts of each engine."""
+        return self.scheduler.stats()
+
+    def get_budget_usage(self) -> dict[str, NodeUsage]:
+        """Get the live token usage and cost of each kani and of the subtree below it. The session's totals are in
+        ``app.budget.session``."""
+        return self.budget.snapshot()
+
+    def get_memory_stats(self) -> MemoryStats:
+        """Get an estimate of the memory used by the chat histories of the live kani in the session, and how many of
+        them are spilled to disk (see ``spill_idle_histories``)."""
+        kanis = list(self.kanis.values())
+        resident = [ai.chat_history for ai in kanis if not ai.history_spilled]
+        store = self.history_store
+        return MemoryStats(
+            n_kanis=len(kanis),
+            n_spilled=len(kanis) - len(resident),
+            resident_messages=sum(map(len, resident)),
+            resident_chars=sum(len(msg.text or "") for history in resident for msg in history),
+            spilled_bytes=store.spilled_bytes if store is not None else 0,
+            n_spills=store.n_spills if store is not None else 0,
+            n_rehydrations=store.n_rehydrations if store is not None else 0,
+        )
 
     # --- kani lifecycle ---
     def on_kani_creation(self, ai: BaseKani):
@@ -418,15 +675,21 @@ class AutoAgentSystem:
 
     async def close(self):
         """Clean up all the app resources."""
+        # stop the whole delegation tree before tearing down the resources it uses
+        if self.root_kani is not None:
+            await self.root_kani.stop("session closed")
         self.dispatch(events.SessionClose(session_id=self.session_id))
         await self.drain()
         if self.dispatch_task is not None:
             self.dispatch_task.cancel()
+        for lane in self._lanes.values():
+            lane.close()
         await asyncio.gather(
             self.logger.close(),
             self.root_kani.close(),
             *(child.close() for child in self.kanis.values()),
         )
+        await self.tool_resources.close()
 
         
 class TreeVisualizer:
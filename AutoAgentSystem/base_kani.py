@@ -1,19 +1,28 @@
+import asyncio
+import logging
+import operator
 from contextlib import contextmanager
 from typing import AsyncIterable, TYPE_CHECKING
 
-from kani import ChatMessage, ChatRole, Kani
+from kani import AIFunction, ChatMessage, ChatRole, Kani
 from kani.engines.base import BaseCompletion
 from kani.engines.openai import OpenAIEngine
 from kani.streaming import StreamManager
 import events
 
+from cancellation import CancelScope
 from state import KaniState, RunState
-from utils import create_kani_id
+from utils import create_kani_id, get_prompt_cache_usage
 
 
 if TYPE_CHECKING:
     from .app import AutoAgentSystem
 
+log = logging.getLogger(__name__)
+
+ELIDED_PREFIX = "[elided "
+ELIDED_EXCERPT_CHARS = 300
+
 
 class BaseKani(Kani):
     """
@@ -23,6 +32,9 @@ class BaseKani(Kani):
     interface.
     """
 
+    _spilled: tuple[int, int | None] | None = None
+    """The history fingerprint of the chat history, if it was spilled to the app's history store."""
+
     def __init__(
         self,
         *args,
@@ -31,6 +43,7 @@ class BaseKani(Kani):
         id: str = None,
         name: str = None,
         dispatch_creation: bool = True,
+        cancel_scope: CancelScope = None,
         **kwargs,
     ):
         """
@@ -40,6 +53,8 @@ class BaseKani(Kani):
         :param name: The human-readable name of this kani. If not passed, uses the ID.
         :param dispatch_creation: Whether to dispatch a :class:`.events.KaniSpawn` event automatically. If false, the
             caller is responsible for calling ``app.on_kani_creation()`` to dispatch the event.
+        :param cancel_scope: The deadline and request budget of this kani and its subtree (see :class:`.CancelScope`).
+            Defaults to a scope without limits that stops when the parent's scope does.
         """
         super().__init__(*args, **kwargs)
         self.state = RunState.STOPPED
@@ -51,31 +66,66 @@ class BaseKani(Kani):
             self.depth = 0
         self.parent = parent
         self.children = {}
+        if cancel_scope is None:
+            cancel_scope = CancelScope(parent.cancel_scope if parent is not None else None)
+        self.cancel_scope = cancel_scope
         # app management
         self.id = create_kani_id() if id is None else id
         self.name = self.id if name is None else name
         self.app = app
+        # token counting
+        self._history_token_lens: list[tuple[ChatMessage, int]] = []
+        self._always_token_lens: dict[bool, tuple[tuple, int]] = {}
         if dispatch_creation:
             app.on_kani_creation(self)
 
     # ==== overrides ====
+    async def get_prompt(self, include_functions: bool = True, **kwargs) -> list[ChatMessage]:
+        # keep as many of the most recent messages as fit, using memoized per-message token counts rather than
+        # recounting a candidate prompt for every possible length
+        functions = self.get_enabled_functions() if include_functions else None
+        budget = self.max_context_size - self.desired_response_tokens - await self.always_token_len(functions)
+        to_keep = 0
+        for _, n_tokens in reversed(await self.history_token_lens()):
+            if n_tokens > budget:
+                break
+            budget -= n_tokens
+            to_keep += 1
+        # if nothing fits, let kani work out which error to raise
+        if budget < 0 or (self.chat_history and not to_keep):
+            return await super().get_prompt(include_functions=include_functions, **kwargs)
+        if not to_keep:
+            return self.always_included_messages
+        return self.always_included_messages + self.chat_history[-to_keep:]
+
     async def get_model_completion(self, include_functions: bool = True, **kwargs) -> BaseCompletion:
+        # once over budget, make the model finish with what it has rather than call more tools
+        if include_functions and self.app.budget.over_budget(self) is not None:
+            include_functions = False
         # if include_functions is False but we have functions and are using an OpenAIEngine, we should set
         # tool_choice="none" instead -- this prevents the API from exploding if we set parallel_tool_calls
         if self.functions and (not include_functions) and isinstance(self.engine, OpenAIEngine):
             include_functions = True
             kwargs["tool_choice"] = "none"
 
-        return await super().get_model_completion(include_functions=include_functions, **kwargs)
+        self.cancel_scope.check()
+        self.cancel_scope.record_request()
+        async with self.app.scheduler.slot(self.engine, self):
+            return await super().get_model_completion(include_functions=include_functions, **kwargs)
 
     async def get_model_stream(self, include_functions: bool = True, **kwargs) -> AsyncIterable[str | BaseCompletion]:
+        if include_functions and self.app.budget.over_budget(self) is not None:
+            include_functions = False
         # same as above for streaming
         if self.functions and (not include_functions) and isinstance(self.engine, OpenAIEngine):
             include_functions = True
             kwargs["tool_choice"] = "none"
 
-        async for elem in super().get_model_stream(include_functions=include_functions, **kwargs):
-            yield elem
+        self.cancel_scope.check()
+        self.cancel_scope.record_request()
+        async with self.app.scheduler.slot(self.engine, self):
+            async for elem in super().get_model_stream(include_functions=include_functions, **kwargs):
+                yield elem
 
     async def chat_round(self, *args, **kwargs):
         with self.run_state(RunState.RUNNING):
@@ -89,7 +139,7 @@ class BaseKani(Kani):
             with self.run_state(RunState.RUNNING):
                 async for token in stream:
                     yield token
-                    self.app.dispatch(events.StreamDelta(id=self.id, delta=token, role=stream.role))
+                    self.app.dispatch_stream_delta(self.id, token, stream.role)
                 yield await stream.completion()
 
         return StreamManager(_impl(), role=stream.role)
@@ -106,7 +156,7 @@ class BaseKani(Kani):
                 async def _impl():
                     async for token in stream:
                         yield token
-                        self.app.dispatch(events.StreamDelta(id=self.id, delta=token, role=stream.role))
+                        self.app.dispatch_stream_delta(self.id, token, stream.role)
                     yield await stream.completion()
 
                 yield StreamManager(_impl(), role=stream.role)
@@ -116,14 +166,30 @@ class BaseKani(Kani):
         self.app.dispatch(events.KaniMessage(id=self.id, msg=message))
         if self.parent is None:
             self.app.dispatch(events.RootMessage(msg=message))
+        await self.app.backpressure()
 
     async def add_completion_to_history(self, completion):
         message = await super().add_completion_to_history(completion)
+        cached, uncached = get_prompt_cache_usage(completion) or (None, None)
+        if cached is not None:
+            log.debug(f"[{self.name}] prompt tokens: {cached} cached, {uncached} uncached")
+        self.app.budget.charge(
+            self,
+            completion.prompt_tokens,
+            completion.completion_tokens,
+            self.app.scheduler.engine_key(self.engine),
+            cached_prompt_tokens=cached,
+        )
         self.app.dispatch(
             events.TokensUsed(
-                id=self.id, prompt_tokens=completion.prompt_tokens, completion_tokens=completion.completion_tokens
+                id=self.id,
+                prompt_tokens=completion.prompt_tokens,
+                completion_tokens=completion.completion_tokens,
+                cached_prompt_tokens=cached,
+                uncached_prompt_tokens=uncached,
             )
         )
+        await self.app.backpressure()
         # HACK: sometimes openai's function calls are borked; we fix them here
         if message.tool_calls:
             for tc in message.tool_calls:
@@ -132,6 +198,28 @@ class BaseKani(Kani):
         return message
 
     # ==== utils ====
+    @property
+    def chat_history(self) -> list[ChatMessage]:
+        """The chat history; if it was spilled to disk, it is read back and kept in memory again."""
+        if self._spilled is not None:
+            self._rehydrate_history()
+        return self._chat_history
+
+    @chat_history.setter
+    def chat_history(self, value: list[ChatMessage]):
+        self._spilled = None
+        self._chat_history = value
+
+    @property
+    def history_spilled(self) -> bool:
+        return self._spilled is not None
+
+    def history_fingerprint(self) -> tuple[int, int | None]:
+        """(length, identity of the last message) of the chat history, without reading it back if it was spilled."""
+        if self._spilled is not None:
+            return self._spilled
+        return len(self._chat_history), id(self._chat_history[-1]) if self._chat_history else None
+
     @property
     def last_user_message(self) -> ChatMessage | None:
         """The most recent USER message in this kani's chat history, if one exists."""
@@ -144,8 +232,126 @@ class BaseKani(Kani):
 
     def get_save_state(self) -> KaniState:
         """Get a Pydantic state suitable for saving/loading."""
+        if self._spilled is not None:
+            # read the spilled history without keeping it in memory
+            chat_history, _ = self.app.history_store.load(self.id)
+            return KaniState.from_kani(self, chat_history=chat_history)
         return KaniState.from_kani(self)
 
+    # --- history spilling ---
+    async def spill_history(self) -> bool:
+        """If the app has a history store and this kani is idle, write its chat history to disk and drop it from
+        memory until it is next accessed. Returns whether the history was spilled."""
+        store = self.app.history_store
+        history = self._chat_history
+        if store is None or self._spilled is not None or not history or self.state != RunState.STOPPED:
+            return False
+        fingerprint = self.history_fingerprint()
+        lens = self._history_token_lens
+        if len(lens) == len(history) and all(cached_msg is msg for (cached_msg, _), msg in zip(lens, history)):
+            token_lens = [n for _, n in lens]
+        else:
+            token_lens = None
+        await asyncio.to_thread(store.save, self.id, list(history), token_lens)
+        # the kani may have been given a new task while the history was being written
+        if (
+            self._spilled is not None
+            or self._chat_history is not history
+            or self.history_fingerprint() != fingerprint
+            or self.state != RunState.STOPPED
+        ):
+            return False
+        self._chat_history = []
+        self._history_token_lens = []
+        self._spilled = fingerprint
+        log.debug(f"[{self.name}] Spilled {fingerprint[0]} messages to disk")
+        return True
+
+    def _rehydrate_history(self):
+        messages, token_lens = self.app.history_store.rehydrate(self.id)
+        self._chat_history = messages
+        if token_lens is not None and len(token_lens) == len(messages):
+            self._history_token_lens = list(zip(messages, token_lens))
+        self._spilled = None
+        log.debug(f"[{self.name}] Read {len(messages)} spilled messages back from disk")
+
+    # --- token counting ---
+    async def history_token_lens(self) -> list[tuple[ChatMessage, int]]:
+        """The token length of each message in the chat history, as (message, length) pairs.
+
+        Lengths are memoized by message identity, so only messages added (or replaced) since the last call are counted.
+        """
+        cache = self._history_token_lens
+        n_same = 0
+        for (cached_msg, _), msg in zip(cache, self.chat_history):
+            if cached_msg is not msg:
+                break
+            n_same += 1
+        del cache[n_same:]
+        for msg in self.chat_history[n_same:]:
+            cache.append((msg, await self.prompt_token_len([msg])))
+        return cache
+
+    async def compact_history(
+        self, max_tokens: int, target_tokens: int = None, keep_recent: int = 2, min_result_tokens: int = 200
+    ) -> int:
+        """If the chat history is longer than *max_tokens*, replace old function results with a short excerpt, oldest
+        first, until it is no longer than *target_tokens*. The originals stay in the event log.
+
+        Compacting to well below the threshold means it happens rarely, so the prompt prefix (and the provider's prompt
+        cache) stays stable between compactions.
+
+        :param target_tokens: The length to compact the history to (default half of *max_tokens*).
+        :param keep_recent: The number of most recent function results to always keep in full.
+        :param min_result_tokens: Function results shorter than this are never elided.
+        :returns: The number of function results elided.
+        """
+        lens = await self.history_token_lens()
+        tokens_before = total = sum(n for _, n in lens)
+        if total <= max_tokens:
+            return 0
+        if target_tokens is None:
+            target_tokens = max_tokens // 2
+        candidates = [
+            idx
+            for idx, (msg, n) in enumerate(lens)
+            if msg.role == ChatRole.FUNCTION
+            and n >= min_result_tokens
+            and not (msg.text or "").startswith(ELIDED_PREFIX)
+        ]
+        if keep_recent:
+            candidates = candidates[:-keep_recent]
+        elided = []
+        for idx in candidates:
+            if total <= target_tokens:
+                break
+            msg, n = lens[idx]
+            text = msg.text or ""
+            excerpt = text[:ELIDED_EXCERPT_CHARS] + ("..." if len(text) > ELIDED_EXCERPT_CHARS else "")
+            stub = msg.copy_with(content=f"{ELIDED_PREFIX}{n} tokens of this result to save space]\n{excerpt}")
+            total -= n - await self.prompt_token_len([stub])
+            self.chat_history[idx] = stub
+            elided.append(idx)
+        if elided:
+            log.info(f"[{self.name}] Elided {len(elided)} old function results ({tokens_before} -> {total} tokens)")
+            self.app.dispatch(
+                events.HistoryCompacted(
+                    id=self.id, message_idxs=elided, tokens_before=tokens_before, tokens_after=total
+                )
+            )
+        return len(elided)
+
+    async def always_token_len(self, functions: list[AIFunction] | None) -> int:
+        """The token length of the always included messages and the given functions, recounted only when either
+        changes."""
+        key = (*self.always_included_messages, *(functions or ()))
+        cached = self._always_token_lens.get(functions is None)
+        if cached is not None and len(cached[0]) == len(key) and all(map(operator.is_, cached[0], key)):
+            return cached[1]
+        n_tokens = await self.prompt_token_len(self.always_included_messages, functions)
+        self._always_token_lens[functions is None] = (key, n_tokens)
+        return n_tokens
+
     # --- state utils ---
     def set_run_state(self, state: RunState):
         """Set the run state and dispatch the event."""
@@ -167,7 +373,7 @@ class BaseKani(Kani):
 
     async def cleanup(self):
         """This kani may run again but is done for now; clean up any ephemeral resources but save its state."""
-        pass
+        await self.spill_history()
 
     async def close(self):
         """The application is shutting down and all resources should be gracefully cleaned up."""
@@ -0,0 +1,84 @@
+"""
+Benchmark the per-event cost of dispatching to N listeners, comparing catch-all listeners (every listener is called
+for every event) with typed subscriptions via :class:`dispatch.ListenerIndex`.
+
+Each listener is only interested in one event type, which mirrors the listeners the app registers itself (the title
+generator only wants root messages, etc.). Run from the ``AutoAgentSystem`` directory::
+
+    python -m benchmarks.bench_dispatch
+"""
+
+import asyncio
+import itertools
+import time
+
+from kani import ChatMessage, ChatRole
+
+import events
+from dispatch import ListenerIndex
+
+N_EVENTS = 20000
+LISTENER_COUNTS = (1, 4, 16, 64, 256)
+
+
+def make_events(n: int) -> list[events.BaseEvent]:
+    msg = ChatMessage.assistant("hello")
+    protos = [
+        events.StreamDelta(id="a", delta="tok", role=ChatRole.ASSISTANT),
+        events.StreamDelta(id="b", delta="tok", role=ChatRole.ASSISTANT),
+        events.KaniMessage(id="a", msg=msg),
+        events.TokensUsed(id="a", prompt_tokens=1, completion_tokens=1),
+        events.RootMessage(msg=msg),
+        events.RoundComplete(session_id="bench"),
+    ]
+    return list(itertools.islice(itertools.cycle(protos), n))
+
+
+def make_listeners(n: int):
+    event_types = ["root_message", "kani_message", "tokens_used", "round_complete"]
+    listeners = []
+    for i in range(n):
+        wanted = event_types[i % len(event_types)]
+
+        async def listener(event, wanted=wanted):
+            # a catch-all listener has to check and discard
+            if event.type != wanted:
+                return
+
+        listeners.append((listener, wanted))
+    return listeners
+
+
+async def bench_catch_all(evts, listeners) -> float:
+    callbacks = [cb for cb, _ in listeners]
+    start = time.perf_counter()
+    for event in evts:
+        await asyncio.gather(*(callback(event) for callback in callbacks), return_exceptions=True)
+    return time.perf_counter() - start
+
+
+async def bench_indexed(evts, listeners) -> float:
+    index = ListenerIndex()
+    for cb, wanted in listeners:
+        index.add(cb, [wanted])
+    start = time.perf_counter()
+    for event in evts:
+        await asyncio.gather(*(callback(event) for callback in index.get(event)), return_exceptions=True)
+    return time.perf_counter() - start
+
+
+async def main():
+    evts = make_events(N_EVENTS)
+    print(f"{'listeners':>10} {'catch-all us/event':>20} {'indexed us/event':>18} {'speedup':>8}")
+    for n in LISTENER_COUNTS:
+        listeners = make_listeners(n)
+        catch_all = await bench_catch_all(evts, listeners)
+        indexed = await bench_indexed(evts, listeners)
+        print(
+            f"{n:>10} {catch_all / N_EVENTS * 1e6:>20.2f} {indexed / N_EVENTS * 1e6:>18.2f}"
+            f" {catch_all / indexed:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
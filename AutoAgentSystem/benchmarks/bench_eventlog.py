@@ -0,0 +1,76 @@
+"""
+Benchmark the throughput of :class:`eventlogger.EventLogger` (events logged per second) with the default
+line-buffered writer and with the group commit writer at each durability level. For reference, it also runs the
+line-buffered writer with an fsync after every event, which is what the group writer's ``"fsync"`` level replaces.
+
+Reports both the time spent in ``log_event`` on the event loop and the total time until everything is on disk (i.e.
+including closing the writer).
+
+On an ext4 disk, with 50,000 events (two runs, events/s including close)::
+
+    line            129k - 138k
+    line (fsync)     11k
+    group (none)     99k - 110k
+    group (flush)   100k - 110k
+    group (fsync)    98k - 105k
+
+Without fsync, the group writer is no faster than the line-buffered default (the cost is dominated by serializing
+events, and every ``write`` takes a lock), so only use it with ``durability="fsync"``, where it is about 9x faster
+than fsyncing every event.
+
+Run from the ``AutoAgentSystem`` directory::
+
+    python -m benchmarks.bench_eventlog
+"""
+
+import asyncio
+import os
+import pathlib
+import tempfile
+import time
+
+from kani import ChatMessage
+
+import events
+from eventlogger import EventLogger
+
+N_EVENTS = 50000
+
+CONFIGS = {
+    "line": dict(writer="line"),
+    "line (fsync)": dict(writer="line"),
+    "group (none)": dict(writer="group", durability="none"),
+    "group (flush)": dict(writer="group", durability="flush"),
+    "group (fsync)": dict(writer="group", durability="fsync"),
+}
+
+
+async def bench(
+    log_dir: pathlib.Path, evts: list[events.BaseEvent], fsync_each: bool = False, **kwargs
+) -> tuple[float, float]:
+    logger = EventLogger(None, "bench", log_dir=log_dir, clear_existing_log=True, catalog_path=None, **kwargs)
+    start = time.perf_counter()
+    for event in evts:
+        await logger.log_event(event)
+        if fsync_each:
+            os.fsync(logger.event_file.fileno())
+    on_loop = time.perf_counter() - start
+    logger.event_file.close()
+    return on_loop, time.perf_counter() - start
+
+
+async def main():
+    evts = [
+        events.KaniMessage(id="bench", msg=ChatMessage.assistant(f"This is message number {i}."))
+        for i in range(N_EVENTS)
+    ]
+    print(f"{'writer':>14} {'events/s (loop)':>16} {'us/event (loop)':>16} {'events/s (total)':>17}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, kwargs in CONFIGS.items():
+            log_dir = pathlib.Path(tmp) / name.replace(" ", "_")
+            on_loop, total = await bench(log_dir, evts, fsync_each=name == "line (fsync)", **kwargs)
+            print(f"{name:>14} {N_EVENTS / on_loop:>16.0f} {on_loop / N_EVENTS * 1e6:>16.2f} {N_EVENTS / total:>17.0f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""
+Simulate a session in which the root is waiting on one helper while another helper's subtree churns through tool
+loops, and compare the time to the root's final answer with FIFO admission and with priority admission (see
+:func:`scheduler.request_priority`).
+
+Kani are stand-ins with just the attributes the scheduler looks at, and each model request is a fixed sleep through a
+fake engine, so the numbers only reflect scheduling. Run from the ``AutoAgentSystem`` directory::
+
+    python -m benchmarks.bench_scheduling
+"""
+
+import asyncio
+import time
+
+from scheduler import ConcurrencyScheduler, EngineLimits
+from state import RunState
+
+CONCURRENCY = 4
+LATENCY = 0.01
+CRITICAL_ROUNDS = 3
+BACKGROUND_ROUNDS = 10
+
+# name -> (fan-out, depth) of the background subtree
+SCENARIOS = {
+    "wide": (32, 1),
+    "deep": (2, 4),
+}
+
+
+class FakeEngine:
+    model = "fake"
+
+
+class SimKani:
+    def __init__(self, parent: "SimKani | None"):
+        self.parent = parent
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.state = RunState.RUNNING
+
+
+async def model_rounds(scheduler: ConcurrencyScheduler, kani: SimKani, n: int):
+    for _ in range(n):
+        async with scheduler.slot(FakeEngine, kani):
+            await asyncio.sleep(LATENCY)
+
+
+async def background_subtree(scheduler: ConcurrencyScheduler, kani: SimKani, fanout: int, depth: int):
+    """Each kani delegates to its children, does some tool loops of its own, then waits for its children."""
+    children = [SimKani(kani) for _ in range(fanout)] if depth else []
+    child_tasks = [asyncio.create_task(background_subtree(scheduler, child, fanout, depth - 1)) for child in children]
+    try:
+        await model_rounds(scheduler, kani, BACKGROUND_ROUNDS)
+        kani.state = RunState.WAITING
+        await asyncio.gather(*child_tasks)
+        kani.state = RunState.RUNNING
+    finally:
+        for task in child_tasks:
+            task.cancel()
+
+
+async def simulate(prioritize: bool, fanout: int, depth: int) -> float:
+    """Returns the time to the root's final answer, in seconds."""
+    limits = {FakeEngine.model: EngineLimits(initial_concurrency=CONCURRENCY, max_concurrency=CONCURRENCY)}
+    scheduler = ConcurrencyScheduler(None, limits, prioritize=prioritize)
+    start = time.perf_counter()
+    root = SimKani(None)
+    await model_rounds(scheduler, root, 1)
+
+    # the root delegates a research task that fans out, then a task it needs for its answer, and waits on the latter
+    background = asyncio.create_task(background_subtree(scheduler, SimKani(root), fanout, depth))
+    await asyncio.sleep(LATENCY * 2)
+    critical = SimKani(root)
+    root.state = RunState.WAITING
+    await model_rounds(scheduler, critical, CRITICAL_ROUNDS)
+    root.state = RunState.RUNNING
+    await model_rounds(scheduler, root, 1)
+    elapsed = time.perf_counter() - start
+
+    background.cancel()
+    try:
+        await background
+    except asyncio.CancelledError:
+        pass
+    return elapsed
+
+
+async def main():
+    print(f"{'scenario':>10} {'fifo (s)':>10} {'priority (s)':>13} {'speedup':>8}")
+    for name, (fanout, depth) in SCENARIOS.items():
+        fifo = await simulate(False, fanout, depth)
+        prio = await simulate(True, fanout, depth)
+        print(f"{name:>10} {fifo:>10.3f} {prio:>13.3f} {fifo / prio:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
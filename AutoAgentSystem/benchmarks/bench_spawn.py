@@ -0,0 +1,83 @@
+"""
+Benchmark the latency and memory cost of spawning a delegate kani through the real spawn path
+(:meth:`.ReDelKani.create_delegate_kani`: kani construction, tool binding and setup, function registration, and the
+spawn event), with the app's default tools and with no tools. No LLM calls are made.
+
+The script only uses the public app API, so it can also be run against an older checkout to compare spawn costs
+across changes, e.g.::
+
+    git worktree add /tmp/redel-before <commit>
+    cd /tmp/redel-before/AutoAgentSystem && python -m benchmarks.bench_spawn
+
+Run from the ``AutoAgentSystem`` directory::
+
+    python -m benchmarks.bench_spawn
+"""
+
+import asyncio
+import pathlib
+import tempfile
+import time
+import tracemalloc
+
+from kani import ChatMessage
+from kani.engines.base import BaseEngine, Completion
+
+from app import AutoAgentSystem
+
+N_KANIS = 200
+N_RUNS = 3
+
+
+class NullEngine(BaseEngine):
+    """An engine that is never prompted; delegates only need it to exist."""
+
+    max_context_size = 128000
+
+    def prompt_len(self, messages, functions=None, **kwargs) -> int:
+        return sum(len(m.text or "") // 4 for m in messages)
+
+    async def predict(self, messages, functions=None, **kwargs) -> Completion:
+        return Completion(ChatMessage.assistant("done"))
+
+
+async def bench(log_dir: pathlib.Path, with_tools: bool) -> tuple[float, float]:
+    """Returns (ms per spawn, KiB per kani)."""
+    app = AutoAgentSystem(
+        root_engine=NullEngine(),
+        delegate_engine=NullEngine(),
+        title=None,
+        log_dir=log_dir,
+        log_kwargs={"catalog_path": None},
+    )
+    if not with_tools:
+        app.tool_configs.clear()
+    await app.ensure_init()
+    # warm up: the first spawn creates any shared resources and imports lazily-loaded modules
+    kanis = [await app.root_kani.create_delegate_kani("warm up")]
+
+    tracemalloc.start()
+    mem_start = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    for i in range(N_KANIS):
+        kanis.append(await app.root_kani.create_delegate_kani(f"Subtask number {i}"))
+    elapsed = time.perf_counter() - start
+    mem_used = tracemalloc.get_traced_memory()[0] - mem_start
+    tracemalloc.stop()
+
+    await app.close()
+    return elapsed / N_KANIS * 1000, mem_used / N_KANIS / 1024
+
+
+async def main():
+    print(f"{'tools':>14} {'ms/spawn':>10} {'KiB/kani':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, with_tools in (("none", False), ("default tools", True)):
+            results = [await bench(pathlib.Path(tmp) / f"{with_tools}-{i}", with_tools) for i in range(N_RUNS)]
+            ms = min(r[0] for r in results)
+            kib = min(r[1] for r in results)
+            print(f"{name:>14} {ms:>10.2f} {kib:>10.1f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,208 @@
+"""
+Token and cost budgets for the session, for each delegated subtree, and for each kani.
+
+:class:`BudgetAccountant` is charged with the tokens of every completion as it is added to a kani's history, and adds
+them to the kani's own totals and to the subtree totals of the kani and each of its ancestors, so charging is O(depth)
+and every total can be read in O(1). Before each model request, a kani asks the accountant whether it or any subtree
+it is in is over budget; if so, the request is made without tools so the model finishes with what it has, and the
+kani refuses to delegate further.
+"""
+
+import logging
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Literal
+
+import events
+
+if TYPE_CHECKING:
+    from app import AutoAgentSystem
+    from base_kani import BaseKani
+
+log = logging.getLogger(__name__)
+
+BudgetScope = Literal["session", "subtree", "kani"]
+
+
+@dataclass
+class BudgetLimits:
+    """The most tokens and/or money a session, subtree, or kani may use. Either limit may be None."""
+
+    max_tokens: int | None = None
+    """The maximum number of tokens (prompt + completion)."""
+    max_cost: float | None = None
+    """The maximum cost, in the currency of the :class:`ModelPrice` given for each model."""
+
+
+@dataclass
+class ModelPrice:
+    prompt: float
+    """The price per million prompt tokens."""
+    completion: float
+    """The price per million completion tokens."""
+
+
+@dataclass
+class UsageTotals:
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cached_prompt_tokens: int = 0
+    """The prompt tokens read from the provider's prompt cache (only counted for providers that report it)."""
+    cost: float = 0.0
+    """The cost of the tokens used with models that have a known price."""
+    n_requests: int = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    @property
+    def prompt_cache_hit_rate(self) -> float:
+        return self.cached_prompt_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cost: float, cached_prompt_tokens: int = 0):
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_prompt_tokens += cached_prompt_tokens
+        self.cost += cost
+        self.n_requests += 1
+
+    def exceeds(self, limits: BudgetLimits | None) -> bool:
+        if limits is None:
+            return False
+        return (limits.max_tokens is not None and self.total_tokens >= limits.max_tokens) or (
+            limits.max_cost is not None and self.cost >= limits.max_cost
+        )
+
+
+@dataclass
+class NodeUsage:
+    """The usage of a single kani and of the subtree it is the root of."""
+
+    id: str
+    parent: str | None
+    own: UsageTotals = field(default_factory=UsageTotals)
+    subtree: UsageTotals = field(default_factory=UsageTotals)
+
+
+class BudgetAccountant:
+    """Tracks the token usage and cost of each kani and subtree in the app, and whether they are over budget."""
+
+    def __init__(
+        self,
+        app: "AutoAgentSystem" = None,
+        *,
+        session_limits: BudgetLimits = None,
+        subtree_limits: BudgetLimits = None,
+        kani_limits: BudgetLimits = None,
+        prices: dict[str, ModelPrice] = None,
+    ):
+        """
+        :param app: The app to dispatch :class:`.events.BudgetExceeded` events to, if any.
+        :param session_limits: The limits on the usage of the whole session.
+        :param subtree_limits: The limits on the usage of each delegated subtree (a helper and all of its descendants).
+        :param kani_limits: The limits on the usage of each individual kani.
+        :param prices: A mapping of model names (see :meth:`.ConcurrencyScheduler.engine_key`) to their prices, used to
+            compute costs. Tokens used with models not in the mapping cost nothing.
+        """
+        self.app = app
+        self.session_limits = session_limits
+        self.subtree_limits = subtree_limits
+        self.kani_limits = kani_limits
+        self.prices = prices or {}
+        self.session = UsageTotals()
+        self.nodes: dict[str, NodeUsage] = {}
+        self._reported: set[tuple[str | None, BudgetScope]] = set()  # limits that BudgetExceeded was sent for
+
+    # ==== accounting ====
+    def get_node(self, kani: "BaseKani") -> NodeUsage:
+        if (node := self.nodes.get(kani.id)) is None:
+            node = self.nodes[kani.id] = NodeUsage(id=kani.id, parent=kani.parent.id if kani.parent else None)
+        return node
+
+    def charge(
+        self,
+        kani: "BaseKani",
+        prompt_tokens: int | None,
+        completion_tokens: int | None,
+        model: str = None,
+        cached_prompt_tokens: int | None = None,
+    ):
+        """Charge the tokens of one completion to the given kani, its subtree, and the subtrees of its ancestors."""
+        prompt_tokens = prompt_tokens or 0
+        completion_tokens = completion_tokens or 0
+        cached_prompt_tokens = cached_prompt_tokens or 0
+        cost = 0.0
+        if (price := self.prices.get(model)) is not None:
+            cost = (prompt_tokens * price.prompt + completion_tokens * price.completion) / 1_000_000
+        self.session.add(prompt_tokens, completion_tokens, cost, cached_prompt_tokens)
+        self.get_node(kani).own.add(prompt_tokens, completion_tokens, cost, cached_prompt_tokens)
+        ancestor = kani
+        while ancestor is not None:
+            self.get_node(ancestor).subtree.add(prompt_tokens, completion_tokens, cost, cached_prompt_tokens)
+            ancestor = ancestor.parent
+
+    # ==== enforcement ====
+    def over_budget(self, kani: "BaseKani") -> tuple[BudgetScope, str] | None:
+        """If the given kani, a delegated subtree it is in, or the session is over budget, returns (scope, ID of the
+        kani whose limit was hit). Otherwise returns None."""
+        if self.session.exceeds(self.session_limits):
+            self._report("session", None, self.session, self.session_limits)
+            return "session", kani.id
+        if (node := self.nodes.get(kani.id)) is None:
+            return None
+        if node.own.exceeds(self.kani_limits):
+            self._report("kani", kani.id, node.own, self.kani_limits)
+            return "kani", kani.id
+        if self.subtree_limits is not None:
+            ancestor = kani
+            # the root's subtree is the session
+            while ancestor is not None and ancestor.parent is not None:
+                if (other := self.nodes.get(ancestor.id)) is not None and other.subtree.exceeds(self.subtree_limits):
+                    self._report("subtree", ancestor.id, other.subtree, self.subtree_limits)
+                    return "subtree", ancestor.id
+                ancestor = ancestor.parent
+        return None
+
+    def stop_reason(self, kani: "BaseKani") -> str | None:
+        """A human-readable reason the given kani should finish up, or None if it is within budget."""
+        if (over := self.over_budget(kani)) is None:
+            return None
+        scope, kani_id = over
+        if scope == "session":
+            return "the session's budget is used up"
+        if scope == "kani" or kani_id == kani.id:
+            return "your budget is used up"
+        return "the budget of your task is used up"
+
+    # ==== queries ====
+    def get_usage(self, kani_id: str) -> UsageTotals:
+        """The usage of the kani with the given ID itself."""
+        node = self.nodes.get(kani_id)
+        return node.own if node is not None else UsageTotals()
+
+    def get_subtree_usage(self, kani_id: str) -> UsageTotals:
+        """The usage of the kani with the given ID and all of its descendants."""
+        node = self.nodes.get(kani_id)
+        return node.subtree if node is not None else UsageTotals()
+
+    def snapshot(self) -> dict[str, NodeUsage]:
+        """The usage of every kani that has used tokens, and of its subtree."""
+        return dict(self.nodes)
+
+    # ==== internals ====
+    def _report(self, scope: BudgetScope, kani_id: str | None, usage: UsageTotals, limits: BudgetLimits):
+        """Dispatch a BudgetExceeded event the first time the given limit is hit."""
+        if (kani_id, scope) not in self._reported:
+            self._reported.add((kani_id, scope))
+            log.info(f"Budget of {scope} {kani_id or ''} used up: {usage.total_tokens} tokens, cost {usage.cost:.4f}")
+            if self.app is not None:
+                self.app.dispatch(
+                    events.BudgetExceeded(
+                        id=kani_id,
+                        scope=scope,
+                        total_tokens=usage.total_tokens,
+                        cost=usage.cost,
+                        max_tokens=limits.max_tokens,
+                        max_cost=limits.max_cost,
+                    )
+                )
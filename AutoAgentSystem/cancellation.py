@@ -0,0 +1,86 @@
+"""
+Deadlines, request budgets, and cooperative cancellation for the delegation tree.
+
+Each kani has a :class:`CancelScope` whose parent is its parent kani's scope. A scope stops when it is cancelled, when
+its deadline passes, or when its subtree has made as many model requests as its budget allows -- and it also stops
+when any of its ancestors does, so stopping a kani stops its whole subtree. Kani check their scope before each model
+request (see :meth:`.BaseKani.get_model_completion`) and raise :class:`SubtaskStopped` once it has stopped; the
+delegator that started the kani turns that into a partial result for its parent.
+"""
+
+import time
+
+
+class SubtaskStopped(Exception):
+    """Raised by a kani whose scope was cancelled, ran past its deadline, or used up its request budget."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelScope:
+    """The deadline, request budget, and cancellation state of a kani and its subtree."""
+
+    def __init__(self, parent: "CancelScope | None" = None, *, timeout: float = None, max_requests: int = None):
+        """
+        :param parent: The scope of the parent kani, if any. This scope stops whenever the parent scope does.
+        :param timeout: The number of seconds from now after which this scope stops, if any.
+        :param max_requests: The number of model requests this kani and its subtree may make in total, if limited.
+        """
+        self.parent = parent
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.max_requests = max_requests
+        self.n_requests = 0
+        self.cancel_reason: str | None = None
+
+    def child(self, *, timeout: float = None, max_requests: int = None) -> "CancelScope":
+        return CancelScope(self, timeout=timeout, max_requests=max_requests)
+
+    def cancel(self, reason: str = "cancelled"):
+        """Stop this scope (and so its subtree). Does nothing if it was already cancelled."""
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+
+    def stop_reason(self) -> str | None:
+        """Why this scope (or one of its ancestors) has stopped, or None if it may continue."""
+        now = time.monotonic()
+        scope = self
+        while scope is not None:
+            if scope.cancel_reason is not None:
+                return scope.cancel_reason
+            if scope.deadline is not None and now >= scope.deadline:
+                return "deadline exceeded"
+            if scope.max_requests is not None and scope.n_requests >= scope.max_requests:
+                return "request budget used up"
+            scope = scope.parent
+        return None
+
+    @property
+    def stopped(self) -> bool:
+        return self.stop_reason() is not None
+
+    def check(self):
+        """Raise :class:`SubtaskStopped` if this scope has stopped."""
+        if (reason := self.stop_reason()) is not None:
+            raise SubtaskStopped(reason)
+
+    def record_request(self):
+        """Charge a model request to this scope and each of its ancestors."""
+        scope = self
+        while scope is not None:
+            scope.n_requests += 1
+            scope = scope.parent
+
+    def remaining_time(self) -> float | None:
+        """The number of seconds until the earliest deadline of this scope or its ancestors, or None if there is no
+        deadline."""
+        deadlines = []
+        scope = self
+        while scope is not None:
+            if scope.deadline is not None:
+                deadlines.append(scope.deadline)
+            scope = scope.parent
+        if not deadlines:
+            return None
+        return max(min(deadlines) - time.monotonic(), 0)
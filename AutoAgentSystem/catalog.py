@@ -0,0 +1,226 @@
+"""
+A SQLite catalog of session metadata, so sessions can be listed and searched without opening their log files.
+
+The :class:`.EventLogger` of each session updates its row every time it writes the session state. Use
+:meth:`SessionCatalog.rebuild` to index sessions that were logged before the catalog existed.
+"""
+
+import functools
+import json
+import sqlite3
+import threading
+from collections import Counter
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from config import DEFAULT_CATALOG_PATH, DEFAULT_LOG_DIR
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id TEXT PRIMARY KEY,
+    title TEXT,
+    log_dir TEXT NOT NULL,
+    last_modified REAL NOT NULL,
+    n_events INTEGER NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    n_kanis INTEGER NOT NULL,
+    max_depth INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_last_modified ON sessions (last_modified);
+CREATE TABLE IF NOT EXISTS session_tools (
+    session_id TEXT NOT NULL REFERENCES sessions (id) ON DELETE CASCADE,
+    tool TEXT NOT NULL,
+    n_calls INTEGER NOT NULL,
+    PRIMARY KEY (session_id, tool)
+);
+CREATE INDEX IF NOT EXISTS session_tools_tool ON session_tools (tool);
+"""
+
+_SESSION_COLUMNS = (
+    "id",
+    "title",
+    "log_dir",
+    "last_modified",
+    "n_events",
+    "prompt_tokens",
+    "completion_tokens",
+    "n_kanis",
+    "max_depth",
+)
+
+
+class SessionMeta(BaseModel):
+    id: str
+    title: str | None
+    log_dir: str
+    last_modified: float
+    n_events: int
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    n_kanis: int = 0
+    max_depth: int = 0
+    tools: dict[str, int] = {}
+    """tool (function) name -> number of times it was called in the session"""
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+class SessionCatalog:
+    """A catalog of session metadata stored in a SQLite database. Safe to use from multiple threads."""
+
+    def __init__(self, path: Path = DEFAULT_CATALOG_PATH):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(_SCHEMA)
+
+    def upsert(self, meta: SessionMeta):
+        """Insert or update the row of a session."""
+        row = tuple(getattr(meta, col) for col in _SESSION_COLUMNS)
+        updates = ", ".join(f"{col} = excluded.{col}" for col in _SESSION_COLUMNS[1:])
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO sessions VALUES ({', '.join('?' * len(row))}) ON CONFLICT (id) DO UPDATE SET {updates}",
+                row,
+            )
+            self._conn.execute("DELETE FROM session_tools WHERE session_id = ?", (meta.id,))
+            self._conn.executemany(
+                "INSERT INTO session_tools VALUES (?, ?, ?)", [(meta.id, k, v) for k, v in meta.tools.items()]
+            )
+
+    def remove(self, session_id: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sessions WHERE id = ?", (session_id,))
+
+    def get(self, session_id: str) -> SessionMeta | None:
+        results = self.query(session_id=session_id, limit=1)
+        return results[0] if results else None
+
+    def query(
+        self,
+        *,
+        session_id: str = None,
+        title: str = None,
+        after: float = None,
+        before: float = None,
+        min_tokens: int = None,
+        tool: str = None,
+        order_by: str = "last_modified",
+        descending: bool = True,
+        limit: int | None = 100,
+    ) -> list[SessionMeta]:
+        """
+        Find sessions matching all of the given filters.
+
+        :param title: Only sessions whose title contains this string (case-insensitive).
+        :param after: Only sessions last modified at or after this timestamp.
+        :param before: Only sessions last modified at or before this timestamp.
+        :param min_tokens: Only sessions that used at least this many tokens in total.
+        :param tool: Only sessions in which a tool (function) with this name was called.
+        :param order_by: The column to sort by.
+        """
+        if order_by not in _SESSION_COLUMNS:
+            raise ValueError(f"Cannot order by {order_by!r}")
+        clauses = []
+        params = []
+        if session_id is not None:
+            clauses.append("id = ?")
+            params.append(session_id)
+        if title is not None:
+            clauses.append("title LIKE ? ESCAPE '\\'")
+            escaped = title.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            params.append(f"%{escaped}%")
+        if after is not None:
+            clauses.append("last_modified >= ?")
+            params.append(after)
+        if before is not None:
+            clauses.append("last_modified <= ?")
+            params.append(before)
+        if min_tokens is not None:
+            clauses.append("prompt_tokens + completion_tokens >= ?")
+            params.append(min_tokens)
+        if tool is not None:
+            clauses.append("id IN (SELECT session_id FROM session_tools WHERE tool = ?)")
+            params.append(tool)
+        sql = f"SELECT {', '.join(_SESSION_COLUMNS)} FROM sessions"
+        if clauses:
+            sql += f" WHERE {' AND '.join(clauses)}"
+        sql += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+            results = [SessionMeta(**dict(zip(_SESSION_COLUMNS, row))) for row in rows]
+            # fetch the tools of all the results in one go
+            by_id = {meta.id: meta for meta in results}
+            if by_id:
+                tool_rows = self._conn.execute(
+                    "SELECT session_id, tool, n_calls FROM session_tools WHERE session_id IN"
+                    f" ({', '.join('?' * len(by_id))})",
+                    list(by_id),
+                ).fetchall()
+                for session_id, tool_name, n_calls in tool_rows:
+                    by_id[session_id].tools[tool_name] = n_calls
+        return results
+
+    def rebuild(self, root: Path = DEFAULT_LOG_DIR) -> int:
+        """Index every session saved under the given directory by replaying its event log. Returns the number of
+        sessions indexed."""
+        from replay import iter_session_dirs, replay_sessions
+
+        n = 0
+        for log_dir, replay in replay_sessions(iter_session_dirs(root)):
+            self.upsert(_meta_from_replay(log_dir, replay))
+            n += 1
+        return n
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+@functools.cache
+def get_catalog(path: Path = DEFAULT_CATALOG_PATH) -> SessionCatalog:
+    """Get the (process-wide, shared) catalog stored at the given path."""
+    return SessionCatalog(path)
+
+
+def _meta_from_replay(log_dir: Path, replay) -> SessionMeta:
+    session_id = replay.session_id
+    title = replay.title
+    last_modified = replay.last_timestamp or 0
+    try:
+        with open(log_dir / "state.json", encoding="utf-8") as f:
+            state = json.load(f)
+        session_id = state.get("id") or session_id
+        title = state.get("title") or title
+        last_modified = state.get("last_modified") or last_modified
+    except (OSError, ValueError):
+        pass
+
+    tools = Counter()
+    for kani in replay.kanis.values():
+        for msg in kani["chat_history"]:
+            for tc in msg.get("tool_calls") or ():
+                tools[tc["function"]["name"]] += 1
+    return SessionMeta(
+        id=session_id,
+        title=title,
+        log_dir=str(log_dir),
+        last_modified=last_modified,
+        n_events=replay.event_count.total(),
+        prompt_tokens=replay.prompt_tokens.total(),
+        completion_tokens=replay.completion_tokens.total(),
+        n_kanis=len(replay.kanis),
+        max_depth=replay.max_depth,
+        tools=dict(tools),
+    )
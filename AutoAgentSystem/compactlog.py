@@ -0,0 +1,243 @@
+"""
+A compact, compressed alternative to the JSONL event log.
+
+A compact log is a directory of gzip-compressed segments plus an index::
+
+    events.rlog/
+        index.json
+        00000000.seg.gz
+        00000001.seg.gz
+        ...
+
+Each segment is a sequence of frames. A frame is a header (payload length, timestamp, and length of the event type)
+followed by the event type and the event's JSON. The header lets readers skip events they don't want without decoding
+them, and the index (event counts by type and the time range of each segment) lets them skip whole segments.
+
+Root messages that repeat the kani message just before them (which is almost all of them) are stored as a reference to
+that message instead of a second copy.
+"""
+
+import gzip
+import json
+import logging
+import os
+import struct
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import Iterable, Literal
+
+import events
+from utils import read_jsonl
+
+log = logging.getLogger(__name__)
+
+FRAME_HEADER = struct.Struct(">IdH")  # payload length, timestamp, event type length
+INDEX_VERSION = 1
+SEGMENT_GLOB = "*.seg.gz"
+
+
+class CompactLogWriter:
+    """Writes events to a compact log directory, starting a new segment every *segment_events* events."""
+
+    def __init__(
+        self, path: Path, mode: Literal["w", "a"] = "a", *, segment_events: int = 10000, compresslevel: int = 6
+    ):
+        """
+        :param path: The path to the log directory. Created if it does not exist.
+        :param mode: ``"w"`` to clear any existing log, or ``"a"`` to append to it.
+        :param segment_events: The number of events in each segment.
+        :param compresslevel: The gzip compression level of each segment.
+        """
+        self.path = Path(path)
+        self.segment_events = segment_events
+        self.compresslevel = compresslevel
+        self.path.mkdir(parents=True, exist_ok=True)
+        if mode == "w":
+            for fp in self.path.glob(SEGMENT_GLOB):
+                fp.unlink()
+            (self.path / "index.json").unlink(missing_ok=True)
+        self.segments = read_compact_index(self.path)
+        # segments that were never indexed (e.g. the process was killed) are indexed now and never appended to
+        if any("recovered" in seg for seg in self.segments):
+            for seg in self.segments:
+                seg.pop("recovered", None)
+            self._write_index()
+        self._seg_file = None
+        self._seg_info = None
+        self._last_kani_msg = None
+
+    @property
+    def event_count(self) -> Counter:
+        """The number of events in this log, by type."""
+        count = Counter()
+        for seg in self.segments:
+            count.update(seg["counts"])
+        if self._seg_info is not None:
+            count.update(self._seg_info["counts"])
+        return count
+
+    def write_event(self, event: events.BaseEvent):
+        self._ensure_segment()
+        # the root message is dispatched right after the kani message with the same ChatMessage instance
+        if isinstance(event, events.RootMessage) and event.msg is self._last_kani_msg:
+            payload = json.dumps({"type": event.type, "timestamp": event.timestamp, "msg_ref": "prev"}).encode()
+        else:
+            payload = event.model_dump_json().encode()
+        self._last_kani_msg = event.msg if isinstance(event, events.KaniMessage) else None
+        self._write_frame(event.type, event.timestamp, payload)
+
+    def write_dict(self, data: dict):
+        """Write an event that has already been dumped to a dict (e.g. read from a JSONL log)."""
+        self._ensure_segment()
+        if data["type"] == "root_message" and data["msg"] == self._last_kani_msg:
+            payload = {"type": data["type"], "timestamp": data["timestamp"], "msg_ref": "prev"}
+        else:
+            payload = data
+        self._last_kani_msg = data["msg"] if data["type"] == "kani_message" else None
+        self._write_frame(data["type"], data["timestamp"], json.dumps(payload).encode())
+
+    def flush(self):
+        """Flush the current segment so that everything written so far can be read back."""
+        if self._seg_file is not None:
+            self._seg_file.flush()
+
+    def close(self):
+        self._close_segment()
+
+    # ==== internals ====
+    def _ensure_segment(self):
+        if self._seg_file is not None:
+            return
+        name = f"{len(self.segments):08d}.seg.gz"
+        self._seg_file = gzip.open(self.path / name, "wb", compresslevel=self.compresslevel)
+        self._seg_info = {"file": name, "n_events": 0, "counts": {}, "start": None, "end": None}
+        # references never cross segments, so that each segment can be read on its own
+        self._last_kani_msg = None
+
+    def _write_frame(self, event_type: str, timestamp: float, payload: bytes):
+        etype = event_type.encode()
+        self._seg_file.write(FRAME_HEADER.pack(len(payload), timestamp, len(etype)) + etype + payload)
+        _update_segment_info(self._seg_info, event_type, timestamp)
+        if self._seg_info["n_events"] >= self.segment_events:
+            self._close_segment()
+
+    def _close_segment(self):
+        if self._seg_file is None:
+            return
+        self._seg_file.close()
+        self.segments.append(self._seg_info)
+        self._seg_file = None
+        self._seg_info = None
+        self._write_index()
+
+    def _write_index(self):
+        tmp_path = self.path / "index.json.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"version": INDEX_VERSION, "segments": self.segments}, f)
+        os.replace(tmp_path, self.path / "index.json")
+
+
+def _update_segment_info(info: dict, event_type: str, timestamp: float):
+    info["n_events"] += 1
+    info["counts"][event_type] = info["counts"].get(event_type, 0) + 1
+    if info["start"] is None or timestamp < info["start"]:
+        info["start"] = timestamp
+    if info["end"] is None or timestamp > info["end"]:
+        info["end"] = timestamp
+
+
+# ==== reading ====
+def read_compact_index(path: Path) -> list[dict]:
+    """
+    Get the index entry of each segment in the compact log at the given path, in order.
+
+    Segments that are missing from the index (e.g. because the writer was killed) are scanned and included with a
+    ``"recovered": True`` key.
+    """
+    path = Path(path)
+    try:
+        with open(path / "index.json", encoding="utf-8") as f:
+            index = json.load(f)
+        segments = index["segments"] if index.get("version") == INDEX_VERSION else []
+    except (OSError, ValueError, KeyError):
+        segments = []
+    indexed = {seg["file"] for seg in segments}
+    for fp in sorted(path.glob(SEGMENT_GLOB)):
+        if fp.name in indexed:
+            continue
+        info = {"file": fp.name, "n_events": 0, "counts": {}, "start": None, "end": None, "recovered": True}
+        for event_type, timestamp, _ in iter_segment_frames(fp):
+            _update_segment_info(info, event_type, timestamp)
+        segments.append(info)
+    return segments
+
+
+def iter_segment_frames(fp: Path) -> Iterable[tuple[str, float, bytes]]:
+    """Yield (event type, timestamp, JSON payload) tuples from a segment file, stopping at a truncated frame."""
+    with gzip.open(fp, "rb") as f:
+        try:
+            while header := f.read(FRAME_HEADER.size):
+                if len(header) < FRAME_HEADER.size:
+                    break
+                length, timestamp, type_len = FRAME_HEADER.unpack(header)
+                event_type = f.read(type_len).decode()
+                payload = f.read(length)
+                if len(payload) < length:
+                    break
+                yield event_type, timestamp, payload
+        except (EOFError, zlib.error, gzip.BadGzipFile):
+            # this is expected for the segment that is currently being written
+            log.debug(f"Segment {fp} is truncated, stopping early")
+
+
+def read_compact_log(path: Path, types: Iterable[str] = None, start: float = None, end: float = None) -> Iterable[dict]:
+    """
+    Lazily yield events (as dicts, the same as :func:`utils.read_jsonl` would) from the compact log at the given path.
+
+    :param types: If given, only yield events of these types.
+    :param start: If given, only yield events with a timestamp at or after this time.
+    :param end: If given, only yield events with a timestamp at or before this time.
+    """
+    path = Path(path)
+    types = set(types) if types is not None else None
+    for seg in read_compact_index(path):
+        # skip segments we know have nothing we want
+        if types is not None and not types.intersection(seg["counts"]):
+            continue
+        if seg["start"] is None:
+            continue
+        if (start is not None and seg["end"] < start) or (end is not None and seg["start"] > end):
+            continue
+
+        prev_kani_message = None
+        for event_type, timestamp, payload in iter_segment_frames(path / seg["file"]):
+            if event_type == "kani_message":
+                prev_kani_message = payload
+            if types is not None and event_type not in types:
+                continue
+            if (start is not None and timestamp < start) or (end is not None and timestamp > end):
+                continue
+            data = json.loads(payload)
+            if data.pop("msg_ref", None) is not None:
+                data["msg"] = json.loads(prev_kani_message)["msg"]
+            yield data
+
+
+def convert_jsonl_log(src: Path, dest: Path, **kwargs) -> int:
+    """
+    Convert a JSONL event log to a compact log. Returns the number of events converted.
+
+    :param src: The path to the ``events.jsonl`` file.
+    :param dest: The path to the compact log directory to create. Any existing log there is overwritten.
+    :param kwargs: Additional keyword arguments to pass to :class:`CompactLogWriter`.
+    """
+    writer = CompactLogWriter(dest, "w", **kwargs)
+    n_events = 0
+    try:
+        for data in read_jsonl(src):
+            writer.write_dict(data)
+            n_events += 1
+    finally:
+        writer.close()
+    return n_events
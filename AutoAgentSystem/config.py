@@ -11,3 +11,6 @@ REDEL_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 # log instances to ~/.redel/instances by default
 DEFAULT_LOG_DIR = REDEL_HOME / "instances"
 DEFAULT_LOG_DIR.mkdir(parents=True, exist_ok=True)
+
+# the catalog of session metadata (see catalog.py)
+DEFAULT_CATALOG_PATH = REDEL_HOME / "catalog.sqlite3"
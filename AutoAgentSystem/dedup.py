@@ -0,0 +1,116 @@
+"""
+Detection of duplicate and near-duplicate delegated tasks across the whole session.
+
+Exact duplicates (after normalizing case, punctuation, and whitespace) are found with a hash lookup. Near duplicate
+detection is opt-in: candidates are found with rapidfuzz's ``process.extract`` over every task seen so far, which runs
+in C and exits early on the score cutoff. The tokens of each task are sorted once when it is added, so each comparison
+is a plain ``fuzz.ratio`` (equivalent to ``fuzz.token_sort_ratio``) and lookups stay fast with thousands of tasks.
+
+A high similarity score alone does not make a near duplicate: sibling tasks in a fan-out often differ only in an
+entity ("... Germany ..." vs "... France ..."), which scores well above 90. A candidate only counts if the words that
+differ between the two tasks are all function words (articles, prepositions, etc.).
+"""
+
+import hashlib
+import re
+import unicodedata
+from dataclasses import dataclass
+
+from rapidfuzz import fuzz, process
+
+_PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+# the number of candidates above the score cutoff to check for differing content words
+_N_CANDIDATES = 5
+# words that may differ between two tasks for them to still count as near duplicates
+FUNCTION_WORDS = frozenset(
+    "a an the this that these those of in on at to for from by with about as into onto over under and or but nor so"
+    " if then than is are was were be been being do does did can could should would will shall may might must please"
+    " some any all each every its it their them they you your me my i we our us what which who whom whose".split()
+)
+
+
+def normalize_instructions(instructions: str) -> str:
+    """Normalize task instructions so that trivially different phrasings compare equal."""
+    text = unicodedata.normalize("NFKC", instructions).casefold()
+    text = _PUNCTUATION_RE.sub(" ", text)
+    return _WHITESPACE_RE.sub(" ", text).strip()
+
+
+def instructions_hash(instructions: str) -> str:
+    """A stable hash of the normalized instructions."""
+    return _hash_normalized(normalize_instructions(instructions))
+
+
+def _hash_normalized(normalized: str) -> str:
+    return hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+
+
+def _sort_tokens(normalized: str) -> str:
+    return " ".join(sorted(normalized.split()))
+
+
+def _differs_in_content(a: str, b: str) -> bool:
+    """Whether two normalized instructions differ in any word that is not a function word."""
+    return any(word not in FUNCTION_WORDS for word in set(a.split()).symmetric_difference(b.split()))
+
+
+@dataclass
+class TaskMatch:
+    agent: str
+    """The name of the agent the matching task was assigned to."""
+    task: str
+    """The instructions of the matching task, as originally given."""
+    score: float
+    """The similarity of the normalized instructions (0-100); 100 for exact duplicates."""
+    exact: bool
+
+
+class TaskIndex:
+    """An index of every task delegated in the session, for finding duplicates of new tasks."""
+
+    def __init__(self, near_duplicate_cutoff: float | None = None):
+        """
+        :param near_duplicate_cutoff: The minimum similarity score (0-100, rapidfuzz ``token_sort_ratio`` on the
+            normalized instructions) for a task to count as a near duplicate, if it also differs only in function words.
+            If None (the default), only exact duplicates are detected.
+        """
+        self.near_duplicate_cutoff = near_duplicate_cutoff
+        self._by_hash: dict[str, tuple[str, str]] = {}  # hash -> (agent, task)
+        self._entries: list[tuple[str, str]] = []  # (agent, task)
+        self._sorted_tokens: list[str] = []  # parallel to _entries, for extractOne
+
+    def __len__(self):
+        return len(self._by_hash)
+
+    def add(self, instructions: str, agent: str):
+        """Record that a task with the given instructions was assigned to the given agent."""
+        normalized = normalize_instructions(instructions)
+        key = _hash_normalized(normalized)
+        if key in self._by_hash:
+            return
+        self._by_hash[key] = (agent, instructions)
+        self._sorted_tokens.append(_sort_tokens(normalized))
+        self._entries.append((agent, instructions))
+
+    def find(self, instructions: str) -> TaskMatch | None:
+        """Find an exact or near duplicate of the given instructions, preferring exact duplicates."""
+        normalized = normalize_instructions(instructions)
+        key = _hash_normalized(normalized)
+        if (entry := self._by_hash.get(key)) is not None:
+            return TaskMatch(agent=entry[0], task=entry[1], score=100.0, exact=True)
+        if self.near_duplicate_cutoff is None or not self._sorted_tokens:
+            return None
+        candidates = process.extract(
+            _sort_tokens(normalized),
+            self._sorted_tokens,
+            scorer=fuzz.ratio,
+            score_cutoff=self.near_duplicate_cutoff,
+            limit=_N_CANDIDATES,
+        )
+        for sorted_tokens, score, idx in candidates:
+            if _differs_in_content(normalized, sorted_tokens):
+                continue
+            agent, task = self._entries[idx]
+            return TaskMatch(agent=agent, task=task, score=score, exact=False)
+        return None
@@ -13,7 +13,9 @@ class DelegationBase(ToolBase):
     It extends :class:`.ToolBase` with an interface for creating delegate kani instances.
     """
 
-    async def create_delegate_kani(self, instructions: str) -> "ReDelKani":
+    async def create_delegate_kani(
+        self, instructions: str, timeout: float = None, max_requests: int = None
+    ) -> "ReDelKani":
         r"""
         Call this method to get a fresh :class:`.ReDelKani` instance.
 
@@ -27,5 +29,16 @@ class DelegationBase(ToolBase):
         * Providing the instructions to the delegate kani and calling its ``full_round_stream`` method
         * Buffering the delegate's response and returning it to the caller
         * Calling the appropriate cleanup methods of the delegate
+        * Returning a partial result if the delegate raises :class:`.SubtaskStopped`
+
+        :param timeout: The delegate's deadline, in seconds from now. Defaults to the app's ``subtask_timeout``; the
+            delegate also stops at this kani's deadline.
+        :param max_requests: The number of model requests the delegate's subtree may make. Defaults to the app's
+            ``subtask_max_requests``; the delegate also stops when this kani's budget runs out.
         """
-        return await self.kani.create_delegate_kani(instructions)
+        return await self.kani.create_delegate_kani(instructions, timeout=timeout, max_requests=max_requests)
+
+    async def cancel_all(self, reason: str = "cancelled"):
+        """Stop every delegate that is still working for this kani. Delegation schemes that run delegates in the
+        background should override this."""
+        pass
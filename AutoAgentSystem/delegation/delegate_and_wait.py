@@ -4,11 +4,14 @@ from typing import Annotated
 
 from kani import AIParam, ChatRole, ai_function
 from rapidfuzz import fuzz
-import openai
 
 import events
-from state import RunState
+from cancellation import SubtaskStopped
+from state import RunState, TaskRecord, TaskStatus
+from dedup import TaskMatch
+from scheduler import ConcurrencyScheduler
 from delegation._base import DelegationBase
+from delegation.progress import ProgressBuffer, ProgressUpdate
 
 log = logging.getLogger(__name__)
 
@@ -18,10 +21,27 @@ class DelegateWait(DelegationBase):
         super().__init__(*args, **kwargs)
         self.helpers = {}
         self.helper_futures = {}
-        self.request_semaphore = asyncio.Semaphore(3)
+        # helper name -> the progress of its current task, and how much of it this kani has read
+        self.progress: dict[str, ProgressBuffer] = {}
+        self._progress_cursors: dict[str, int] = {}
+        self._stop_reasons: dict[str, str] = {}  # helper name -> why its task was cancelled
+
+    def find_duplicate_task(self, instructions: str) -> TaskMatch | None:
+        return self.app.task_index.find(instructions)
 
     def is_duplicate_task(self, instructions: str):
-        return any(instructions == task["task"] for task in self.app.global_task_log)
+        return self.find_duplicate_task(instructions) is not None
+
+    def get_result_cache_key(self, instructions: str) -> str | None:
+        """The key of a new helper's result for these instructions in the app's result cache, or None if results are
+        not cached."""
+        if self.app.result_cache is None:
+            return None
+        tools = [t.__name__ for t, config in self.app.tool_configs.items() if config.get("always_include", False)]
+        if self.app.delegation_scheme is not None and self.kani.depth != self.app.max_delegation_depth:
+            tools.append(f"delegation:{self.app.delegation_scheme.__name__}")
+        engine = ConcurrencyScheduler.engine_key(self.app.delegate_engine)
+        return self.app.result_cache.make_key(instructions, tools, engine)
 
     @ai_function(desc="Delegate a subtask to another agent with specific instructions. Returns immediately.")
     async def delegate(
@@ -30,9 +50,22 @@ class DelegateWait(DelegationBase):
         who: Annotated[str, AIParam("Name of an existing helper to continue with (optional).")] = None,
     ):
         log.info(f"Delegated with instructions: {instructions}")
+        if (reason := self.kani.cancel_scope.stop_reason() or self.app.budget.stop_reason(self.kani)) is not None:
+            return f"You can't delegate any more tasks ({reason}). Finish your task with what you have."
 
-        if self.is_duplicate_task(instructions):
-            return f"⚠️ 類似任務已經被分派過了，跳過重複指派。"
+        # a result for the same task from anywhere in the tree (or an earlier session) can be reused by a new helper
+        cache_key = None
+        if not (who and who in self.helpers):
+            cache_key = self.get_result_cache_key(instructions)
+            if (
+                cache_key is not None
+                and (cached := await asyncio.to_thread(self.app.result_cache.get, cache_key)) is not None
+            ):
+                log.info(f"Using cached result for instructions: {instructions}")
+                return f"(cached result of an identical earlier task)\n{cached}"
+
+        if duplicate := self.find_duplicate_task(instructions):
+            return f"⚠️ 類似任務已經被分派過了，跳過重複指派。({duplicate.agent!r} was already given: {duplicate.task})"
 
         if getattr(self, "depth", 0) >= 4:
             return f"⚠️ 已達最大遞迴層數（4）。請在目前層級內完成任務。"
@@ -48,6 +81,10 @@ class DelegateWait(DelegationBase):
             if who in self.helper_futures:
                 return f"{who!r} is still working. Wait or delegate to someone else."
             helper = self.helpers[who]
+            # a new task gets a new deadline and budget
+            helper.cancel_scope = self.kani.cancel_scope.child(
+                timeout=self.app.subtask_timeout, max_requests=self.app.subtask_max_requests
+            )
             self.app.dispatch(events.KaniDelegated(
                 parent_id=self.kani.id,
                 child_id=helper.id,
@@ -63,65 +100,155 @@ class DelegateWait(DelegationBase):
             print("📄 被指派的任務：")
             print(instructions)
             print("-" * 40 + "\n")
-            self.app.global_task_log.append({
-                "agent": helper.name,
-                "task": instructions,
-                "status": "assigned"
-            })
+            self.app.task_index.add(instructions, helper.name)
+
+        return await self._task_with_helper(helper, instructions, cache_key)
+
+    async def _task_with_helper(self, helper, instructions, cache_key: str = None):
+        task = self.app.task_registry.create(helper, instructions, parent=self.kani)
+        progress = self.progress[helper.name] = ProgressBuffer()
+        self._progress_cursors[helper.name] = 0
+        self.helper_futures[helper.name] = asyncio.create_task(self._run_task(helper, task, cache_key, progress))
+        return f"{helper.name!r} is helping you with this request."
+
+    async def _run_task(self, helper, task: TaskRecord, cache_key: str = None, progress: ProgressBuffer = None):
+        """Run the task to completion, retrying the helper and then reassigning the task as the retry policy allows.
+        Returns (result, name of the helper the task was originally given to).
+
+        :param cache_key: If given, store a successful result in the app's result cache under this key.
+        :param progress: If given, publish the helper's messages and tool results to this buffer as it works.
+        """
+        try:
+            # the helper checks its deadline before each model request; this also stops it if it is stuck in a tool
+            return await asyncio.wait_for(
+                self._run_task_inner(helper, task, cache_key, progress), helper.cancel_scope.remaining_time()
+            )
+        except (SubtaskStopped, asyncio.TimeoutError) as e:
+            reason = e.reason if isinstance(e, SubtaskStopped) else "deadline exceeded"
+            log.info(f"[{helper.name}] Stopped early: {reason}")
+            await self._stop_task(task, reason)
+            partial = "\n".join(u.text for u in progress.updates) if progress is not None else ""
+            return f"(stopped early: {reason}) {partial}", helper.name
+        except asyncio.CancelledError:
+            await self._stop_task(task, self._stop_reasons.pop(helper.name, "cancelled"))
+            raise
+        finally:
+            if progress is not None:
+                progress.close()
 
-        return await self._task_with_helper(helper, instructions)
+    async def _stop_task(self, task: TaskRecord, reason: str):
+        """Mark the task as cancelled and stop the subtree of the helper it was last given to, releasing its
+        resources."""
+        registry = self.app.task_registry
+        task = registry.get(task.id)
+        while task is not None and task.reassigned_to is not None:
+            task = registry.get(task.reassigned_to)
+        if task is None or task.status.is_finished:
+            return
+        registry.transition(task.id, TaskStatus.CANCELLED, error=reason)
+        if (helper := self.app.kanis.get(task.kani_id)) is not None:
+            await helper.stop(reason)
+            self._rewind_to_last_good_message(helper, 0, task.instructions)
+            await helper.cleanup()
 
-    async def _task_with_helper(self, helper, instructions):
-        async def internal():
+    async def _run_task_inner(self, helper, task: TaskRecord, cache_key: str, progress: ProgressBuffer | None):
+        policy = self.app.retry_policy
+        stats = self.app.retry_stats
+        registry = self.app.task_registry
+        instructions = task.instructions
+        name = helper.name
+        n_reassignments = 0
+        while True:
+            registry.transition(task.id, TaskStatus.RUNNING)
             try:
-                result = []
-                retries = 1
-                delay = 2
-                for attempt in range(retries):
-                    try:
-                        async with self.request_semaphore:
-                            log.info(f"Starting full_round_stream for {helper.name}")
-                            content = ""
-                            async for stream in helper.full_round_stream(instructions):
-                                async for token in stream:
-                                    content += token
-                            result.append(content)
-                        break
-                    except openai.RateLimitError:
-                        log.warning(f"[{helper.name}] Rate limit. Retry {attempt + 1}/{retries} after {delay}s")
-                        await asyncio.sleep(delay)
-                        delay *= 2
-                else:
-                    return f"[{helper.name}] was rate limited. Try again later.", helper.name
-
-                for entry in self.app.global_task_log:
-                    if entry["agent"] == helper.name and entry["task"] == instructions:
-                        entry["status"] = "completed"
-
-                await helper.cleanup()
-                return "\n".join(result), helper.name
+                result = await self._run_helper_with_retries(helper, instructions, progress)
+            except SubtaskStopped:
+                raise
             except Exception as e:
                 log.exception(f"{helper.name}-{helper.depth} encountered an exception!")
-                for entry in self.app.global_task_log:
-                    if entry["agent"] == helper.name and entry["task"] == instructions:
-                        entry["status"] = f"failed: {e}"
+                if n_reassignments >= policy.max_reassignments:
+                    stats.n_failed += 1
+                    registry.transition(task.id, TaskStatus.FAILED, error=str(e))
+                    return f"{helper.name} failed: {e}", name
                 try:
-                    new_helper = await self.create_delegate_kani(instructions)
-                    new_helper.task_description = instructions
-                    self.helpers[new_helper.name] = new_helper
-                    print(f"\n[🔁 任務重新委派] 由 {helper.name} 改為 {new_helper.name}")
-                    self.app.global_task_log.append({
-                        "agent": new_helper.name,
-                        "task": instructions,
-                        "status": "reassigned"
-                    })
-                    return await self._task_with_helper(new_helper, instructions)
+                    new_helper = await self.create_delegate_kani(
+                        instructions, timeout=helper.cancel_scope.remaining_time()
+                    )
                 except Exception as retry_error:
                     log.exception(f"Failed to reassign task to new agent after failure: {retry_error}")
-                    return f"{helper.name} failed and reassignment also failed: {retry_error}", helper.name
+                    stats.n_failed += 1
+                    registry.transition(task.id, TaskStatus.FAILED, error=str(e))
+                    return f"{helper.name} failed and reassignment also failed: {retry_error}", name
+                n_reassignments += 1
+                stats.n_reassignments += 1
+                new_helper.task_description = instructions
+                self.helpers[new_helper.name] = new_helper
+                print(f"\n[🔁 任務重新委派] 由 {helper.name} 改為 {new_helper.name}")
+                new_task = registry.create(new_helper, instructions, parent=self.kani, reassigned_from=task.id)
+                registry.transition(task.id, TaskStatus.REASSIGNED, error=str(e), reassigned_to=new_task.id)
+                helper, task = new_helper, new_task
+                continue
 
-        self.helper_futures[helper.name] = asyncio.create_task(internal())
-        return f"{helper.name!r} is helping you with this request."
+            registry.transition(task.id, TaskStatus.COMPLETED)
+            await helper.cleanup()
+            if cache_key is not None and result:
+                await asyncio.to_thread(self.app.result_cache.put, cache_key, result)
+            if helper.name != name:
+                result = f"(reassigned to {helper.name}) {result}"
+            return result, name
+
+    async def _run_helper_with_retries(self, helper, instructions, progress: ProgressBuffer = None) -> str:
+        """Run one round of the helper, resuming its conversation from the last good message after retryable errors.
+        Returns the text of its messages and tool results. Raises the last error if the round can't be completed."""
+        policy = self.app.retry_policy
+        stats = self.app.retry_stats
+        start = len(helper.chat_history)
+        query = instructions
+        for attempt in range(1, policy.max_attempts + 1):
+            stats.n_attempts += 1
+            try:
+                log.info(f"Starting full_round_stream for {helper.name} (attempt {attempt})")
+                # the text of messages kept from earlier attempts, followed by this attempt's
+                parts = [
+                    m.text
+                    for m in helper.chat_history[start:]
+                    if m.role in (ChatRole.ASSISTANT, ChatRole.FUNCTION) and m.text
+                ]
+                async for stream in helper.full_round_stream(query):
+                    msg = await stream.message()
+                    if not msg.text:
+                        continue
+                    parts.append(msg.text)
+                    if progress is not None:
+                        progress.publish("message" if msg.role == ChatRole.ASSISTANT else "tool_result", msg.text)
+                return "\n".join(parts)
+            except Exception as e:
+                if attempt == policy.max_attempts or not policy.is_retryable(e):
+                    raise
+                delay = policy.get_delay(attempt)
+                log.warning(
+                    f"[{helper.name}] {type(e).__name__}: {e}. Retry {attempt}/{policy.max_attempts - 1} after"
+                    f" {delay:.1f}s"
+                )
+                stats.n_retries += 1
+                await asyncio.sleep(delay)
+                query = self._rewind_to_last_good_message(helper, start, instructions)
+
+    @staticmethod
+    def _rewind_to_last_good_message(helper, start: int, instructions: str) -> str | None:
+        """Drop any tool calls without results from the end of the helper's history (added since *start*), so the
+        round can be resumed. Returns the query to resume with: the instructions if they never made it into the
+        history, otherwise None."""
+        history = helper.chat_history
+        for idx in range(len(history) - 1, start - 1, -1):
+            msg = history[idx]
+            if msg.role != ChatRole.ASSISTANT or not msg.tool_calls:
+                continue
+            answered = {m.tool_call_id for m in history[idx + 1 :] if m.role == ChatRole.FUNCTION}
+            if not all(tc.id in answered for tc in msg.tool_calls):
+                del history[idx:]
+            break
+        return instructions if len(history) == start else None
 
     async def _auto_wait_all(self):
         active_futures = [fut for name, fut in self.helper_futures.items() if name != "__AUTO_WAITING__"]
@@ -135,9 +262,8 @@ class DelegateWait(DelegationBase):
 
         results = []
         for future in done:
-            if future.done():
-                result, helper_name = future.result()
-                results.append(f"{helper_name}:{result}")
+            result, helper_name = self._unpack_result(future)
+            results.append(f"{helper_name}:{result}")
 
         self.helper_futures.clear()
 
@@ -149,6 +275,10 @@ class DelegateWait(DelegationBase):
     async def wait(
         self,
         until: Annotated[str, AIParam('Name of the helper. Use "next" or "all".')],
+        timeout: Annotated[
+            float,
+            AIParam("Stop waiting after this many seconds and return the progress so far instead (optional)."),
+        ] = None,
     ):
         if until not in self.helper_futures and until not in ("next", "all"):
             return 'The "until" param must be a running helper name, "next", or "all".'
@@ -157,54 +287,131 @@ class DelegateWait(DelegationBase):
             if not self.helper_futures:
                 return "There are no active sub-agents to wait for."
             with self.kani.run_state(RunState.WAITING):
-                done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.FIRST_COMPLETED)
+                done, _ = await asyncio.wait(
+                    self.helper_futures.values(), timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+            if not done:
+                return self.format_progress(list(self.helper_futures))
             future = done.pop()
-            try:
-                res = future.result()
-                if isinstance(res, tuple) and len(res) == 2:
-                    result, helper_name = res
-                else:
-                    result = str(res)
-                    helper_name = "unknown"
-            except Exception as e:
-                result = f"Exception: {e}"
-                helper_name = "unknown"
-            self.helper_futures.pop(helper_name, None)
+            name = next(name for name, f in self.helper_futures.items() if f is future)
+            result, helper_name = self._unpack_result(future, name)
+            self.helper_futures.pop(name)
             return f"{helper_name}:{result}"
 
         elif until == "all":
             if not self.helper_futures:
                 return "No sub-agents were successfully assigned. Please try delegating again."
             with self.kani.run_state(RunState.WAITING):
-                done, _ = await asyncio.wait(self.helper_futures.values(), return_when=asyncio.ALL_COMPLETED)
+                done, pending = await asyncio.wait(self.helper_futures.values(), timeout=timeout)
             results = []
-            for future in done:
-                try:
-                    res = future.result()
-                    if isinstance(res, tuple) and len(res) == 2:
-                        result, helper_name = res
-                    else:
-                        result = str(res)
-                        helper_name = "unknown"
-                except Exception as e:
-                    result = f"Exception: {e}"
-                    helper_name = "unknown"
+            for name, future in list(self.helper_futures.items()):
+                if future not in done:
+                    continue
+                result, helper_name = self._unpack_result(future, name)
                 results.append(f"{helper_name}:{result}")
-            self.helper_futures.clear()
+                del self.helper_futures[name]
+            if pending:
+                results.append(self.format_progress(list(self.helper_futures)))
             return "\n\n=====\n\n".join(results)
 
         else:
-            if until not in self.helper_futures:
-                return f"No active helper named {until}."
-            future = self.helper_futures.pop(until)
+            future = self.helper_futures[until]
             with self.kani.run_state(RunState.WAITING):
-                try:
-                    res = await future
-                    if isinstance(res, tuple) and len(res) == 2:
-                        result, _ = res
-                    else:
-                        result = str(res)
-                except Exception as e:
-                    result = f"Exception: {e}"
+                done, _ = await asyncio.wait([future], timeout=timeout)
+            if not done:
+                return self.format_progress([until])
+            self.helper_futures.pop(until)
+            result, _ = self._unpack_result(future, until)
             return f"{until}:{result}"
 
+    @ai_function(
+        desc="Check the progress (messages and tool results) of working sub-agents without waiting for them to finish.",
+        auto_truncate=6000,
+    )
+    async def check_progress(
+        self,
+        who: Annotated[str, AIParam('Name of the helper, or "all".')] = "all",
+        timeout: Annotated[
+            float, AIParam("If there is no new progress yet, wait up to this many seconds for some (optional).")
+        ] = None,
+    ):
+        if who == "all":
+            names = [name for name in self.helper_futures if name in self.progress]
+            if not names:
+                return "There are no active sub-agents."
+        elif who in self.helper_futures and who in self.progress:
+            names = [who]
+        else:
+            return f"No active helper named {who}."
+
+        if timeout:
+            waiters = [
+                asyncio.create_task(self.progress[name].wait_for_update(self._progress_cursors[name], timeout))
+                for name in names
+            ]
+            with self.kani.run_state(RunState.WAITING):
+                await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            for waiter in waiters:
+                waiter.cancel()
+        return self.format_progress(names)
+
+    @ai_function(desc="Cancel a sub-agent whose result is no longer needed. Returns its progress so far.")
+    async def cancel(self, who: Annotated[str, AIParam("Name of the helper.")]):
+        if who not in self.helper_futures or who not in self.progress:
+            return f"No active helper named {who}."
+        if (future := self.helper_futures[who]).done():
+            del self.helper_futures[who]
+            result, _ = self._unpack_result(future, who)
+            return f"{who} had already finished:{result}"
+        progress = self.format_progress([who])
+        await self.cancel_helper(who, "cancelled by parent")
+        return f"Cancelled {who}. {progress}"
+
+    # ==== progress ====
+    def read_progress(self, name: str) -> list[ProgressUpdate]:
+        """Get the progress of the given helper's current task that this kani hasn't read yet."""
+        if (buffer := self.progress.get(name)) is None:
+            return []
+        updates, self._progress_cursors[name] = buffer.read(self._progress_cursors.get(name, 0))
+        return updates
+
+    def format_progress(self, names: list[str]) -> str:
+        """Report the unread progress of the given helpers."""
+        reports = []
+        for name in names:
+            updates = self.read_progress(name)
+            future = self.helper_futures.get(name)
+            if future is not None and future.done():
+                status = "has finished; wait for it to get its result"
+            else:
+                status = "is still working"
+            if updates:
+                reports.append(f"{name} {status}. New progress:\n" + "\n".join(u.render() for u in updates))
+            else:
+                reports.append(f"{name} {status}. No new progress.")
+        return "\n\n".join(reports)
+
+    async def cancel_helper(self, name: str, reason: str = "cancelled"):
+        """Cancel the given helper's current task, stopping its subtree, and wait for it to stop."""
+        if (future := self.helper_futures.pop(name, None)) is None:
+            return
+        self._stop_reasons[name] = reason
+        future.cancel()
+        await asyncio.wait([future])
+        self._stop_reasons.pop(name, None)
+
+    async def cancel_all(self, reason: str = "cancelled"):
+        await asyncio.gather(*(self.cancel_helper(name, reason) for name in list(self.helper_futures)))
+
+    @staticmethod
+    def _unpack_result(future: asyncio.Future, helper_name: str = "unknown") -> tuple[str, str]:
+        """Get (result, helper name) from a finished helper task."""
+        if future.cancelled():
+            return "Cancelled.", helper_name
+        try:
+            res = future.result()
+        except Exception as e:
+            return f"Exception: {e}", helper_name
+        if isinstance(res, tuple) and len(res) == 2:
+            return res
+        return str(res), helper_name
@@ -1,9 +1,11 @@
+import asyncio
 import logging
 from typing import Annotated
 
 from kani import AIParam, ChatRole, ai_function
 from rapidfuzz import fuzz
 
+from cancellation import SubtaskStopped
 from state import RunState
 from delegation._base import DelegationBase
 
@@ -29,6 +31,8 @@ class DelegateOne(DelegationBase):
         NOTE: Helpers cannot see previous parts of your conversation.
         """
         log.info(f"Delegated with instructions: {instructions}")
+        if (reason := self.kani.cancel_scope.stop_reason() or self.app.budget.stop_reason(self.kani)) is not None:
+            return f"You can't delegate any more tasks ({reason}). Finish your task with what you have."
         # if the instructions are >80% the same as the current goal, bonk
         if self.kani.last_user_message and fuzz.ratio(instructions, self.kani.last_user_message.content) > 80:
             return (
@@ -38,12 +42,21 @@ class DelegateOne(DelegationBase):
 
         # wait for child
         helper = await self.create_delegate_kani(instructions)
-        with self.kani.run_state(RunState.WAITING):
-            result = []
+        result = []
+
+        async def _run():
             async for stream in helper.full_round_stream(instructions, max_function_rounds=5):  # TODO temp
                 msg = await stream.message()
                 log.info(msg)
                 if msg.role == ChatRole.ASSISTANT and msg.content:
                     result.append(msg.content)
+
+        with self.kani.run_state(RunState.WAITING):
+            try:
+                await asyncio.wait_for(_run(), helper.cancel_scope.remaining_time())
+            except (SubtaskStopped, asyncio.TimeoutError) as e:
+                reason = e.reason if isinstance(e, SubtaskStopped) else "deadline exceeded"
+                await helper.stop(reason)
+                result.insert(0, f"(stopped early: {reason})")
             await helper.cleanup()
             return "\n".join(result)
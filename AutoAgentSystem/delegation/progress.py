@@ -0,0 +1,63 @@
+import asyncio
+import collections
+import time
+from dataclasses import dataclass, field
+from typing import Literal
+
+
+@dataclass
+class ProgressUpdate:
+    kind: Literal["message", "tool_result"]
+    """Whether this is a completed assistant message or the result of a tool call."""
+    text: str
+    timestamp: float = field(default_factory=time.time)
+
+    def render(self) -> str:
+        return self.text if self.kind == "message" else f"[tool result] {self.text}"
+
+
+class ProgressBuffer:
+    """Incremental progress published by a helper while it works on a task, which its parent can poll or await.
+
+    Updates are numbered in the order they are published; readers keep the number of the next update they want, so
+    several readers can follow the same buffer. Only the last *max_updates* updates are kept.
+    """
+
+    def __init__(self, max_updates: int | None = 100):
+        self.updates: collections.deque[ProgressUpdate] = collections.deque(maxlen=max_updates)
+        self.n_published = 0
+        self.done = False
+        self._changed = asyncio.Event()
+
+    def publish(self, kind: Literal["message", "tool_result"], text: str):
+        self.updates.append(ProgressUpdate(kind, text))
+        self.n_published += 1
+        self._notify()
+
+    def close(self):
+        """Mark the task as finished (successfully or not); waiters are woken and no more updates are expected."""
+        self.done = True
+        self._notify()
+
+    def read(self, since: int = 0) -> tuple[list[ProgressUpdate], int]:
+        """Get the updates published since update number *since* that are still kept, and the number to read from
+        next time."""
+        first = self.n_published - len(self.updates)
+        start = max(since - first, 0)
+        return list(self.updates)[start:], self.n_published
+
+    async def wait_for_update(self, since: int = 0, timeout: float | None = None) -> bool:
+        """Wait until there are updates after number *since* or the task is finished, for at most *timeout* seconds.
+        Returns whether there is anything new to read."""
+        if self.n_published > since or self.done:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.n_published > since or self.done
+
+    def _notify(self):
+        # wake everyone waiting on the current event, and give future waiters a fresh one
+        self._changed.set()
+        self._changed = asyncio.Event()
@@ -0,0 +1,70 @@
+import asyncio
+import random
+from dataclasses import dataclass, field
+
+try:
+    import openai
+
+    _OPENAI_RETRYABLE = (
+        openai.RateLimitError,
+        openai.APITimeoutError,
+        openai.APIConnectionError,
+        openai.InternalServerError,
+    )
+except ImportError:
+    _OPENAI_RETRYABLE = ()
+
+try:
+    import httpx
+
+    _HTTPX_RETRYABLE = (httpx.TransportError,)
+except ImportError:
+    _HTTPX_RETRYABLE = ()
+
+DEFAULT_RETRYABLE_ERRORS = (*_OPENAI_RETRYABLE, *_HTTPX_RETRYABLE, asyncio.TimeoutError, ConnectionError)
+
+
+@dataclass
+class RetryPolicy:
+    """How a delegator retries a helper whose round failed.
+
+    Retryable errors (rate limits, timeouts, dropped connections) are retried with exponential backoff, resuming the
+    same helper's conversation. Other errors, or running out of attempts, reassign the task to a fresh helper up to
+    *max_reassignments* times.
+    """
+
+    max_attempts: int = 3
+    """The number of times to run a helper's round (including the first) before giving up on that helper."""
+    base_delay: float = 2.0
+    """The delay (in seconds) before the first retry."""
+    multiplier: float = 2.0
+    """How much the delay grows with each retry."""
+    max_delay: float = 60.0
+    jitter: float = 0.5
+    """Each delay is randomly scaled by a factor in ``[1 - jitter, 1 + jitter]`` so that helpers that failed together
+    do not retry together."""
+    max_reassignments: int = 1
+    """The number of times a task may be handed to a new helper after its helper fails for good."""
+    retryable_errors: tuple[type[BaseException], ...] = field(default=DEFAULT_RETRYABLE_ERRORS)
+
+    def is_retryable(self, exc: BaseException) -> bool:
+        return isinstance(exc, self.retryable_errors)
+
+    def get_delay(self, attempt: int) -> float:
+        """The delay before retrying after the given (1-indexed) attempt failed."""
+        delay = min(self.max_delay, self.base_delay * self.multiplier ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+
+@dataclass
+class RetryStats:
+    """App-wide counters of helper rounds, retries, and reassignments."""
+
+    n_attempts: int = 0
+    """The number of helper rounds started, including retries."""
+    n_retries: int = 0
+    """The number of times a helper was resumed after a retryable error."""
+    n_reassignments: int = 0
+    """The number of times a task was handed to a new helper after its helper failed."""
+    n_failed: int = 0
+    """The number of tasks that failed after all retries and reassignments."""
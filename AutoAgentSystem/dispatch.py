@@ -0,0 +1,512 @@
+import asyncio
+import collections
+import enum
+import logging
+import os
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import Callable, Iterable
+
+from kani import ChatRole
+
+import events
+
+log = logging.getLogger(__name__)
+
+
+class StreamDeltaCoalescer:
+    """
+    Buffers stream deltas per kani and flushes them as a single :class:`.events.StreamDelta`.
+
+    A buffer is flushed when it has been open for *window* seconds, when it holds at least *max_bytes* bytes of
+    UTF-8 text, or when :meth:`flush` is called (the app does this before dispatching any other event for the same
+    kani, so coalesced deltas are never reordered after the message they belong to).
+    """
+
+    def __init__(self, dispatch: Callable[[events.BaseEvent], None], window: float | None, max_bytes: int | None):
+        """
+        :param dispatch: The function to call with each coalesced event.
+        :param window: The maximum time (in seconds) a delta can be buffered before it is flushed, or ``None`` to only
+            flush on size.
+        :param max_bytes: The maximum number of bytes to buffer per kani before flushing, or ``None`` to only flush on
+            time.
+        """
+        self._dispatch = dispatch
+        self.window = window
+        self.max_bytes = max_bytes
+        # (kani id, role) -> buffered deltas
+        self._buffers: dict[tuple[str, ChatRole], list[str]] = {}
+        self._sizes: dict[tuple[str, ChatRole], int] = {}
+        self._timers: dict[tuple[str, ChatRole], asyncio.TimerHandle] = {}
+
+    def add(self, kani_id: str, delta: str, role: ChatRole):
+        """Buffer a new delta from the given kani."""
+        key = (kani_id, role)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self._buffers[key] = []
+            self._sizes[key] = 0
+            if self.window is not None:
+                self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._flush_key, key)
+        buf.append(delta)
+        self._sizes[key] += len(delta.encode())
+        if self.max_bytes is not None and self._sizes[key] >= self.max_bytes:
+            self._flush_key(key)
+
+    def flush(self, kani_id: str = None):
+        """Flush all pending deltas for the given kani, or for all kani if *kani_id* is None."""
+        if not self._buffers:
+            return
+        keys = [k for k in self._buffers if kani_id is None or k[0] == kani_id]
+        for key in keys:
+            self._flush_key(key)
+
+    def _flush_key(self, key: tuple[str, ChatRole]):
+        buf = self._buffers.pop(key, None)
+        self._sizes.pop(key, None)
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        if not buf:
+            return
+        kani_id, role = key
+        self._dispatch(events.StreamDelta(id=kani_id, delta="".join(buf), role=role))
+
+
+class _Subscription:
+    __slots__ = ("callback", "types", "kani_id", "exclude")
+
+    def __init__(self, callback, types: frozenset[str] | None, kani_id: str | None, exclude: frozenset[str]):
+        self.callback = callback
+        self.types = types
+        self.kani_id = kani_id
+        self.exclude = exclude
+
+    def matches(self, event_type: str, kani_id: str | None) -> bool:
+        if self.kani_id != kani_id:
+            return False
+        if event_type in self.exclude:
+            return False
+        return self.types is None or event_type in self.types
+
+
+def event_type_key(event_type: str | type[events.BaseEvent]) -> str:
+    """Get the ``type`` string of an event class (or return the string if given one)."""
+    if isinstance(event_type, str):
+        return event_type
+    return event_type.model_fields["type"].default
+
+
+class ListenerIndex:
+    """
+    An index of event listeners keyed by event ``type`` (and optionally by kani ID).
+
+    The listeners for a given event are resolved once per event type (or (type, kani ID) pair) and cached until the
+    set of subscriptions changes, so dispatching an event only touches the listeners that want it.
+    """
+
+    def __init__(self):
+        self._subscriptions: list[_Subscription] = []
+        self._has_kani_subscriptions = False
+        # event type -> listeners that are not scoped to a kani
+        self._type_cache: dict[str, tuple[Callable, ...]] = {}
+        # (event type, kani id) -> listeners scoped to that kani
+        self._kani_cache: dict[tuple[str, str], tuple[Callable, ...]] = {}
+
+    def add(
+        self,
+        callback: Callable,
+        event_types: Iterable[str | type[events.BaseEvent]] = None,
+        *,
+        kani_id: str = None,
+        exclude: Iterable[str | type[events.BaseEvent]] = (),
+    ):
+        """
+        Subscribe a callback.
+
+        :param event_types: The event types to subscribe to, or None to subscribe to all events.
+        :param kani_id: If set, only receive events whose ``id`` is this kani's ID.
+        :param exclude: Event types to never receive (only useful if *event_types* is None).
+        """
+        types = frozenset(map(event_type_key, event_types)) if event_types is not None else None
+        self._subscriptions.append(_Subscription(callback, types, kani_id, frozenset(map(event_type_key, exclude))))
+        self._invalidate()
+
+    def remove(self, callback: Callable):
+        """Remove all subscriptions of the given callback. Raises ValueError if there are none."""
+        remaining = [s for s in self._subscriptions if s.callback != callback]
+        if len(remaining) == len(self._subscriptions):
+            raise ValueError(f"{callback!r} is not a registered listener")
+        self._subscriptions = remaining
+        self._invalidate()
+
+    def get(self, event: events.BaseEvent) -> tuple[Callable, ...]:
+        """Get all the listeners that should be called for the given event."""
+        listeners = self._for_type(event.type)
+        if self._has_kani_subscriptions and (kani_id := getattr(event, "id", None)) is not None:
+            listeners += self._for_kani(event.type, kani_id)
+        return listeners
+
+    def has_listeners(self, event_type: str, kani_id: str = None) -> bool:
+        """Whether any listener would be called for an event of this type (from the given kani, if passed)."""
+        if self._for_type(event_type):
+            return True
+        return kani_id is not None and self._has_kani_subscriptions and bool(self._for_kani(event_type, kani_id))
+
+    # ==== internals ====
+    def _for_type(self, event_type: str) -> tuple[Callable, ...]:
+        try:
+            return self._type_cache[event_type]
+        except KeyError:
+            listeners = self._type_cache[event_type] = self._resolve(event_type, None)
+            return listeners
+
+    def _for_kani(self, event_type: str, kani_id: str) -> tuple[Callable, ...]:
+        key = (event_type, kani_id)
+        try:
+            return self._kani_cache[key]
+        except KeyError:
+            listeners = self._kani_cache[key] = self._resolve(event_type, kani_id)
+            return listeners
+
+    def _resolve(self, event_type: str, kani_id: str | None) -> tuple[Callable, ...]:
+        return tuple(s.callback for s in self._subscriptions if s.matches(event_type, kani_id))
+
+    def _invalidate(self):
+        self._type_cache.clear()
+        self._kani_cache.clear()
+        self._has_kani_subscriptions = any(s.kani_id is not None for s in self._subscriptions)
+
+    def __iter__(self):
+        return iter(s.callback for s in self._subscriptions)
+
+    def __len__(self):
+        return len(self._subscriptions)
+
+
+# ==== bounded event queue ====
+class QueuePolicy(enum.Enum):
+    """
+    What the event queue does with an event dispatched while it is full.
+
+    * ``QueuePolicy.BLOCK``: Accept the event anyway, but make producers that call :meth:`.BoundedEventQueue.wait_for_room`
+      wait until the queue has room again.
+    * ``QueuePolicy.SPILL``: Spill the event to a temporary file on disk; it is read back in order once there is room.
+    * ``QueuePolicy.DROP``: Drop the event.
+    * ``QueuePolicy.MERGE``: Merge the event into a compatible queued event (stream deltas are concatenated, state
+      changes collapse to the latest state per kani). Falls back to ``DROP`` for events that are not logged, and to
+      ``BLOCK`` otherwise.
+    """
+
+    BLOCK = "block"
+    SPILL = "spill"
+    DROP = "drop"
+    MERGE = "merge"
+
+
+DEFAULT_QUEUE_POLICIES = {
+    events.StreamDelta: QueuePolicy.MERGE,
+    events.KaniStateChange: QueuePolicy.MERGE,
+}
+
+
+@dataclass
+class EventQueueMetrics:
+    depth: int
+    """The number of events currently in memory waiting to be dispatched."""
+    max_depth: int
+    """The highest in-memory depth seen so far."""
+    spilled_depth: int
+    """The number of events currently spilled to disk waiting to be dispatched."""
+    n_spilled: int
+    """The total number of events that have been spilled to disk."""
+    n_blocked: int
+    """The total number of events that were accepted over capacity under the ``BLOCK`` policy."""
+    dropped: collections.Counter
+    """The number of dropped events, by event type."""
+    merged: collections.Counter
+    """The number of events merged into a queued event, by event type."""
+
+
+class _Slot:
+    __slots__ = ("event",)
+
+    def __init__(self, event: events.BaseEvent | None):
+        self.event = event  # None if the event was merged away
+
+
+class BoundedEventQueue:
+    """
+    A FIFO queue of events with an optional maximum size and per-event-class overflow policies
+    (see :class:`QueuePolicy`).
+
+    Implements the subset of the :class:`asyncio.Queue` interface the app uses (``put_nowait``, ``get``,
+    ``task_done``, ``join``, ``qsize``). ``put_nowait`` never raises; when the queue is full, the policy of the event's
+    class decides what happens to it.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 0,
+        policies: dict[type[events.BaseEvent], QueuePolicy] = None,
+        default_policy: QueuePolicy = QueuePolicy.BLOCK,
+    ):
+        """
+        :param maxsize: The number of events to hold in memory before applying overflow policies. If 0, the queue is
+            unbounded.
+        :param policies: A mapping of event classes to the policy to use for them (and their subclasses). Merged with
+            :data:`DEFAULT_QUEUE_POLICIES`.
+        :param default_policy: The policy to use for events with no configured policy.
+        """
+        self.maxsize = maxsize
+        self.policies = {**DEFAULT_QUEUE_POLICIES, **(policies or {})}
+        self.default_policy = default_policy
+        self._policy_cache: dict[type, QueuePolicy] = {}
+        self._slots: collections.deque[_Slot] = collections.deque()
+        self._size = 0  # live events in memory
+        self._unfinished = 0  # events put but not yet task_done
+        self._not_empty = asyncio.Event()
+        self._has_room = asyncio.Event()
+        self._all_done = asyncio.Event()
+        self._all_done.set()
+        # merge bookkeeping: the last in-memory slot of each kani, and each kani's queued state change
+        self._tail_by_kani: dict[str, _Slot] = {}
+        self._state_slots: dict[str, _Slot] = {}
+        # spill
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spill_count = 0
+        # metrics
+        self._max_depth = 0
+        self._n_spilled = 0
+        self._n_blocked = 0
+        self._dropped = collections.Counter()
+        self._merged = collections.Counter()
+
+    # ==== asyncio.Queue interface ====
+    def qsize(self) -> int:
+        return self._size + self._spill_count
+
+    def full(self) -> bool:
+        return 0 < self.maxsize <= self._size
+
+    def put_nowait(self, event: events.BaseEvent):
+        if not self._spill_count and not self.full():
+            self._append(event)
+            return
+
+        policy = self._policy_for(event)
+        if policy == QueuePolicy.MERGE:
+            if self._merge(event):
+                self._merged[event.type] += 1
+                return
+            policy = QueuePolicy.BLOCK if event.__log_event__ else QueuePolicy.DROP
+
+        if policy == QueuePolicy.DROP:
+            self._dropped[event.type] += 1
+        elif policy == QueuePolicy.SPILL:
+            self._spill(event)
+        else:
+            self._overflow(event)
+
+    async def get(self) -> events.BaseEvent:
+        while True:
+            while not self._slots:
+                self._not_empty.clear()
+                await self._not_empty.wait()
+            slot = self._slots.popleft()
+            event = slot.event
+            if event is None:
+                continue
+            self._forget(slot, event)
+            self._size -= 1
+            self._refill()
+            if not self.full():
+                self._has_room.set()
+            return event
+
+    def task_done(self):
+        if self._unfinished <= 0:
+            raise ValueError("task_done() called too many times")
+        self._unfinished -= 1
+        if self._unfinished == 0:
+            self._all_done.set()
+
+    async def join(self):
+        if self._unfinished:
+            await self._all_done.wait()
+
+    # ==== backpressure + metrics ====
+    async def wait_for_room(self):
+        """Wait until the in-memory queue is below its maximum size."""
+        while self.full():
+            self._has_room.clear()
+            await self._has_room.wait()
+
+    def metrics(self) -> EventQueueMetrics:
+        """Get the current metrics of this queue."""
+        return EventQueueMetrics(
+            depth=self._size,
+            max_depth=self._max_depth,
+            spilled_depth=self._spill_count,
+            n_spilled=self._n_spilled,
+            n_blocked=self._n_blocked,
+            dropped=self._dropped.copy(),
+            merged=self._merged.copy(),
+        )
+
+    # ==== internals ====
+    def _policy_for(self, event: events.BaseEvent) -> QueuePolicy:
+        cls = type(event)
+        try:
+            return self._policy_cache[cls]
+        except KeyError:
+            policy = next((self.policies[c] for c in cls.__mro__ if c in self.policies), self.default_policy)
+            self._policy_cache[cls] = policy
+            return policy
+
+    def _append(self, event: events.BaseEvent, *, new: bool = True):
+        slot = _Slot(event)
+        self._slots.append(slot)
+        self._size += 1
+        if new:
+            self._unfinished += 1
+            self._all_done.clear()
+        self._max_depth = max(self._max_depth, self._size)
+        if self.maxsize and (kani_id := getattr(event, "id", None)) is not None:
+            self._tail_by_kani[kani_id] = slot
+            if isinstance(event, events.KaniStateChange):
+                self._state_slots[kani_id] = slot
+        self._not_empty.set()
+
+    def _forget(self, slot: _Slot, event: events.BaseEvent):
+        if (kani_id := getattr(event, "id", None)) is None:
+            return
+        if self._tail_by_kani.get(kani_id) is slot:
+            del self._tail_by_kani[kani_id]
+        if self._state_slots.get(kani_id) is slot:
+            del self._state_slots[kani_id]
+
+    def _overflow(self, event: events.BaseEvent):
+        # keep FIFO order: once anything is spilled, everything after it must be too
+        if self._spill_count:
+            self._spill(event)
+        else:
+            self._n_blocked += 1
+            self._append(event)
+
+    def _merge(self, event: events.BaseEvent) -> bool:
+        if isinstance(event, events.StreamDelta):
+            # only if the kani's latest queued event is a delta of the same role, so no other event is reordered
+            slot = self._tail_by_kani.get(event.id)
+            if slot is None or not isinstance(slot.event, events.StreamDelta) or slot.event.role != event.role:
+                return False
+            # copy rather than mutate: the same event object may be queued in more than one queue
+            slot.event = slot.event.model_copy(update={"delta": slot.event.delta + event.delta})
+            return True
+        if isinstance(event, events.KaniStateChange):
+            # drop the stale queued state and enqueue the latest one at the end
+            slot = self._state_slots.get(event.id)
+            if slot is None:
+                return False
+            self._forget(slot, slot.event)
+            slot.event = None
+            self._size -= 1
+            self._unfinished -= 1
+            self._overflow(event)
+            return True
+        return False
+
+    def _spill(self, event: events.BaseEvent):
+        if self._spill_file is None:
+            self._spill_file = tempfile.TemporaryFile()
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spill_file.write(f"{event.type}\t{event.model_dump_json()}\n".encode())
+        self._spill_count += 1
+        self._n_spilled += 1
+        self._unfinished += 1
+        self._all_done.clear()
+        # later events for this kani are now behind the spill, so they can't be merged into earlier slots
+        if (kani_id := getattr(event, "id", None)) is not None:
+            self._tail_by_kani.pop(kani_id, None)
+
+    def _refill(self):
+        if not self._spill_count:
+            return
+        self._spill_file.seek(self._spill_read_pos)
+        while self._spill_count and not self.full():
+            event_type, data = self._spill_file.readline().split(b"\t", 1)
+            self._spill_count -= 1
+            self._append(events.get_event_class(event_type.decode()).model_validate_json(data), new=False)
+        self._spill_read_pos = self._spill_file.tell()
+        if not self._spill_count:
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._spill_read_pos = 0
+
+
+# ==== listener lanes ====
+@dataclass
+class LaneStats:
+    name: str
+    """The name of the listener."""
+    depth: int
+    """The number of events waiting to be delivered to the listener."""
+    n_delivered: int
+    """The number of events delivered to the listener so far."""
+    last_lag: float
+    """The time (in seconds) between the last delivered event being dispatched and it being delivered."""
+    max_lag: float
+    """The highest lag seen so far."""
+
+
+class ListenerLane:
+    """
+    An ordered delivery lane for a single listener.
+
+    Each lane has its own queue and task, so listeners run concurrently and a slow listener only delays its own events,
+    while each listener still sees events in the order they were dispatched.
+    """
+
+    def __init__(self, callback: Callable, queue: BoundedEventQueue, name: str):
+        self.callback = callback
+        self.queue = queue
+        self.name = name
+        self.n_delivered = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self._closing = False
+        self.task = asyncio.create_task(self._run(), name=f"redel-listener-{name}")
+
+    def put_nowait(self, event: events.BaseEvent):
+        self.queue.put_nowait(event)
+
+    def close(self):
+        """Stop delivering events. If called from within the listener, the current event finishes first."""
+        if asyncio.current_task() is self.task:
+            self._closing = True
+        else:
+            self.task.cancel()
+
+    def stats(self) -> LaneStats:
+        return LaneStats(
+            name=self.name,
+            depth=self.queue.qsize(),
+            n_delivered=self.n_delivered,
+            last_lag=self.last_lag,
+            max_lag=self.max_lag,
+        )
+
+    async def _run(self):
+        while not self._closing:
+            event = await self.queue.get()
+            self.last_lag = time.time() - event.timestamp
+            self.max_lag = max(self.max_lag, self.last_lag)
+            try:
+                await self.callback(event)
+            except Exception:
+                log.exception(f"Exception in listener {self.name}:")
+            finally:
+                self.n_delivered += 1
+                self.queue.task_done()
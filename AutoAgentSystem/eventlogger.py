@@ -1,50 +1,269 @@
+import asyncio
 import contextlib
+import hashlib
 import json
 import logging
+import os
 import pathlib
+import threading
 import time
 from collections import Counter
 from functools import cached_property
-from typing import TYPE_CHECKING
+from typing import Literal, TYPE_CHECKING
 
 import events
-from config import DEFAULT_LOG_DIR
-from utils import read_jsonl
-
+from catalog import SessionMeta, get_catalog
+from compactlog import CompactLogWriter
+from config import DEFAULT_CATALOG_PATH, DEFAULT_LOG_DIR
 
 if TYPE_CHECKING:
     from .app import AutoAgentSystem
+    from .base_kani import BaseKani
+    from .state import KaniState
 
 
 log = logging.getLogger(__name__)
 
+# the event index sidecar stores a (n_events, byte offset, timestamp) checkpoint every this many events
+INDEX_CHECKPOINT_INTERVAL = 1000
+INDEX_VERSION = 2
+# the index fingerprints this many bytes at the start of the log and before the end of the part it covers
+INDEX_FINGERPRINT_BYTES = 4096
+
+
+class GroupCommitWriter:
+    """
+    A file-like writer for the event log that buffers writes in memory and commits them in groups from a background
+    thread, once *max_bytes* are buffered or every *max_delay* seconds.
+
+    Calls to :meth:`write` never touch the disk, so they are cheap to make from the event loop. This is mainly useful
+    with ``durability="fsync"``, where it amortizes the cost of an fsync over each group instead of paying it per event.
+    """
+
+    def __init__(
+        self,
+        path: pathlib.Path,
+        mode: Literal["w", "a"],
+        *,
+        max_bytes: int = 65536,
+        max_delay: float = 0.2,
+        durability: Literal["none", "flush", "fsync"] = "flush",
+    ):
+        """
+        :param max_bytes: Commit once this many bytes are buffered.
+        :param max_delay: Commit buffered writes at least this often (in seconds).
+        :param durability: What to do after writing each group: ``"none"`` leaves the data in Python's file buffer,
+            ``"flush"`` flushes it to the OS, and ``"fsync"`` also fsyncs it to disk.
+        """
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.durability = durability
+        self._file = open(path, f"{mode}b")
+        self._buf: list[bytes] = []
+        self._buf_size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._io_lock = threading.Lock()  # so groups are committed in order
+        self._thread = threading.Thread(target=self._run, name=f"redel-aof-{path}", daemon=True)
+        self._thread.start()
+
+    def write(self, data: str):
+        encoded = data.encode()
+        with self._cond:
+            self._buf.append(encoded)
+            self._buf_size += len(encoded)
+            if self._buf_size >= self.max_bytes:
+                self._cond.notify()
+
+    def flush(self):
+        """Commit everything written so far and flush it to the OS, regardless of durability level. Blocks."""
+        self._commit()
+        with self._io_lock:
+            self._file.flush()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._file.close()
+
+    def _commit(self):
+        with self._io_lock:
+            with self._cond:
+                buf, self._buf, self._buf_size = self._buf, [], 0
+            if not buf:
+                return
+            self._file.write(b"".join(buf))
+            if self.durability != "none":
+                self._file.flush()
+            if self.durability == "fsync":
+                os.fsync(self._file.fileno())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._closed and self._buf_size < self.max_bytes:
+                    self._cond.wait(self.max_delay)
+                closed = self._closed
+            self._commit()
+            if closed:
+                return
+
 
 class EventLogger:
-    def __init__(self, app: "AutoAgentSystem", session_id: str, log_dir: pathlib.Path = None, clear_existing_log: bool = False):
+    def __init__(
+        self,
+        app: "AutoAgentSystem",
+        session_id: str,
+        log_dir: pathlib.Path = None,
+        clear_existing_log: bool = False,
+        *,
+        log_format: Literal["jsonl", "compact"] = "jsonl",
+        writer: Literal["line", "group"] = "line",
+        group_max_bytes: int = 65536,
+        group_max_delay: float = 0.2,
+        durability: Literal["none", "flush", "fsync"] = "flush",
+        catalog_path: pathlib.Path | None = DEFAULT_CATALOG_PATH,
+    ):
+        """
+        :param log_format: The format of the event log. ``"jsonl"`` writes to ``events.jsonl``; ``"compact"`` writes
+            compressed segments to the ``events.rlog`` directory (see ``compactlog``). The writer options below only
+            apply to the JSONL format.
+        :param writer: How events are written to the log. ``"line"`` (default) writes each event to the (line-buffered)
+            file as it is logged. ``"group"`` buffers events and writes them in groups from a background thread (see
+            :class:`.GroupCommitWriter`); it only pays off with ``durability="fsync"``.
+        :param group_max_bytes: For the group writer, write a group once this many bytes are buffered.
+        :param group_max_delay: For the group writer, write buffered events at least this often (in seconds).
+        :param durability: For the group writer, what to do after writing each group (``"none"``, ``"flush"``, or
+            ``"fsync"``).
+        :param catalog_path: The path of the session catalog to keep this session's metadata up to date in (see
+            ``catalog``), or None to not catalog this session.
+        """
         self.app = app
         self.session_id = session_id
         self.last_modified = time.time()
         self.log_dir = log_dir or (DEFAULT_LOG_DIR / session_id)
         self.clear_existing_log = clear_existing_log
+        self.log_format = log_format
+        self.writer = writer
+        self.group_max_bytes = group_max_bytes
+        self.group_max_delay = group_max_delay
+        self.durability = durability
+        self.catalog = get_catalog(catalog_path) if catalog_path is not None else None
 
         self.aof_path = self.log_dir / "events.jsonl"
         self.state_path = self.log_dir / "state.json"
+        self.index_path = self.log_dir / "events.idx.json"
+        self.compact_log_path = self.log_dir / "events.rlog"
 
         self.event_count = Counter()
+        self._aof_size = 0  # bytes
+        self._checkpoints: list[tuple[int, int, float]] = []  # (n_events, byte offset, timestamp)
         self._suppress_flag = 0
+        # kani id -> (fingerprint, serialized KaniState) of the last snapshot
+        self._state_cache: dict[str, tuple[tuple, str]] = {}
+        self._state_lock = asyncio.Lock()
+        # session stats for the catalog
+        self._prompt_tokens = 0
+        self._completion_tokens = 0
+        self._n_kanis = 0
+        self._max_depth = 0
+        self._tools = Counter()
 
     @cached_property
     def event_file(self):
         # we use a cached property here to only lazily create the log dir if we need it
         self.log_dir.mkdir(exist_ok=True, parents=True)
+        if not self.clear_existing_log:
+            self._load_catalog_stats()
+
+        if self.log_format == "compact":
+            writer = CompactLogWriter(self.compact_log_path, "w" if self.clear_existing_log else "a")
+            self.event_count = writer.event_count
+            return writer
 
         if self.clear_existing_log:
-            return open(self.aof_path, "w", buffering=1, encoding="utf-8")
+            self.index_path.unlink(missing_ok=True)
+            mode = "w"
+        else:
+            if self.aof_path.exists():
+                self._load_event_index()
+            mode = "a"
+
+        if self.writer == "group":
+            return GroupCommitWriter(
+                self.aof_path,
+                mode,
+                max_bytes=self.group_max_bytes,
+                max_delay=self.group_max_delay,
+                durability=self.durability,
+            )
+        # newline="\n" so that our byte offsets match the file on all platforms
+        return open(self.aof_path, mode, buffering=1, encoding="utf-8", newline="\n")
 
-        if self.aof_path.exists():
-            existing_events = read_jsonl(self.aof_path)
-            self.event_count = Counter(event["type"] for event in existing_events)
-        return open(self.aof_path, "a", buffering=1, encoding="utf-8")
+    def _load_event_index(self):
+        """Restore the event counts from the index sidecar, only scanning the part of the log it doesn't cover.
+        If the sidecar is missing or stale (e.g. the log was truncated or rewritten since), falls back to scanning the
+        whole log."""
+        size = self.aof_path.stat().st_size
+        try:
+            index = json.loads(self.index_path.read_text(encoding="utf-8"))
+            if (
+                index["version"] != INDEX_VERSION
+                or index["size"] > size
+                or index["fingerprint"] != _log_fingerprint(self.aof_path, index["size"])
+            ):
+                raise ValueError("event index is stale")
+            offset = index["size"]
+            self.event_count = Counter(index["counts"])
+            self._checkpoints = [tuple(c) for c in index["checkpoints"]]
+        except (OSError, ValueError, KeyError):
+            log.info(f"Event index for {self.aof_path} is missing or stale, rebuilding from the full log")
+            offset = 0
+            self.event_count = Counter()
+            self._checkpoints = []
+
+        # scan the events appended since the index was written (all of them, if we fell back)
+        if offset < size:
+            with open(self.aof_path, "rb") as f:
+                f.seek(offset)
+                for line in f:
+                    data = json.loads(line)
+                    n_events = self.event_count.total()
+                    if n_events % INDEX_CHECKPOINT_INTERVAL == 0:
+                        self._checkpoints.append((n_events, offset, data["timestamp"]))
+                    self.event_count[data["type"]] += 1
+                    offset += len(line)
+        self._aof_size = offset
+
+    def _load_catalog_stats(self):
+        """Restore the session stats from the catalog, if this session is in it."""
+        if self.catalog is None or (meta := self.catalog.get(self.session_id)) is None:
+            return
+        self._prompt_tokens = meta.prompt_tokens
+        self._completion_tokens = meta.completion_tokens
+        self._n_kanis = meta.n_kanis
+        self._max_depth = meta.max_depth
+        self._tools = Counter(meta.tools)
+
+    def _update_stats(self, event: events.BaseEvent):
+        if isinstance(event, events.TokensUsed):
+            self._prompt_tokens += event.prompt_tokens or 0
+            self._completion_tokens += event.completion_tokens or 0
+        elif isinstance(event, events.KaniSpawn):
+            self._n_kanis += 1
+            self._max_depth = max(self._max_depth, event.depth)
+        elif isinstance(event, events.KaniMessage) and event.msg.tool_calls:
+            for tc in event.msg.tool_calls:
+                self._tools[tc.function.name] += 1
+
+    def _write_index_file(self, index: dict):
+        index["fingerprint"] = _log_fingerprint(self.aof_path, index["size"])
+        tmp_path = self.index_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
 
     async def log_event(self, event: events.BaseEvent):
         if self._suppress_flag:
@@ -53,25 +272,83 @@ class EventLogger:
             return
         self.last_modified = time.time()
         # since this is a synch operation we don't need a lock here (though it is thread-unsafe)
-        self.event_file.write(event.model_dump_json())
-        self.event_file.write("\n")
+        event_file = self.event_file
+        self._update_stats(event)
+        if self.log_format == "compact":
+            event_file.write_event(event)
+            self.event_count[event.type] += 1
+            return
+        n_events = self.event_count.total()
+        if n_events % INDEX_CHECKPOINT_INTERVAL == 0:
+            self._checkpoints.append((n_events, self._aof_size, event.timestamp))
+        data = event.model_dump_json()
+        event_file.write(f"{data}\n")
+        self._aof_size += len(data.encode()) + 1
         self.event_count[event.type] += 1
 
     async def write_state(self):
-        """Write the full state of the app to the state file, with a basic checksum against the AOF to check validity"""
+        """Write the full state of the app to the state file, with a basic checksum against the AOF to check validity.
+
+        Only kani whose state changed since the last snapshot are re-serialized. Encoding and the (atomic) file write
+        happen in a worker thread so that large states don't block the event loop.
+        """
         if self._suppress_flag:
             return
+        async with self._state_lock:
+            # take a snapshot of the changed kani on the event loop, where their state can't change under us
+            kani_ids = []
+            snapshots = {}
+            for ai in list(self.app.kanis.values()):
+                kani_ids.append(ai.id)
+                fingerprint = _state_fingerprint(ai)
+                cached = self._state_cache.get(ai.id)
+                if cached is None or cached[0] != fingerprint:
+                    snapshots[ai.id] = (fingerprint, ai.get_save_state())
+            meta = {
+                "id": self.session_id,
+                "title": self.app.title,
+                "last_modified": self.last_modified,
+                "n_events": self.event_count.total(),
+            }
+            await asyncio.to_thread(self._write_state_file, meta, kani_ids, snapshots)
+            if self.catalog is not None:
+                session_meta = SessionMeta(
+                    **meta,
+                    log_dir=str(self.log_dir),
+                    prompt_tokens=self._prompt_tokens,
+                    completion_tokens=self._completion_tokens,
+                    n_kanis=self._n_kanis,
+                    max_depth=self._max_depth,
+                    tools=dict(self._tools),
+                )
+                await asyncio.to_thread(self.catalog.upsert, session_meta)
+            if self.log_format == "compact" and self.event_count.total():
+                self.event_file.flush()
+            # make sure the index doesn't cover events that aren't on disk yet
+            if self.log_format == "jsonl" and self.event_count.total():
+                if isinstance(self.event_file, GroupCommitWriter):
+                    await asyncio.to_thread(self.event_file.flush)
+                index = {
+                    "version": INDEX_VERSION,
+                    "size": self._aof_size,
+                    "counts": dict(self.event_count),
+                    "checkpoints": list(self._checkpoints),
+                }
+                await asyncio.to_thread(self._write_index_file, index)
+
+    def _write_state_file(self, meta: dict, kani_ids: list[str], snapshots: dict[str, tuple[tuple, "KaniState"]]):
+        for kani_id, (fingerprint, state) in snapshots.items():
+            self._state_cache[kani_id] = (fingerprint, state.model_dump_json())
+        for kani_id in self._state_cache.keys() - set(kani_ids):
+            del self._state_cache[kani_id]
+        # splice the cached kani states into the metadata object
+        state = ", ".join(self._state_cache[kani_id][1] for kani_id in kani_ids)
+        data = f'{json.dumps(meta)[:-1]}, "state": [{state}]}}'
         self.log_dir.mkdir(exist_ok=True, parents=True)
-        state = [ai.get_save_state().model_dump(mode="json") for ai in self.app.kanis.values()]
-        data = {
-            "id": self.session_id,
-            "title": self.app.title,
-            "last_modified": self.last_modified,
-            "n_events": self.event_count.total(),
-            "state": state,
-        }
-        with open(self.state_path, "w", encoding="utf-8") as f:
-            json.dump(data, f, indent=2)
+        tmp_path = self.state_path.with_suffix(".json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, self.state_path)
 
     async def close(self):
         # if we haven't done anything, don't write anything
@@ -88,3 +365,29 @@ class EventLogger:
             yield
         finally:
             self._suppress_flag -= 1
+
+
+def _log_fingerprint(path: pathlib.Path, size: int) -> str:
+    """A hash of the start of the log and of the bytes just before *size*, to check that the log an index was written
+    for is the same log (not truncated or rewritten) up to the size it covers."""
+    with open(path, "rb") as f:
+        head = f.read(min(size, INDEX_FINGERPRINT_BYTES))
+        tail_start = max(size - INDEX_FINGERPRINT_BYTES, 0)
+        f.seek(tail_start)
+        tail = f.read(size - tail_start)
+    return hashlib.blake2b(head + tail, digest_size=16).hexdigest()
+
+
+def _state_fingerprint(ai: "BaseKani") -> tuple:
+    """A cheap fingerprint of the parts of a kani's state that change as it runs.
+
+    Messages are not compared by value, so a message that is mutated in place after being added to the history is not
+    picked up until the next change to the kani. Spilled histories are not read back to compute it.
+    """
+    return (
+        ai.state,
+        ai.history_fingerprint(),
+        tuple(map(id, ai.always_included_messages)),
+        tuple(ai.children),
+        len(ai.functions),
+    )
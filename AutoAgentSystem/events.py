@@ -5,7 +5,7 @@ from typing import Literal
 from kani import ChatMessage, ChatRole
 from pydantic import BaseModel, Field
 
-from state import KaniState, RunState
+from state import KaniState, RunState, TaskRecord, TaskStatus
 
 
 
@@ -56,6 +56,29 @@ class KaniStateChange(BaseEvent):
     state: RunState
 
 
+class TaskStateChange(BaseEvent):
+    """
+    A delegated task was created or changed status. Includes the full record of the task. See :class:`.TaskRegistry`.
+
+    The task ID can be the same as an existing task ID, in which case this event should overwrite the previous record.
+    """
+
+    type: Literal["task_state_change"] = "task_state_change"
+    id: str
+    """The ID of the helper kani the task was given to."""
+    task: TaskRecord
+    previous_status: TaskStatus | None = None
+    """The status of the task before this change, or None if the task was just created."""
+
+
+class TasksCompacted(BaseEvent):
+    """Finished tasks were removed from the task registry (and archived, if ``archive_path`` is set)."""
+
+    type: Literal["tasks_compacted"] = "tasks_compacted"
+    task_ids: list[str]
+    archive_path: str | None = None
+
+
 class TokensUsed(BaseEvent):
     """A kani just finished a request to the engine, which used this many tokens."""
 
@@ -63,6 +86,23 @@ class TokensUsed(BaseEvent):
     id: str
     prompt_tokens: int
     completion_tokens: int
+    cached_prompt_tokens: int | None = None
+    """The number of prompt tokens read from the provider's prompt cache, if the provider reports it."""
+    uncached_prompt_tokens: int | None = None
+    """The number of prompt tokens the provider had to process from scratch, if it reports prompt caching."""
+
+
+class BudgetExceeded(BaseEvent):
+    """A token or cost budget was used up. Sent once per limit. See :class:`.BudgetAccountant`."""
+
+    type: Literal["budget_exceeded"] = "budget_exceeded"
+    id: str | None
+    """The ID of the kani whose own or subtree budget was used up, or None for the session budget."""
+    scope: Literal["session", "subtree", "kani"]
+    total_tokens: int
+    cost: float
+    max_tokens: int | None
+    max_cost: float | None
 
 
 class KaniMessage(BaseEvent):
@@ -73,6 +113,21 @@ class KaniMessage(BaseEvent):
     msg: ChatMessage
 
 
+class HistoryCompacted(BaseEvent):
+    """
+    Old function results in a kani's chat history were replaced by short excerpts to save tokens.
+
+    The original messages are in the earlier ``kani_message`` events.
+    """
+
+    type: Literal["history_compacted"] = "history_compacted"
+    id: str
+    message_idxs: list[int]
+    """The indices of the elided messages in the kani's chat history."""
+    tokens_before: int
+    tokens_after: int
+
+
 class RootMessage(BaseEvent):
     """
     The root kani has a new result.
@@ -122,3 +177,20 @@ class SessionMetaUpdate(BaseEvent):
 class SendMessage(BaseEvent):
     type: Literal["send_message"] = "send_message"
     content: str
+
+
+# ==== utils ====
+_event_classes: dict[str, type[BaseEvent]] = {}
+
+
+def get_event_class(event_type: str) -> type[BaseEvent]:
+    """Get the event class with the given ``type``. Raises KeyError if there is no such event class."""
+    if event_type not in _event_classes:
+        # refresh the registry -- new subclasses could have been defined since the last lookup
+        to_visit = [BaseEvent]
+        while to_visit:
+            cls = to_visit.pop()
+            to_visit.extend(cls.__subclasses__())
+            if (field := cls.model_fields.get("type")) is not None and isinstance(field.default, str):
+                _event_classes.setdefault(field.default, cls)
+    return _event_classes[event_type]
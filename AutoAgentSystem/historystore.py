@@ -0,0 +1,83 @@
+"""
+On-disk storage for the chat histories of finished, idle kani.
+
+When a kani finishes its task, its history can be spilled to a :class:`HistoryStore` and dropped from memory (see
+:meth:`.BaseKani.spill_history`). The history is read back the next time anything accesses ``kani.chat_history``, e.g.
+when the kani is re-tasked. The event logger serializes spilled kani straight from the store without making their
+histories resident again.
+"""
+
+import json
+import os
+from dataclasses import dataclass
+from pathlib import Path
+
+from kani import ChatMessage
+from pydantic import TypeAdapter
+
+_messages_adapter = TypeAdapter(list[ChatMessage])
+
+
+@dataclass
+class MemoryStats:
+    """An estimate of the chat history memory used by a session."""
+
+    n_kanis: int
+    n_spilled: int
+    """The number of kani whose history is on disk rather than in memory."""
+    resident_messages: int
+    """The number of messages in the histories that are in memory."""
+    resident_chars: int
+    """The length of the text of the messages in memory, as a rough measure of their size."""
+    spilled_bytes: int
+    """The size of the spilled histories on disk."""
+    n_spills: int
+    n_rehydrations: int
+
+
+class HistoryStore:
+    """Spilled chat histories, one JSON file per kani."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.n_spills = 0
+        self.n_rehydrations = 0
+        self._sizes: dict[str, int] = {}  # kani id -> size on disk
+
+    def _file(self, kani_id: str) -> Path:
+        return self.path / f"{kani_id}.json"
+
+    @property
+    def spilled_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def save(self, kani_id: str, messages: list[ChatMessage], token_lens: list[int] | None = None):
+        """Write the history of a kani (and optionally the token length of each message) to disk. Thread-safe for
+        different kani."""
+        messages_json = _messages_adapter.dump_json(messages).decode()
+        data = f'{{"token_lens": {json.dumps(token_lens)}, "messages": {messages_json}}}'
+        self.path.mkdir(parents=True, exist_ok=True)
+        fp = self._file(kani_id)
+        tmp_fp = fp.with_suffix(".json.tmp")
+        with open(tmp_fp, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_fp, fp)
+        self._sizes[kani_id] = len(data)
+        self.n_spills += 1
+
+    def load(self, kani_id: str) -> tuple[list[ChatMessage], list[int] | None]:
+        """Read a spilled history, returning (messages, token lengths if saved)."""
+        with open(self._file(kani_id), encoding="utf-8") as f:
+            data = json.load(f)
+        return _messages_adapter.validate_python(data["messages"]), data["token_lens"]
+
+    def rehydrate(self, kani_id: str) -> tuple[list[ChatMessage], list[int] | None]:
+        """Read a spilled history that is being made resident again, and remove it from disk."""
+        result = self.load(kani_id)
+        self.delete(kani_id)
+        self.n_rehydrations += 1
+        return result
+
+    def delete(self, kani_id: str):
+        self._file(kani_id).unlink(missing_ok=True)
+        self._sizes.pop(kani_id, None)
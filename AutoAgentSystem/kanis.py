@@ -1,7 +1,11 @@
 import asyncio
+import copy
 import datetime
+import functools
 import inspect
 import logging
+import time
+from typing import Literal
 
 from kani import AIFunction, ChatMessage
 
@@ -28,19 +32,40 @@ DEFAULT_ROOT_PROMPT = (
     "The current time is {time}."
 )
 
+# the parts that differ between delegates go last, so that siblings share a prompt prefix that providers can cache
 DEFAULT_DELEGATE_PROMPT = (
-    "You are {name}, a specialist agent who can help the main agent accomplish part of a mission.\n"
+    "You are a specialist agent who can help the main agent accomplish part of a mission.\n"
     "- First, understand your assigned task and explain your approach.\n"
     "- If needed, you may break it down and further delegate subtasks or collaborate with others.\n"
     "- You may use tools or APIs if useful.\n"
     "- Produce a clear, concise and actionable result for your task.\n"
-    "The current time is {time}."
+    "Your name is {name}. The current time is {time}."
 )
 
-def get_system_prompt(kani: "BaseKani") -> str:
-    now = datetime.datetime.now().strftime("%a %d %b %Y, %I:%M%p")
+SystemPromptGranularity = Literal["minute", "hour", "session"]
+
+SYSTEM_PROMPT_TIME_FORMATS = {
+    "minute": "%a %d %b %Y, %I:%M%p",
+    "hour": "%a %d %b %Y, %I%p",
+}
+# with "session" granularity the time is rendered once, when the kani first builds its prompt, to the minute
+SYSTEM_PROMPT_TIME_FORMATS["session"] = SYSTEM_PROMPT_TIME_FORMATS["minute"]
+
+
+def get_system_prompt(kani: "BaseKani", granularity: SystemPromptGranularity = "minute") -> str:
+    now = datetime.datetime.now().strftime(SYSTEM_PROMPT_TIME_FORMATS[granularity])
     return kani.system_prompt.format(name=kani.name, time=now)
 
+
+def system_prompt_time_key(granularity: SystemPromptGranularity) -> tuple:
+    """A key that changes exactly when the time shown in a system prompt with the given granularity changes."""
+    if granularity == "session":
+        return ()
+    now = time.localtime()
+    if granularity == "hour":
+        return now[:4]
+    return now[:5]
+
 class ReDelKani(BaseKani):
     def __init__(self, *args, **kwargs):
         kwargs.setdefault("retry_attempts", 10)
@@ -49,6 +74,7 @@ class ReDelKani(BaseKani):
         self.delegator = None
         self.tools = []
         self.task_description = None
+        self._system_prompt_key = None
 
     def _register_tools(self, delegator: DelegationBase | None, tools: list[ToolBase]):
         new_functions = {}
@@ -58,19 +84,27 @@ class ReDelKani(BaseKani):
         self.tools = tools
         for inst in tools:
             new_functions.update(get_tool_functions(inst))
-        self.functions = new_functions
+        # tool schemas are sent in this order; keep it the same for every kani with the same tools
+        self.functions = dict(sorted(new_functions.items()))
 
     def get_tool(self, cls: type[ToolBase]) -> ToolBase | None:
         return next((t for t in self.tools if type(t) is cls), None)
 
-    async def create_delegate_kani(self, instructions: str):
+    async def create_delegate_kani(self, instructions: str, timeout: float = None, max_requests: int = None):
+        """Create a child kani for the given instructions, whose deadline and request budget are nested within this
+        kani's (see :class:`.CancelScope`). *timeout* and *max_requests* default to the app's subtask limits."""
         name = self.namer.get_name()
+        cancel_scope = self.cancel_scope.child(
+            timeout=timeout if timeout is not None else self.app.subtask_timeout,
+            max_requests=max_requests if max_requests is not None else self.app.subtask_max_requests,
+        )
         kani_inst = ReDelKani(
             self.app.delegate_engine,
             app=self.app,
             parent=self,
             name=name,
             dispatch_creation=False,
+            cancel_scope=cancel_scope,
             system_prompt=self.app.delegate_system_prompt,
             **self.app.delegate_kani_kwargs,
         )
@@ -104,10 +138,33 @@ class ReDelKani(BaseKani):
         await asyncio.gather(*(t.setup() for t in tool_insts))
         self.app.on_kani_creation(kani_inst)
 
-    async def get_prompt(self) -> list[ChatMessage]:
+    async def get_prompt(self, include_functions=True, **kwargs) -> list[ChatMessage]:
         if self.system_prompt is not None:
-            self.always_included_messages[0] = ChatMessage.system(get_system_prompt(self))
-        return await super().get_prompt()
+            self.refresh_system_prompt()
+        if self.parent is not None and (limit := self.app.helper_history_token_limit) is not None:
+            await self.compact_history(limit)
+        return await super().get_prompt(include_functions=include_functions, **kwargs)
+
+    def refresh_system_prompt(self):
+        """Re-render the system prompt if the time it shows is out of date.
+
+        The system message is only replaced if its text changes, so the token count of the always included messages
+        stays cached between calls.
+        """
+        granularity = self.app.system_prompt_time_granularity
+        key = (granularity, system_prompt_time_key(granularity))
+        if key == self._system_prompt_key:
+            return
+        self._system_prompt_key = key
+        prompt = get_system_prompt(self, granularity)
+        if self.always_included_messages[0].text != prompt:
+            self.always_included_messages[0] = ChatMessage.system(prompt)
+
+    async def stop(self, reason: str = "cancelled"):
+        """Cancel this kani's scope and stop any helpers still working for it, releasing their resources."""
+        self.cancel_scope.cancel(reason)
+        if self.delegator:
+            await self.delegator.cancel_all(reason)
 
     async def cleanup(self):
         if self.delegator:
@@ -149,13 +206,42 @@ async def create_root_kani(
     app.on_kani_creation(kani_inst)
     return kani_inst
 
-def get_tool_functions(inst: ToolBase) -> dict[str, AIFunction]:
-    functions = {}
+# tool class -> AIFunctions wrapping the unbound methods of the class
+_class_function_cache: dict[type, list[AIFunction]] = {}
+
+
+def get_class_functions(inst: ToolBase) -> list[AIFunction]:
+    """Get the AIFunctions defined by the class of the given tool, introspecting the class only the first time.
+
+    The returned functions wrap the *unbound* methods (i.e. they take the tool instance as their first argument); use
+    :func:`get_tool_functions` to get functions bound to an instance.
+    """
+    cls = type(inst)
+    try:
+        return _class_function_cache[cls]
+    except KeyError:
+        pass
+    functions = []
+    seen = set()
     for name, member in inspect.getmembers(inst, predicate=inspect.ismethod):
         if not hasattr(member, "__ai_function__"):
             continue
-        f = AIFunction(member, **member.__ai_function__)
-        if f.name in functions:
+        # generate the JSON schema from the bound method so that it does not include `self`
+        schema = AIFunction(member, **member.__ai_function__).json_schema
+        f = AIFunction(member.__func__, **{**member.__ai_function__, "json_schema": schema})
+        if f.name in seen:
             raise ValueError(f"AIFunction {f.name!r} is already registered!")
+        seen.add(f.name)
+        functions.append(f)
+    _class_function_cache[cls] = functions
+    return functions
+
+
+def get_tool_functions(inst: ToolBase) -> dict[str, AIFunction]:
+    functions = {}
+    for template in get_class_functions(inst):
+        # a shallow copy shares the validator and JSON schema; only the instance it is called with differs
+        f = copy.copy(template)
+        f.inner = functools.partial(template.inner, inst)
         functions[f.name] = f
     return functions
@@ -0,0 +1,167 @@
+"""
+Rebuild a session's kani tree and chat histories from its event log, without making any LLM calls.
+
+The replay works on the raw event dicts from :func:`utils.read_events` and only validates them into Pydantic models
+(e.g. :class:`.KaniState`) on request, so scanning many archived sessions stays cheap.
+"""
+
+import concurrent.futures
+from collections import Counter
+from pathlib import Path
+from typing import Iterable
+
+from config import DEFAULT_LOG_DIR
+from state import KaniState, RunState
+from utils import read_events
+
+
+def find_event_log(log_dir: Path) -> Path | None:
+    """Get the path to the event log in a session's log directory (compact or JSONL), or None if there is none."""
+    log_dir = Path(log_dir)
+    for fp in (log_dir / "events.rlog", log_dir / "events.jsonl"):
+        if fp.exists():
+            return fp
+    return None
+
+
+class SessionReplay:
+    """
+    The state of a session, rebuilt by applying its events in order.
+
+    Each kani is stored as a dict with the same fields as :class:`.KaniState` (messages are left as dicts); use
+    :meth:`get_kani_state` to get a validated model.
+    """
+
+    def __init__(self, session_id: str = None):
+        self.session_id = session_id
+        self.title = None
+        self.kanis: dict[str, dict] = {}
+        """kani id -> the kani's state, as a dict of :class:`.KaniState` fields."""
+        self.root_id = None
+        self.delegations: list[dict] = []
+        """Every ``kani_delegated`` event, in order."""
+        self.prompt_tokens = Counter()
+        """kani id -> prompt tokens used."""
+        self.completion_tokens = Counter()
+        """kani id -> completion tokens used."""
+        self.event_count = Counter()
+        self.n_rounds = 0
+        self.last_timestamp = None
+
+    # ==== loading ====
+    @classmethod
+    def from_log(cls, fp: Path, until: float = None, max_events: int = None) -> "SessionReplay":
+        """
+        Replay the event log at the given path.
+
+        :param fp: A session's log directory, or the path to an event log in either format.
+        :param until: If given, replay the session as it was at this timestamp.
+        :param max_events: If given, stop after applying this many events.
+        """
+        fp = Path(fp)
+        if fp.is_dir() and fp.suffix != ".rlog":
+            log_dir, log_fp = fp, find_event_log(fp)
+        else:
+            log_dir, log_fp = fp.parent, fp
+        replay = cls(session_id=log_dir.name)
+        if log_fp is None:
+            return replay
+        for n, event in enumerate(read_events(log_fp, end=until)):
+            if max_events is not None and n >= max_events:
+                break
+            replay.apply(event)
+        return replay
+
+    def apply(self, event: dict):
+        """Apply a single event (as a dict) to the replayed state."""
+        event_type = event["type"]
+        self.event_count[event_type] += 1
+        self.last_timestamp = event["timestamp"]
+
+        if event_type == "kani_spawn":
+            # the spawn event can overwrite the previous state of a kani with the same ID
+            kani = {k: event[k] for k in KaniState.model_fields if k in event}
+            kani["chat_history"] = list(kani.get("chat_history", []))
+            kani["children"] = list(kani.get("children", []))
+            self.kanis[kani["id"]] = kani
+            if kani["parent"] is None:
+                self.root_id = kani["id"]
+            elif (parent := self.kanis.get(kani["parent"])) is not None and kani["id"] not in parent["children"]:
+                parent["children"].append(kani["id"])
+        elif event_type == "kani_message":
+            if (kani := self.kanis.get(event["id"])) is not None:
+                kani["chat_history"].append(event["msg"])
+        elif event_type == "kani_state_change":
+            if (kani := self.kanis.get(event["id"])) is not None:
+                kani["state"] = event["state"]
+        elif event_type == "kani_delegated":
+            self.delegations.append(event)
+        elif event_type == "tokens_used":
+            self.prompt_tokens[event["id"]] += event["prompt_tokens"]
+            self.completion_tokens[event["id"]] += event["completion_tokens"]
+        elif event_type == "session_meta_update":
+            self.title = event["title"]
+        elif event_type == "round_complete":
+            self.n_rounds += 1
+
+    # ==== queries ====
+    @property
+    def root(self) -> dict | None:
+        return self.kanis.get(self.root_id)
+
+    def get_kani_state(self, kani_id: str) -> KaniState:
+        """Get the validated state of the kani with the given ID."""
+        return KaniState.model_validate(self.kanis[kani_id])
+
+    def get_kani_states(self) -> list[KaniState]:
+        """Get the validated state of every kani, in spawn order."""
+        return [KaniState.model_validate(kani) for kani in self.kanis.values()]
+
+    def walk(self, kani_id: str = None) -> Iterable[dict]:
+        """Yield the kani in the subtree rooted at *kani_id* (default: the root) in depth-first order."""
+        stack = [kani_id or self.root_id]
+        while stack:
+            kani = self.kanis.get(stack.pop())
+            if kani is None:
+                continue
+            yield kani
+            stack.extend(reversed(kani["children"]))
+
+    @property
+    def max_depth(self) -> int:
+        return max((kani["depth"] for kani in self.kanis.values()), default=0)
+
+    def running_kanis(self) -> list[dict]:
+        """The kani that were running or waiting at the replayed point in time."""
+        active = (RunState.RUNNING.value, RunState.WAITING.value)
+        return [kani for kani in self.kanis.values() if kani["state"] in active]
+
+
+# ==== batch ====
+def iter_session_dirs(root: Path = DEFAULT_LOG_DIR) -> Iterable[Path]:
+    """Yield the log directory of each session saved under the given directory."""
+    for fp in sorted(Path(root).iterdir()):
+        if fp.is_dir() and find_event_log(fp) is not None:
+            yield fp
+
+
+def _replay_one(args) -> SessionReplay:
+    fp, until, max_events = args
+    return SessionReplay.from_log(fp, until=until, max_events=max_events)
+
+
+def replay_sessions(
+    log_dirs: Iterable[Path], until: float = None, max_events: int = None, max_workers: int = None
+) -> Iterable[tuple[Path, SessionReplay]]:
+    """
+    Replay many sessions, yielding (log dir, replay) pairs in the same order as *log_dirs*.
+
+    :param max_workers: The number of processes to replay sessions in. If 1, replays in the current process.
+    """
+    log_dirs = list(log_dirs)
+    args = [(fp, until, max_events) for fp in log_dirs]
+    if max_workers == 1:
+        yield from zip(log_dirs, map(_replay_one, args))
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as pool:
+        yield from zip(log_dirs, pool.map(_replay_one, args, chunksize=16))
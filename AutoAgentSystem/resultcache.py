@@ -0,0 +1,175 @@
+"""
+An opt-in cache of delegated subtask results, shared across the delegation tree and (on disk) across sessions.
+
+Results are keyed by the normalized instructions, the tools available to the helper, and the helper's engine, so the
+same lookup delegated from several branches or in consecutive sessions only runs once. The cache has two tiers: an
+in-memory LRU and a SQLite database (by default under ``config.REDEL_CACHE_DIR``). Both expire entries after a TTL.
+
+Lookups and stores on the disk tier are blocking, so callers on the event loop should run them in a worker thread.
+Eviction on disk is amortized: expired rows are swept at most once every ``EXPIRY_SWEEP_INTERVAL`` seconds (they are
+also dropped when looked up), and the least recently used rows are only evicted once the table is over its limit,
+down to ``EVICT_TO_FRACTION`` of it.
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable
+
+from config import REDEL_CACHE_DIR
+from dedup import normalize_instructions
+
+DEFAULT_RESULT_CACHE_PATH = REDEL_CACHE_DIR / "subtask_results.sqlite3"
+EXPIRY_SWEEP_INTERVAL = 60 * 60
+EVICT_TO_FRACTION = 0.9
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    result TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+CREATE INDEX IF NOT EXISTS results_created ON results (created);
+"""
+
+
+@dataclass
+class ResultCacheStats:
+    memory_hits: int = 0
+    disk_hits: int = 0
+    misses: int = 0
+    n_stored: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+
+class SubtaskResultCache:
+    """A two-tier (memory + SQLite) TTL/LRU cache of delegated subtask results. Safe to share between sessions."""
+
+    def __init__(
+        self,
+        path: Path | None = DEFAULT_RESULT_CACHE_PATH,
+        *,
+        ttl: float | None = 7 * 24 * 60 * 60,
+        max_memory_entries: int = 1024,
+        max_disk_entries: int = 100_000,
+    ):
+        """
+        :param path: The path to the SQLite database of the disk tier, or None to only cache in memory.
+        :param ttl: How long (in seconds) a result stays valid after it is stored, or None to never expire results
+            (default 1 week).
+        :param max_memory_entries: The number of results to keep in memory; the least recently used are evicted first.
+        :param max_disk_entries: The number of results to keep on disk; the least recently used are evicted first.
+        """
+        self.path = Path(path) if path is not None else None
+        self.ttl = ttl
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_entries = max_disk_entries
+        self.stats = ResultCacheStats()
+        self._memory: OrderedDict[str, tuple[str, float]] = OrderedDict()  # key -> (result, created)
+        self._lock = threading.Lock()
+        self._conn = None
+        # an upper bound on the number of rows on disk (replaced rows are counted as new until the next eviction)
+        self._n_disk_entries = 0
+        self._last_expiry_sweep = 0.0
+        if self.path is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            # the cache can lose its latest writes on power loss, so don't fsync every commit
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._n_disk_entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    @staticmethod
+    def make_key(instructions: str, tools: Iterable[str], engine: str) -> str:
+        """The cache key of a subtask given to a helper with the given tools (names) and engine (model)."""
+        data = json.dumps([normalize_instructions(instructions), sorted(tools), engine])
+        return hashlib.blake2b(data.encode(), digest_size=20).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        """Get the cached result for the given key, or None if there is no valid result. Blocking."""
+        now = time.time()
+        with self._lock:
+            if (entry := self._memory.get(key)) is not None:
+                result, created = entry
+                if not self._expired(created, now):
+                    self._memory.move_to_end(key)
+                    self.stats.memory_hits += 1
+                    return result
+                del self._memory[key]
+            if self._conn is not None:
+                row = self._conn.execute("SELECT result, created FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    result, created = row
+                    if not self._expired(created, now):
+                        with self._conn:
+                            self._conn.execute("UPDATE results SET last_access = ? WHERE key = ?", (now, key))
+                        self._remember(key, result, created)
+                        self.stats.disk_hits += 1
+                        return result
+                    with self._conn:
+                        self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            self.stats.misses += 1
+            return None
+
+    def put(self, key: str, result: str):
+        """Store the result of a subtask. Blocking."""
+        now = time.time()
+        with self._lock:
+            self._remember(key, result, now)
+            self.stats.n_stored += 1
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, result, now, now))
+                    self._n_disk_entries += 1
+                    self._evict_disk(now)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn is not None:
+                with self._conn:
+                    self._conn.execute("DELETE FROM results")
+                self._n_disk_entries = 0
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    # ==== internals ====
+    def _expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key: str, result: str, created: float):
+        self._memory[key] = (result, created)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, now: float):
+        """Sweep expired rows if it is time to, and evict the least recently used rows if there are too many."""
+        if self.ttl is not None and now - self._last_expiry_sweep >= EXPIRY_SWEEP_INTERVAL:
+            self._last_expiry_sweep = now
+            self._n_disk_entries -= self._conn.execute(
+                "DELETE FROM results WHERE created < ?", (now - self.ttl,)
+            ).rowcount
+        if self._n_disk_entries <= self.max_disk_entries:
+            return
+        self._conn.execute(
+            "DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY last_access DESC LIMIT -1 OFFSET ?)",
+            (int(self.max_disk_entries * EVICT_TO_FRACTION),),
+        )
+        self._n_disk_entries = self._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
@@ -0,0 +1,280 @@
+"""
+An app-wide, engine-aware concurrency controller for model requests.
+
+Every model request made by a kani in the session goes through :meth:`ConcurrencyScheduler.slot`, which admits it
+once its engine's :class:`EngineLimiter` has a free slot and tokens left in its bucket. Each limiter adjusts its
+concurrency with AIMD (additive increase on success, multiplicative decrease on a rate limit error) and refills its
+token bucket continuously; the app feeds the tokens each request actually used back to it from
+:class:`.events.TokensUsed`.
+
+When requests are queued, the next one admitted is chosen by :func:`request_priority`: requests from kani whose parent
+is blocked waiting on them go first, then requests from shallower kani, then older requests. Priorities are evaluated
+when a slot frees up rather than when a request is queued, so a kani whose parent starts waiting moves ahead.
+"""
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING
+
+from kani.engines import BaseEngine
+
+import events
+from state import RunState
+
+try:
+    import openai
+
+    RATE_LIMIT_ERRORS = (openai.RateLimitError,)
+except ImportError:
+    RATE_LIMIT_ERRORS = ()
+
+if TYPE_CHECKING:
+    from app import AutoAgentSystem
+    from base_kani import BaseKani
+
+log = logging.getLogger(__name__)
+
+
+@dataclass
+class EngineLimits:
+    """The concurrency and rate limits of a single engine/model."""
+
+    initial_concurrency: int = 3
+    """The number of concurrent requests allowed before any feedback has been received."""
+    min_concurrency: int = 1
+    max_concurrency: int = 16
+    tokens_per_minute: int | None = None
+    """The token budget per minute (prompt + completion), or None for no token limit. Up to one minute's worth of
+    tokens can be used in a burst."""
+    increase: float = 1.0
+    """How much the concurrency limit grows after each full window of successful requests."""
+    decrease: float = 0.5
+    """The factor the concurrency limit is multiplied by after a rate limit error."""
+    decrease_cooldown: float = 1.0
+    """After decreasing, further rate limit errors in this many seconds do not decrease the limit again (they are
+    usually from requests that were already in flight)."""
+
+
+def request_priority(kani: "BaseKani | None", seq: int) -> tuple:
+    """The priority of a queued request (lower goes first).
+
+    :param kani: The kani making the request, if known.
+    :param seq: The order the request was queued in.
+    """
+    if kani is None:
+        return 1, 0, seq
+    # the root's requests are always on the critical path, since the user is waiting on it
+    blocking = kani.parent is None or kani.parent.state == RunState.WAITING
+    return 0 if blocking else 1, kani.depth, seq
+
+
+class _Waiter:
+    __slots__ = ("fut", "kani", "seq")
+
+    def __init__(self, fut: asyncio.Future, kani: "BaseKani | None", seq: int):
+        self.fut = fut
+        self.kani = kani
+        self.seq = seq
+
+
+@dataclass
+class LimiterStats:
+    key: str
+    """The engine/model this limiter is for."""
+    concurrency: int
+    """The current concurrency limit."""
+    in_flight: int
+    """The number of requests currently running."""
+    queued: int
+    """The number of requests waiting to be admitted."""
+    throttled: int
+    """The number of queued requests that are waiting for the token bucket to refill."""
+    tokens_available: float | None
+    """The number of tokens currently in the bucket, or None if there is no token limit."""
+    n_admitted: int
+    """The total number of requests admitted so far."""
+    n_throttled: int
+    """The total number of times admission was delayed by the token bucket."""
+    n_rate_limited: int
+    """The total number of requests that failed with a rate limit error."""
+
+
+class EngineLimiter:
+    """Admission control for the requests to a single engine/model."""
+
+    def __init__(self, key: str, limits: EngineLimits, prioritize: bool = True):
+        """
+        :param prioritize: Whether to admit queued requests by :func:`request_priority` (default) or in FIFO order.
+        """
+        self.key = key
+        self.limits = limits
+        self.prioritize = prioritize
+        self.limit = float(limits.initial_concurrency)
+        self.in_flight = 0
+        self.n_admitted = 0
+        self.n_throttled = 0
+        self.n_rate_limited = 0
+        self._waiters: list[_Waiter] = []
+        self._seq = itertools.count()
+        self._tokens = float(limits.tokens_per_minute or 0)
+        self._last_refill = time.monotonic()
+        self._last_decrease = float("-inf")
+        self._refill_timer: asyncio.TimerHandle | None = None
+
+    @property
+    def concurrency(self) -> int:
+        return max(self.limits.min_concurrency, int(self.limit))
+
+    # ==== admission ====
+    async def acquire(self, kani: "BaseKani" = None):
+        """Wait until a request to this engine (by the given kani, if any) may start."""
+        if not self._waiters and self._can_admit():
+            self._admit()
+            return
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), kani, next(self._seq))
+        self._waiters.append(waiter)
+        if self._refill_timer is None:
+            # if only the token bucket is holding us back, no release will wake us, so schedule the refill now
+            self._wake()
+        try:
+            await waiter.fut
+        except asyncio.CancelledError:
+            if waiter.fut.done() and not waiter.fut.cancelled():
+                # we were admitted just as we were cancelled; give the slot to someone else
+                self.in_flight -= 1
+                self._wake()
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+            raise
+
+    def release(self, rate_limited: bool = False):
+        """Mark a request as finished and adjust the concurrency limit based on its outcome."""
+        self.in_flight -= 1
+        if rate_limited:
+            self.n_rate_limited += 1
+            now = time.monotonic()
+            if now - self._last_decrease >= self.limits.decrease_cooldown:
+                self._last_decrease = now
+                self.limit = max(self.limits.min_concurrency, self.limit * self.limits.decrease)
+                log.info(f"[{self.key}] Rate limited, decreasing concurrency to {self.concurrency}")
+        else:
+            self.limit = min(self.limits.max_concurrency, self.limit + self.limits.increase / max(self.limit, 1))
+        self._wake()
+
+    def consume(self, n_tokens: int):
+        """Record that a request to this engine used *n_tokens* tokens."""
+        if self.limits.tokens_per_minute is None:
+            return
+        self._refill()
+        self._tokens -= n_tokens
+
+    def stats(self) -> LimiterStats:
+        self._refill()
+        return LimiterStats(
+            key=self.key,
+            concurrency=self.concurrency,
+            in_flight=self.in_flight,
+            queued=len(self._waiters),
+            throttled=len(self._waiters) if self._refill_timer is not None else 0,
+            tokens_available=self._tokens if self.limits.tokens_per_minute is not None else None,
+            n_admitted=self.n_admitted,
+            n_throttled=self.n_throttled,
+            n_rate_limited=self.n_rate_limited,
+        )
+
+    # ==== internals ====
+    def _refill(self):
+        now = time.monotonic()
+        if (tpm := self.limits.tokens_per_minute) is not None:
+            self._tokens = min(tpm, self._tokens + (now - self._last_refill) * tpm / 60)
+        self._last_refill = now
+
+    def _refill_wait(self) -> float:
+        """The number of seconds until the token bucket is no longer empty."""
+        if self.limits.tokens_per_minute is None:
+            return 0
+        self._refill()
+        if self._tokens > 0:
+            return 0
+        return -self._tokens * 60 / self.limits.tokens_per_minute + 1e-3
+
+    def _can_admit(self) -> bool:
+        return self.in_flight < self.concurrency and self._refill_wait() <= 0
+
+    def _admit(self):
+        self.in_flight += 1
+        self.n_admitted += 1
+
+    def _wake(self):
+        if self._refill_timer is not None:
+            self._refill_timer.cancel()
+            self._refill_timer = None
+        while self._waiters and self.in_flight < self.concurrency:
+            if (wait := self._refill_wait()) > 0:
+                self.n_throttled += 1
+                self._refill_timer = asyncio.get_running_loop().call_later(wait, self._wake)
+                return
+            if self.prioritize:
+                waiter = min(self._waiters, key=lambda w: request_priority(w.kani, w.seq))
+            else:
+                waiter = self._waiters[0]
+            self._waiters.remove(waiter)
+            if waiter.fut.done():
+                continue
+            self._admit()
+            waiter.fut.set_result(None)
+
+
+class ConcurrencyScheduler:
+    """Keeps one :class:`EngineLimiter` per engine/model, shared by every kani in the app."""
+
+    def __init__(self, app: "AutoAgentSystem", limits: dict[str, EngineLimits] = None, prioritize: bool = True):
+        """
+        :param limits: A mapping of model names (or engine class names, for engines without a model) to the limits to
+            use for them. Engines not in the mapping use the default :class:`EngineLimits`.
+        :param prioritize: Whether to admit queued requests by :func:`request_priority` (default) or in FIFO order.
+        """
+        self.app = app
+        self.limits = limits or {}
+        self.prioritize = prioritize
+        self.limiters: dict[str, EngineLimiter] = {}
+
+    @staticmethod
+    def engine_key(engine: BaseEngine) -> str:
+        return getattr(engine, "model", None) or type(engine).__name__
+
+    def get_limiter(self, engine: BaseEngine) -> EngineLimiter:
+        key = self.engine_key(engine)
+        if (limiter := self.limiters.get(key)) is None:
+            limiter = self.limiters[key] = EngineLimiter(key, self.limits.get(key) or EngineLimits(), self.prioritize)
+        return limiter
+
+    @contextlib.asynccontextmanager
+    async def slot(self, engine: BaseEngine, kani: "BaseKani" = None):
+        """Run the body of this statement as a request to the given engine (by the given kani, if any), once it is
+        admitted."""
+        limiter = self.get_limiter(engine)
+        await limiter.acquire(kani)
+        try:
+            yield
+        except RATE_LIMIT_ERRORS:
+            limiter.release(rate_limited=True)
+            raise
+        except BaseException:
+            limiter.release()
+            raise
+        else:
+            limiter.release()
+
+    async def on_tokens_used(self, event: events.TokensUsed):
+        """Listener that charges the tokens used by each request to its engine's token bucket."""
+        if (kani := self.app.kanis.get(event.id)) is None:
+            return
+        self.get_limiter(kani.engine).consume(event.prompt_tokens + event.completion_tokens)
+
+    def stats(self) -> list[LimiterStats]:
+        return [limiter.stats() for limiter in self.limiters.values()]
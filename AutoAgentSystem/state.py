@@ -1,4 +1,5 @@
 import enum
+import time
 from typing import TYPE_CHECKING
 
 from kani import AIFunction, ChatMessage, ChatRole
@@ -22,6 +23,66 @@ class RunState(enum.Enum):
     ERRORED = "errored"  # panic
 
 
+class TaskStatus(enum.Enum):
+    """
+    * ``TaskStatus.ASSIGNED``: The task was given to a helper, which has not started on it yet.
+    * ``TaskStatus.RUNNING``: The helper is working on the task (including any retries).
+    * ``TaskStatus.COMPLETED``: The helper finished the task.
+    * ``TaskStatus.FAILED``: The task failed after all retries and reassignments.
+    * ``TaskStatus.REASSIGNED``: The helper failed and the task was handed to a new helper (see ``reassigned_to``).
+    * ``TaskStatus.CANCELLED``: The task was cancelled before it finished.
+    """
+
+    ASSIGNED = "assigned"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+    REASSIGNED = "reassigned"
+    CANCELLED = "cancelled"
+
+    @property
+    def is_finished(self) -> bool:
+        return self in (TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.REASSIGNED, TaskStatus.CANCELLED)
+
+
+class TaskRecord(BaseModel):
+    """A task delegated to a helper kani. See :class:`.TaskRegistry`."""
+
+    id: str
+    agent: str
+    """The name of the helper the task was given to."""
+    kani_id: str
+    """The ID of the helper the task was given to."""
+    parent_id: str | None
+    """The ID of the kani that delegated the task."""
+    parent_task_id: str | None = None
+    """The ID of the task the delegating kani was working on, if it is a helper itself."""
+    instructions: str
+    status: TaskStatus = TaskStatus.ASSIGNED
+    error: str | None = None
+    reassigned_from: str | None = None
+    """The ID of the task this one took over from, if it was reassigned."""
+    reassigned_to: str | None = None
+    """The ID of the task that took over from this one, if it was reassigned."""
+    created_at: float
+    started_at: float | None = None
+    finished_at: float | None = None
+
+    @property
+    def queue_time(self) -> float | None:
+        """How long (in seconds) the task waited between being assigned and being started."""
+        if self.started_at is None:
+            return None
+        return self.started_at - self.created_at
+
+    @property
+    def duration(self) -> float | None:
+        """How long (in seconds) the task has run, or ran for if it is finished."""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+
 class AIFunctionState(BaseModel):
     name: str
     desc: str
@@ -56,14 +117,14 @@ class KaniState(BaseModel):
     functions: list[AIFunctionState]
 
     @classmethod
-    def from_kani(cls, ai: "BaseKani", **kwargs):
+    def from_kani(cls, ai: "BaseKani", chat_history: list[ChatMessage] = None, **kwargs):
         return cls(
             id=ai.id,
             depth=ai.depth,
             parent=ai.parent.id if ai.parent else None,
             children=list(ai.children),
             always_included_messages=ai.always_included_messages,
-            chat_history=ai.chat_history,
+            chat_history=ai.chat_history if chat_history is None else chat_history,
             state=ai.state,
             name=ai.name,
             engine_type=type(ai.engine).__name__,
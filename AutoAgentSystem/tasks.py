@@ -0,0 +1,185 @@
+"""
+A registry of every task delegated in the session.
+
+Tasks are indexed by ID and by the agent (helper name) they were given to, so status updates and lookups are O(1)
+however many tasks the session has run. Each task records its status transitions with timestamps and links to the
+task of the kani that delegated it, so the registry can be walked as a tree. Every change is dispatched as a
+:class:`.events.TaskStateChange`.
+
+Finished tasks can be compacted out of the registry (e.g. after each round in long batch runs), optionally archiving
+them to a JSONL file first; running tasks are always kept.
+"""
+
+import asyncio
+import logging
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator
+
+import events
+from state import TaskRecord, TaskStatus
+
+if TYPE_CHECKING:
+    from app import AutoAgentSystem
+    from base_kani import BaseKani
+
+log = logging.getLogger(__name__)
+
+# status -> the statuses it may change to
+TASK_TRANSITIONS: dict[TaskStatus, set[TaskStatus]] = {
+    TaskStatus.ASSIGNED: {TaskStatus.RUNNING, TaskStatus.FAILED, TaskStatus.REASSIGNED, TaskStatus.CANCELLED},
+    TaskStatus.RUNNING: {TaskStatus.COMPLETED, TaskStatus.FAILED, TaskStatus.REASSIGNED, TaskStatus.CANCELLED},
+    TaskStatus.COMPLETED: set(),
+    TaskStatus.FAILED: set(),
+    TaskStatus.REASSIGNED: set(),
+    TaskStatus.CANCELLED: set(),
+}
+
+
+class TaskRegistry:
+    """The tasks delegated in an app, indexed by task ID and by (agent, task ID)."""
+
+    def __init__(self, app: "AutoAgentSystem" = None, archive_path: Path | None = None):
+        """
+        :param app: The app to dispatch task events to, if any.
+        :param archive_path: A JSONL file that compacted tasks are appended to, or None to discard compacted tasks.
+        """
+        self.app = app
+        self.archive_path = archive_path
+        self.n_compacted = 0
+        self._tasks: dict[str, TaskRecord] = {}
+        self._by_agent: dict[str, dict[str, TaskRecord]] = {}
+        self._current_task: dict[str, str] = {}  # kani id -> id of the last task given to that kani
+        self._status_counts: Counter[TaskStatus] = Counter()  # includes compacted tasks
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def __iter__(self) -> Iterator[TaskRecord]:
+        return iter(list(self._tasks.values()))
+
+    def __contains__(self, task_id: str):
+        return task_id in self._tasks
+
+    # ==== lookups ====
+    def get(self, task_id: str) -> TaskRecord | None:
+        return self._tasks.get(task_id)
+
+    def get_agent_task(self, agent: str, task_id: str) -> TaskRecord | None:
+        return self._by_agent.get(agent, {}).get(task_id)
+
+    def get_agent_tasks(self, agent: str) -> list[TaskRecord]:
+        """All the (uncompacted) tasks given to the given agent, oldest first."""
+        return list(self._by_agent.get(agent, {}).values())
+
+    def current_task(self, kani_id: str) -> TaskRecord | None:
+        """The last task given to the kani with the given ID, if it is still in the registry."""
+        task_id = self._current_task.get(kani_id)
+        return self._tasks.get(task_id) if task_id is not None else None
+
+    def children(self, task_id: str) -> list[TaskRecord]:
+        """The (uncompacted) tasks delegated by the helper working on the given task."""
+        return [t for t in self._tasks.values() if t.parent_task_id == task_id]
+
+    def with_status(self, *statuses: TaskStatus) -> list[TaskRecord]:
+        return [t for t in self._tasks.values() if t.status in statuses]
+
+    def status_counts(self) -> dict[TaskStatus, int]:
+        """The number of tasks in each status, including compacted tasks."""
+        return {status: n for status, n in self._status_counts.items() if n}
+
+    # ==== transitions ====
+    def create(
+        self, helper: "BaseKani", instructions: str, parent: "BaseKani" = None, reassigned_from: str = None
+    ) -> TaskRecord:
+        """Record that the given task was assigned to *helper* by *parent*."""
+        parent_task = self.current_task(parent.id) if parent is not None else None
+        task = TaskRecord(
+            id=uuid.uuid4().hex[:12],
+            agent=helper.name,
+            kani_id=helper.id,
+            parent_id=parent.id if parent is not None else None,
+            parent_task_id=parent_task.id if parent_task is not None else None,
+            instructions=instructions,
+            reassigned_from=reassigned_from,
+            created_at=time.time(),
+        )
+        self._tasks[task.id] = task
+        self._by_agent.setdefault(task.agent, {})[task.id] = task
+        self._current_task[task.kani_id] = task.id
+        self._status_counts[task.status] += 1
+        self._dispatch(task, None)
+        return task
+
+    def transition(self, task_id: str, status: TaskStatus, *, error: str = None, reassigned_to: str = None):
+        """Move a task to a new status. Raises ValueError if the task can't move from its current status to it."""
+        task = self._tasks[task_id]
+        previous = task.status
+        if status not in TASK_TRANSITIONS[previous]:
+            raise ValueError(f"Task {task_id} cannot go from {previous.value!r} to {status.value!r}")
+        now = time.time()
+        if task.started_at is None and status != TaskStatus.ASSIGNED:
+            task.started_at = now
+        if status.is_finished:
+            task.finished_at = now
+        task.status = status
+        if error is not None:
+            task.error = error
+        if reassigned_to is not None:
+            task.reassigned_to = reassigned_to
+        self._status_counts[previous] -= 1
+        self._status_counts[status] += 1
+        self._dispatch(task, previous)
+        return task
+
+    # ==== compaction ====
+    async def compact(self, older_than: float = None) -> list[TaskRecord]:
+        """Remove finished tasks from the registry, appending them to the archive file if one is set. Status counts
+        still include compacted tasks.
+
+        :param older_than: If set, only remove tasks that finished more than this many seconds ago.
+        :returns: The removed tasks.
+        """
+        cutoff = time.time() - older_than if older_than is not None else None
+        removed = [
+            t for t in self._tasks.values() if t.status.is_finished and (cutoff is None or t.finished_at <= cutoff)
+        ]
+        if not removed:
+            return removed
+        for task in removed:
+            del self._tasks[task.id]
+            agent_tasks = self._by_agent[task.agent]
+            del agent_tasks[task.id]
+            if not agent_tasks:
+                del self._by_agent[task.agent]
+            if self._current_task.get(task.kani_id) == task.id:
+                del self._current_task[task.kani_id]
+        self.n_compacted += len(removed)
+        if self.archive_path is not None:
+            data = "".join(t.model_dump_json() + "\n" for t in removed)
+            await asyncio.to_thread(self._append_archive, data)
+        if self.app is not None:
+            self.app.dispatch(
+                events.TasksCompacted(
+                    task_ids=[t.id for t in removed],
+                    archive_path=str(self.archive_path) if self.archive_path is not None else None,
+                )
+            )
+        log.debug(f"Compacted {len(removed)} finished tasks")
+        return removed
+
+    async def on_round_complete(self, _: events.RoundComplete):
+        """Listener that compacts finished tasks at the end of each round."""
+        await self.compact()
+
+    # ==== internals ====
+    def _dispatch(self, task: TaskRecord, previous: TaskStatus | None):
+        if self.app is not None:
+            self.app.dispatch(events.TaskStateChange(id=task.kani_id, task=task.model_copy(), previous_status=previous))
+
+    def _append_archive(self, data: str):
+        self.archive_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.archive_path, "a", encoding="utf-8") as f:
+            f.write(data)
@@ -20,7 +20,7 @@ class ToolConfig(TypedDict, total=False):
     """Keyword arguments to pass to the constructor of this class. Defaults to ``{}``.
     
     The tool class' constructor will be called each time a new instance is bound to a new kani. Each kani will have
-    its own instance of the tool.
+    its own instance of the tool, so expensive resources should be shared through :meth:`.ToolBase.get_shared`.
     """
 
 
@@ -1,4 +1,4 @@
-from ._base import ToolBase
+from ._base import SharedResources, ToolBase
 from .pubmed import PubMedSearch
 from .semantic import SemanticScholarSearch
 from .wikipedia import WikipediaSearch
\ No newline at end of file
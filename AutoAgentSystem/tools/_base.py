@@ -1,15 +1,99 @@
-from typing import TYPE_CHECKING
+import asyncio
+import inspect
+import logging
+from typing import Any, Awaitable, Callable, Hashable, TYPE_CHECKING, TypeVar
 
 if TYPE_CHECKING:
+    import httpx
+
     from .app import AutoAgentSystem
     from .kanis import ReDelKani
 
+log = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# the key of the app's shared HTTP client in its SharedResources
+SHARED_HTTP_CLIENT_KEY = "httpx"
+
+
+class SharedResources:
+    """A registry of app-scoped resources (HTTP clients, database connections, indexes, etc.) shared by every tool
+    instance in a session.
+
+    Resources are created the first time they are requested and closed once, when the app closes, so binding a tool to
+    a new kani only costs a dictionary lookup.
+    """
+
+    def __init__(self):
+        self._resources: dict[Hashable, Any] = {}
+        self._closers: dict[Hashable, Callable[[Any], Any]] = {}
+        self._locks: dict[Hashable, asyncio.Lock] = {}
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._resources
+
+    def __len__(self) -> int:
+        return len(self._resources)
+
+    def get(self, key: Hashable, factory: Callable[[], T], close: Callable[[T], Any] = None) -> T:
+        """Get the resource with the given key, creating it with *factory* if it does not exist yet.
+
+        :param key: A hashable key identifying the resource. Tools that want a private resource should include their
+            class in the key (e.g. ``(type(self), "index")``); tools that use the same key share the same resource.
+        :param factory: Called with no arguments to create the resource.
+        :param close: Called with the resource when the app closes. May return an awaitable.
+        """
+        try:
+            return self._resources[key]
+        except KeyError:
+            pass
+        resource = self._resources[key] = factory()
+        if close is not None:
+            self._closers[key] = close
+        return resource
+
+    async def aget(self, key: Hashable, factory: Callable[[], Awaitable[T]], close: Callable[[T], Any] = None) -> T:
+        """Like :meth:`get`, but *factory* is a coroutine function. Concurrent callers wait for the same resource to
+        be created instead of creating it more than once."""
+        try:
+            return self._resources[key]
+        except KeyError:
+            pass
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key not in self._resources:
+                resource = await factory()
+                self._resources[key] = resource
+                if close is not None:
+                    self._closers[key] = close
+        return self._resources[key]
+
+    async def close(self):
+        """Close all resources, in the reverse order of their creation."""
+        for key in reversed(list(self._resources)):
+            resource = self._resources.pop(key)
+            closer = self._closers.pop(key, None)
+            if closer is None:
+                continue
+            try:
+                result = closer(resource)
+                if inspect.isawaitable(result):
+                    await result
+            except Exception:
+                log.exception(f"Could not close shared resource {key!r}:")
+        self._locks.clear()
+
 
 class ToolBase:
     """This class is a base that all tool implementations should inherit from.
 
     It provides an interface to the tools in the group to access the application it's running in (for emitting events)
     and the kani it's bound to (for access to the chat state), as well as common setup/teardown hooks.
+
+    A new instance is bound to each kani, so instances should stay lightweight: anything that is expensive to create
+    and safe to share between kani (clients, connections, indexes) should be requested through :meth:`get_shared` or
+    :meth:`get_shared_async` instead of being created in the constructor.
     """
 
     def __init__(self, app: "AutoAgentSystem", kani: "ReDelKani"):
@@ -18,6 +102,21 @@ class ToolBase:
         self.kani: "ReDelKani" = kani
         """The kani this tool is bound to."""
 
+    def get_shared(self, key: Hashable, factory: Callable[[], T], close: Callable[[T], Any] = None) -> T:
+        """Get an app-scoped resource shared by all tool instances. See :meth:`SharedResources.get`."""
+        return self.app.tool_resources.get(key, factory, close)
+
+    async def get_shared_async(
+        self, key: Hashable, factory: Callable[[], Awaitable[T]], close: Callable[[T], Any] = None
+    ) -> T:
+        """Get an app-scoped resource shared by all tool instances. See :meth:`SharedResources.aget`."""
+        return await self.app.tool_resources.aget(key, factory, close)
+
+    def shared_http_client(self) -> "httpx.AsyncClient":
+        """Get the HTTP client (following redirects) shared by all tools in the app, creating it on first use.
+        Requires ``httpx``."""
+        return self.get_shared(SHARED_HTTP_CLIENT_KEY, _create_http_client, close=lambda client: client.aclose())
+
     async def setup(self):
         """Called once per bound instance in an async context for each time this tool is bound to a new kani.
 
@@ -36,6 +135,13 @@ class ToolBase:
     async def close(self):
         """Called once per bound instance when the app closes the session.
 
-        Override this method to gracefully clean up all resources attached to this tool.
+        Override this method to gracefully clean up all resources attached to this tool. Shared resources are closed by
+        the app and should not be closed here.
         """
         pass
+
+
+def _create_http_client() -> "httpx.AsyncClient":
+    import httpx
+
+    return httpx.AsyncClient(follow_redirects=True)
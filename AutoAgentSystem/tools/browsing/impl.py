@@ -70,7 +70,7 @@ class Browsing(ToolBase):
         :param page_concurrency_sem: A semaphore that this tool will acquire when opening a browser page.
         """
         super().__init__(*args, **kwargs)
-        self.http = httpx.AsyncClient(follow_redirects=True)
+        self.http = self.shared_http_client()
         self.page: Optional["Page"] = None
         self.long_engine = long_engine
         self.page_concurrency_sem = page_concurrency_sem
@@ -12,11 +12,12 @@ class SQLiteSearch(ToolBase):
         self.conn = None
 
     async def setup(self):
-        self.conn = sqlite3.connect(self.db_path)
-
-    async def cleanup(self):
-        if self.conn:
-            self.conn.close()
+        # one connection per database for the whole app, closed when the app closes
+        self.conn = self.get_shared(
+            (SQLiteSearch, self.db_path),
+            lambda: sqlite3.connect(self.db_path, check_same_thread=False),
+            close=lambda conn: conn.close(),
+        )
 
     @ai_function(desc="Search Feverous Wiki database by page_id and element_id and return the text content.")
     async def search_feverous(self, page_id: str, element_id: str) -> str:
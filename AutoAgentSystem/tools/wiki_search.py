@@ -1,3 +1,4 @@
+import asyncio
 import json
 from pathlib import Path
 from kani import ai_function
@@ -5,26 +6,30 @@ from tools import ToolBase
 
 class WikipediaSearch(ToolBase):
     def __init__(self, app, kani, wiki_dir, prebuilt_index=None):
-        self.app = app
-        self.kani = kani
+        super().__init__(app, kani)
         self.wiki_dir = wiki_dir
         self.page_index = prebuilt_index or {}
         self.index_built = bool(prebuilt_index)
 
     async def setup(self):
         if not self.index_built:
-            print("🚀 [WikipediaSearch] Building Index...")
-            await self.build_index()
+            # the index is built once per app and shared by every kani
+            self.page_index = await self.get_shared_async(
+                (WikipediaSearch, str(Path(self.wiki_dir).resolve())), lambda: asyncio.to_thread(self.build_index)
+            )
             self.index_built = True
 
-    async def build_index(self):
+    def build_index(self) -> dict[str, str]:
+        print("🚀 [WikipediaSearch] Building Index...")
+        page_index = {}
         for filename in Path(self.wiki_dir).glob("*.jsonl"):
             with open(filename, 'r', encoding='utf-8') as f:
                 for line in f:
                     data = json.loads(line)
                     page_id = data['id']
-                    self.page_index[page_id] = str(filename)
-        print(f"✅ [WikipediaSearch] Index built: {len(self.page_index)} pages.")
+                    page_index[page_id] = str(filename)
+        print(f"✅ [WikipediaSearch] Index built: {len(page_index)} pages.")
+        return page_index
 
     @ai_function(desc="Search and return a specific sentence from a given Wikipedia page.")
     async def search_sentence(self, page_id: str, sentence_id: int) -> str:
@@ -6,7 +6,9 @@ from tools import ToolBase
 class WikipediaSearch(ToolBase):
     def __init__(self, app, kani):
         super().__init__(app, kani)
-        self.wrapper = WikipediaAPIWrapper(top_k_results=3, doc_content_chars_max=1000)
+        self.wrapper = self.get_shared(
+            WikipediaAPIWrapper, lambda: WikipediaAPIWrapper(top_k_results=3, doc_content_chars_max=1000)
+        )
 
     @ai_function()
     async def search_wikipedia(self, query: str) -> str:
@@ -1,9 +1,11 @@
 import itertools
 import json
 import uuid
+from pathlib import Path
 from typing import Iterable, TYPE_CHECKING, TypeVar
 
 from kani import Kani
+from kani.engines.base import BaseCompletion
 
 if TYPE_CHECKING:
     from .base_kani import BaseKani
@@ -45,6 +47,26 @@ async def generate_conversation_title(ai: "BaseKani"):
     return title.strip(' "')
 
 
+# ===== prompt caching =====
+def get_prompt_cache_usage(completion: BaseCompletion) -> tuple[int, int] | None:
+    """Get (cached, uncached) prompt tokens of a completion from the provider's usage report, or None if the provider
+    doesn't report prompt caching."""
+    extra = completion.message.extra
+    if (usage := extra.get("openai_usage")) is not None:
+        # chat completions report prompt_tokens_details, the responses API input_tokens_details
+        details = usage.get("prompt_tokens_details") or usage.get("input_tokens_details")
+        if not details or details.get("cached_tokens") is None or completion.prompt_tokens is None:
+            return None
+        return details["cached_tokens"], completion.prompt_tokens - details["cached_tokens"]
+    if (message := extra.get("anthropic_message")) is not None:
+        # anthropic's input_tokens does not include cache reads or writes
+        usage = message.usage
+        if getattr(usage, "cache_read_input_tokens", None) is None:
+            return None
+        return usage.cache_read_input_tokens, usage.input_tokens + (usage.cache_creation_input_tokens or 0)
+    return None
+
+
 def batched(iterable: Iterable[T], n: int) -> Iterable[tuple[T, ...]]:
     # batched('ABCDEFG', 3) --> ABC DEF G
     if n < 1:
@@ -65,3 +87,29 @@ def read_jsonl(fp) -> Iterable[dict]:
     with open(fp, encoding="utf-8") as f:
         for line in f:
             yield json.loads(line)
+
+
+def read_events(fp, types: Iterable[str] = None, start: float = None, end: float = None) -> Iterable[dict]:
+    """
+    Lazily yield logged events (as dicts) from an event log, optionally filtered by type and time range.
+
+    Accepts either a JSONL log (``events.jsonl``) or a compact log directory (see ``compactlog``). Compact logs can skip
+    whole segments and avoid decoding events that are filtered out.
+
+    :param types: If given, only yield events of these types.
+    :param start: If given, only yield events with a timestamp at or after this time.
+    :param end: If given, only yield events with a timestamp at or before this time.
+    """
+    if Path(fp).is_dir():
+        from compactlog import read_compact_log
+
+        yield from read_compact_log(fp, types=types, start=start, end=end)
+        return
+
+    types = set(types) if types is not None else None
+    for data in read_jsonl(fp):
+        if types is not None and data["type"] not in types:
+            continue
+        if (start is not None and data["timestamp"] < start) or (end is not None and data["timestamp"] > end):
+            continue
+        yield data
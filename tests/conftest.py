@@ -0,0 +1,65 @@
+import asyncio
+import inspect
+
+import pytest
+from kani import ChatMessage
+from kani.engines.base import BaseEngine, Completion
+
+from app import AutoAgentSystem
+
+
+class FakeEngine(BaseEngine):
+    """An engine that answers with ``reply(messages, functions)`` instead of calling a model."""
+
+    max_context_size = 100000
+
+    def __init__(self, reply=None, delay: float = 0.0, completion_tokens: int = 5):
+        self.reply = reply or (lambda messages, functions: ChatMessage.assistant("the answer is 42"))
+        self.delay = delay
+        self.completion_tokens = completion_tokens
+        self.n_requests = 0
+
+    def prompt_len(self, messages, functions=None, **kwargs) -> int:
+        return sum(len(m.text or "") // 4 + 4 for m in messages)
+
+    async def predict(self, messages, functions=None, **kwargs) -> Completion:
+        self.n_requests += 1
+        await asyncio.sleep(self.delay)
+        message = self.reply(messages, functions)
+        if isinstance(message, Exception):
+            raise message
+        return Completion(message, prompt_tokens=self.prompt_len(messages), completion_tokens=self.completion_tokens)
+
+    async def stream(self, messages, functions=None, **kwargs):
+        completion = await self.predict(messages, functions, **kwargs)
+        for word in (completion.message.text or "").split(" "):
+            yield word + " "
+        yield completion
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Create an app with fake engines and no tools, logging to a temporary directory. Call from a coroutine."""
+    n_apps = 0
+
+    def factory(root_reply=None, delegate_reply=None, **kwargs) -> AutoAgentSystem:
+        nonlocal n_apps
+        n_apps += 1
+        kwargs.setdefault("root_engine", FakeEngine(root_reply))
+        kwargs.setdefault("delegate_engine", FakeEngine(delegate_reply))
+        kwargs.setdefault("log_dir", tmp_path / f"session-{n_apps}")
+        kwargs.setdefault("log_kwargs", {"catalog_path": None})
+        app = AutoAgentSystem(title=None, **kwargs)
+        app.tool_configs.clear()
+        return app
+
+    return factory
+
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Run ``async def`` tests in a fresh event loop."""
+    if inspect.iscoroutinefunction(pyfuncitem.obj):
+        kwargs = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+        asyncio.run(pyfuncitem.obj(**kwargs))
+        return True
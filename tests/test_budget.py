@@ -0,0 +1,95 @@
+import types
+
+from kani import ChatMessage
+from kani.models import ToolCall
+
+import events
+from budget import BudgetAccountant, BudgetLimits, ModelPrice
+from conftest import FakeEngine
+
+
+def fake_kani(id: str, parent=None):
+    return types.SimpleNamespace(id=id, parent=parent)
+
+
+ROOT = fake_kani("root")
+HELPER = fake_kani("helper", ROOT)
+GRANDCHILD = fake_kani("grandchild", HELPER)
+
+
+class FakeApp:
+    def __init__(self):
+        self.events = []
+
+    def dispatch(self, event):
+        self.events.append(event)
+
+
+def test_charges_roll_up_the_tree():
+    budget = BudgetAccountant(prices={"model": ModelPrice(prompt=1, completion=2)})
+    budget.charge(GRANDCHILD, 1000, 500, "model", cached_prompt_tokens=250)
+    budget.charge(HELPER, 100, None, "unpriced model")
+
+    assert budget.get_usage("grandchild").cost == budget.get_subtree_usage("grandchild").cost == 0.002
+    helper = budget.get_subtree_usage("helper")
+    assert (helper.prompt_tokens, helper.completion_tokens, helper.n_requests) == (1100, 500, 2)
+    assert budget.get_usage("helper").total_tokens == 100
+    assert budget.get_subtree_usage("root").total_tokens == budget.session.total_tokens == 1600
+    assert budget.session.prompt_cache_hit_rate == 250 / 1100
+    assert budget.get_usage("nobody").total_tokens == 0
+
+
+def test_over_budget_scopes():
+    app = FakeApp()
+    budget = BudgetAccountant(app, subtree_limits=BudgetLimits(max_tokens=1000), kani_limits=BudgetLimits(max_cost=1))
+    budget.charge(GRANDCHILD, 600, 0)
+    assert budget.over_budget(GRANDCHILD) is None
+    budget.charge(HELPER, 400, 0)
+
+    # the helper's subtree is used up, which stops its descendants too; the root's subtree is the session
+    assert budget.over_budget(GRANDCHILD) == ("subtree", "helper")
+    assert budget.stop_reason(GRANDCHILD) == "the budget of your task is used up"
+    assert budget.stop_reason(HELPER) == "your budget is used up"
+    assert budget.over_budget(ROOT) is None
+    assert [(e.scope, e.id, e.total_tokens) for e in app.events] == [("subtree", "helper", 1000)]
+
+    budget.session_limits = BudgetLimits(max_tokens=1000)
+    assert budget.stop_reason(ROOT) == "the session's budget is used up"
+
+
+def finish_without_tools_reply(messages, functions):
+    """Keep calling tools for as long as there are tools to call."""
+    if functions:
+        return ChatMessage.assistant("still counting", tool_calls=[ToolCall.from_function("wait", until="all")])
+    return ChatMessage.assistant("final answer")
+
+
+async def test_subtree_budget_forces_an_answer(make_app):
+    engine = FakeEngine(finish_without_tools_reply)
+    app = make_app(delegate_engine=engine, subtree_budget=BudgetLimits(max_tokens=1))
+    exceeded = []
+
+    async def on_budget_exceeded(event):
+        exceeded.append(event)
+
+    app.subscribe(on_budget_exceeded, events.BudgetExceeded)
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    result = await delegator.wait("all")
+    await app.drain()
+
+    assert result.endswith("final answer") and engine.n_requests == 2
+    (helper,) = delegator.helpers.values()
+    assert [(e.scope, e.id) for e in exceeded] == [("subtree", helper.id)]
+    assert app.get_budget_usage()[helper.id].own.n_requests == 2
+    await app.close()
+
+
+async def test_no_delegation_over_budget(make_app):
+    app = make_app(session_budget=BudgetLimits(max_tokens=1))
+    root = await app.ensure_init()
+    app.budget.charge(root, 10, 0)
+    result = await root.delegator.delegate("count the apples")
+    assert result.startswith("You can't delegate any more tasks (the session's budget is used up).")
+    assert not root.delegator.helpers
+    await app.close()
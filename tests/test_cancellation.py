@@ -0,0 +1,82 @@
+import asyncio
+
+from kani import ChatMessage
+from kani.models import ToolCall
+
+from conftest import FakeEngine
+
+from cancellation import CancelScope, SubtaskStopped
+from state import RunState, TaskStatus
+
+
+def busy_reply(messages, functions):
+    """Say something and call a tool, forever."""
+    return ChatMessage.assistant("still counting", tool_calls=[ToolCall.from_function("wait", until="all")])
+
+
+def test_scopes_stop_with_their_ancestors():
+    root = CancelScope(timeout=60)
+    child = root.child(timeout=1, max_requests=2)
+    grandchild = child.child()
+    assert grandchild.stop_reason() is None and 0 < grandchild.remaining_time() <= 1
+
+    grandchild.record_request()
+    grandchild.record_request()
+    assert (root.n_requests, child.n_requests) == (2, 2)
+    assert grandchild.stop_reason() == "request budget used up" and not root.stopped
+
+    sibling = root.child()
+    root.cancel("user cancelled")
+    root.cancel("again")
+    # the reason closest to the scope wins
+    assert grandchild.stop_reason() == "request budget used up"
+    assert sibling.stop_reason() == "user cancelled"
+    try:
+        sibling.check()
+    except SubtaskStopped as e:
+        assert e.reason == "user cancelled"
+    else:
+        raise AssertionError("check() should raise once the scope has stopped")
+    assert CancelScope().remaining_time() is None
+
+
+async def delegate(app, instructions="count the apples") -> str:
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate(instructions)
+    return await delegator.wait("all")
+
+
+async def test_deadline_returns_partial_result(make_app):
+    app = make_app(delegate_engine=FakeEngine(busy_reply, delay=0.02), subtask_timeout=0.2)
+    result = await delegate(app)
+    assert "(stopped early: deadline exceeded) still counting" in result
+
+    (task,) = app.task_registry
+    assert task.status == TaskStatus.CANCELLED and task.error == "deadline exceeded"
+    (helper,) = app.root_kani.delegator.helpers.values()
+    assert helper.state == RunState.STOPPED
+    await app.close()
+
+
+async def test_request_budget(make_app):
+    engine = FakeEngine(busy_reply)
+    app = make_app(delegate_engine=engine, subtask_max_requests=3)
+    result = await delegate(app)
+    assert "(stopped early: request budget used up)" in result
+    assert engine.n_requests == 3
+    await app.close()
+
+
+async def test_cancel_helper(make_app):
+    app = make_app(delegate_engine=FakeEngine(busy_reply, delay=0.02))
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    while not delegator.read_progress(name := next(iter(delegator.helpers))):
+        await asyncio.sleep(0.01)
+
+    assert (await delegator.cancel(name)).startswith(f"Cancelled {name}.")
+    assert not delegator.helper_futures
+    (task,) = app.task_registry
+    assert task.status == TaskStatus.CANCELLED and task.error == "cancelled by parent"
+    assert delegator.helpers[name].cancel_scope.stopped
+    await app.close()
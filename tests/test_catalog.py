@@ -0,0 +1,48 @@
+from catalog import SessionCatalog, SessionMeta, get_catalog
+
+
+def make_meta(id, **kwargs):
+    kwargs.setdefault("title", None)
+    kwargs.setdefault("log_dir", f"/logs/{id}")
+    kwargs.setdefault("last_modified", 0.0)
+    kwargs.setdefault("n_events", 0)
+    return SessionMeta(id=id, **kwargs)
+
+
+def test_upsert_and_query(tmp_path):
+    catalog = SessionCatalog(tmp_path / "catalog.sqlite3")
+    catalog.upsert(make_meta("a", title="Apples 100%", last_modified=1, prompt_tokens=10, tools={"search": 2}))
+    catalog.upsert(make_meta("b", title="Pears", last_modified=2, prompt_tokens=500, completion_tokens=500))
+    catalog.upsert(make_meta("a", title="Apples 100%", last_modified=3, prompt_tokens=20, tools={"browse": 1}))
+
+    assert [m.id for m in catalog.query()] == ["a", "b"]
+    assert catalog.get("a").prompt_tokens == 20 and catalog.get("a").tools == {"browse": 1}
+    assert [m.id for m in catalog.query(title="100%")] == ["a"]
+    assert [m.id for m in catalog.query(title="_")] == []
+    assert [m.id for m in catalog.query(min_tokens=1000)] == ["b"]
+    assert [m.id for m in catalog.query(tool="browse")] == ["a"]
+    assert [m.id for m in catalog.query(before=2, order_by="n_events")] == ["b"]
+
+    catalog.remove("a")
+    assert catalog.get("a") is None
+    catalog.close()
+
+
+async def test_session_updates_its_catalog_row(make_app, tmp_path):
+    catalog_path = tmp_path / "catalog.sqlite3"
+    app = make_app(log_kwargs={"catalog_path": catalog_path})
+    async for _ in app.query("hello"):
+        pass
+    meta = get_catalog(catalog_path).get(app.session_id)
+    assert meta is not None
+    assert meta.n_events > 0 and meta.prompt_tokens > 0 and meta.n_kanis == 1
+    await app.close()
+
+
+async def test_group_writer_does_not_open_a_catalog(make_app):
+    n_catalogs = get_catalog.cache_info().currsize
+    app = make_app(log_kwargs={"catalog_path": None, "writer": "group"})
+    async for _ in app.query("hello"):
+        pass
+    await app.close()
+    assert get_catalog.cache_info().currsize == n_catalogs
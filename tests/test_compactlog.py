@@ -0,0 +1,75 @@
+import json
+
+from kani import ChatMessage
+
+import events
+from compactlog import CompactLogWriter, convert_jsonl_log, read_compact_index, read_compact_log
+
+
+def conversation(n_rounds: int) -> list[events.BaseEvent]:
+    """Kani messages each followed by the root message that repeats them, as the app dispatches them."""
+    out = []
+    for i in range(n_rounds):
+        msg = ChatMessage.assistant(f"answer {i}")
+        out.append(events.KaniMessage(id="root", msg=msg, timestamp=100 + i))
+        out.append(events.RootMessage(msg=msg, timestamp=100 + i))
+    return out
+
+
+def as_dicts(evts: list[events.BaseEvent]) -> list[dict]:
+    return [json.loads(e.model_dump_json()) for e in evts]
+
+
+def test_round_trip_and_filters(tmp_path):
+    evts = conversation(5)
+    writer = CompactLogWriter(tmp_path / "events.rlog", "w", segment_events=4)
+    for event in evts:
+        writer.write_event(event)
+    writer.close()
+
+    segments = read_compact_index(tmp_path / "events.rlog")
+    assert [seg["n_events"] for seg in segments] == [4, 4, 2]
+    assert writer.event_count == {"kani_message": 5, "root_message": 5}
+    assert list(read_compact_log(tmp_path / "events.rlog")) == as_dicts(evts)
+    assert list(read_compact_log(tmp_path / "events.rlog", types=["root_message"], start=102, end=103)) == as_dicts(
+        [evts[5], evts[7]]
+    )
+
+
+def test_unindexed_segments_are_recovered(tmp_path):
+    evts = conversation(3)
+    writer = CompactLogWriter(tmp_path / "events.rlog", "w")
+    for event in evts:
+        writer.write_event(event)
+    writer.flush()  # e.g. the process was killed before the segment was closed
+
+    segments = read_compact_index(tmp_path / "events.rlog")
+    assert len(segments) == 1 and segments[0]["recovered"] and segments[0]["n_events"] == 6
+    assert list(read_compact_log(tmp_path / "events.rlog")) == as_dicts(evts)
+
+    # appending never reopens a recovered segment
+    appender = CompactLogWriter(tmp_path / "events.rlog", "a")
+    appender.write_event(events.RoundComplete(session_id="s", timestamp=200))
+    appender.close()
+    assert [seg["n_events"] for seg in read_compact_index(tmp_path / "events.rlog")] == [6, 1]
+    assert len(list(read_compact_log(tmp_path / "events.rlog"))) == 7
+
+
+def test_convert_jsonl_log(tmp_path):
+    evts = as_dicts(conversation(3))
+    with open(tmp_path / "events.jsonl", "w", encoding="utf-8") as f:
+        for data in evts:
+            f.write(json.dumps(data) + "\n")
+    assert convert_jsonl_log(tmp_path / "events.jsonl", tmp_path / "events.rlog") == 6
+    assert list(read_compact_log(tmp_path / "events.rlog")) == evts
+
+
+async def test_app_writes_compact_logs(make_app):
+    app = make_app(log_kwargs={"catalog_path": None, "log_format": "compact"})
+    await app.ensure_init()
+    async for _ in app.query("hello"):
+        pass
+    await app.close()
+    logged = list(read_compact_log(app.logger.compact_log_path))
+    assert [e["msg"]["content"] for e in logged if e["type"] == "root_message"] == ["hello", "the answer is 42"]
+    assert not (app.logger.log_dir / "events.jsonl").exists()
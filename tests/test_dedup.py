@@ -0,0 +1,43 @@
+from dedup import TaskIndex, instructions_hash, normalize_instructions
+
+FRANCE = "Find the population of France in 2020 according to the World Bank."
+GERMANY = "Find the population of Germany in 2020 according to the World Bank."
+
+
+def test_normalization():
+    assert normalize_instructions("  Find THE population,\nof France! ") == "find the population of france"
+    assert instructions_hash("Find the population of France") == instructions_hash("find the population of france.")
+
+
+def test_exact_duplicates_only_by_default():
+    index = TaskIndex()
+    index.add(FRANCE, "alpha")
+    match = index.find("find the population of FRANCE in 2020, according to the world bank")
+    assert match is not None and match.exact and match.agent == "alpha"
+    assert index.find("Find the population of France in 2020 according to the World Bank please") is None
+
+
+def test_sibling_tasks_differing_in_an_entity_are_not_duplicates():
+    for index in (TaskIndex(), TaskIndex(near_duplicate_cutoff=90)):
+        index.add(FRANCE, "alpha")
+        assert index.find(GERMANY) is None
+        assert index.find(FRANCE.replace("2020", "2021")) is None
+
+
+def test_near_duplicates_are_opt_in():
+    index = TaskIndex(near_duplicate_cutoff=90)
+    index.add(FRANCE, "alpha")
+    match = index.find("Please find the population of France in 2020 according to World Bank")
+    assert match is not None and not match.exact
+    assert match.agent == "alpha" and match.task == FRANCE
+    assert 90 <= match.score < 100
+
+
+async def test_fan_out_over_entities_is_not_rejected(make_app):
+    app = make_app()
+    delegator = (await app.ensure_init()).delegator
+    assert "is helping you" in await delegator.delegate(FRANCE)
+    assert "is helping you" in await delegator.delegate(GERMANY)
+    assert "already given" in await delegator.delegate(FRANCE.lower())
+    await delegator.wait("all")
+    await app.close()
@@ -0,0 +1,92 @@
+import json
+import types
+
+import pytest
+
+from kani import ChatMessage
+
+import events
+from eventlogger import INDEX_CHECKPOINT_INTERVAL, EventLogger, GroupCommitWriter
+from utils import read_jsonl
+
+
+def make_logger(log_dir, clear=False, **kwargs) -> EventLogger:
+    app = types.SimpleNamespace(kanis={}, title=None)
+    return EventLogger(app, "session", log_dir=log_dir, clear_existing_log=clear, catalog_path=None, **kwargs)
+
+
+async def log_messages(logger: EventLogger, n: int, text: str = "message"):
+    for i in range(n):
+        await logger.log_event(events.KaniMessage(id="k", msg=ChatMessage.assistant(f"{text} {i}")))
+    await logger.log_event(events.RoundComplete(session_id="session"))
+    await logger.write_state()
+
+
+def reopen(log_dir) -> EventLogger:
+    logger = make_logger(log_dir)
+    _ = logger.event_file  # loads the index
+    return logger
+
+
+async def test_counts_resume_from_the_index(tmp_path):
+    logger = make_logger(tmp_path, clear=True)
+    await log_messages(logger, INDEX_CHECKPOINT_INTERVAL + 5)
+    # events after the last index write are scanned from the log
+    await logger.log_event(events.RoundComplete(session_id="session"))
+    logger.event_file.close()
+
+    resumed = reopen(tmp_path)
+    assert resumed.event_count == {"kani_message": INDEX_CHECKPOINT_INTERVAL + 5, "round_complete": 2}
+    assert resumed._aof_size == (tmp_path / "events.jsonl").stat().st_size
+    assert [c[:2] for c in resumed._checkpoints] == [c[:2] for c in logger._checkpoints]
+    resumed.event_file.close()
+
+
+async def test_index_is_trusted_for_the_part_it_covers(tmp_path):
+    logger = make_logger(tmp_path, clear=True)
+    await log_messages(logger, 3)
+    logger.event_file.close()
+    index_path = tmp_path / "events.idx.json"
+    index = json.loads(index_path.read_text())
+    index["counts"]["kani_message"] = 1000
+    index_path.write_text(json.dumps(index))
+
+    resumed = reopen(tmp_path)
+    assert resumed.event_count["kani_message"] == 1000
+    resumed.event_file.close()
+
+
+async def test_index_of_a_rewritten_log_is_ignored(tmp_path):
+    logger = make_logger(tmp_path, clear=True)
+    await log_messages(logger, 3)
+    logger.event_file.close()
+    index_path = tmp_path / "events.idx.json"
+    stale_index = index_path.read_text()
+
+    # rewrite the log with different events that grow past the indexed size, then restore the old index
+    logger = make_logger(tmp_path, clear=True)
+    await log_messages(logger, 10, text="a different message")
+    logger.event_file.close()
+    index_path.write_text(stale_index)
+    assert json.loads(stale_index)["size"] < (tmp_path / "events.jsonl").stat().st_size
+
+    resumed = reopen(tmp_path)
+    assert resumed.event_count == {"kani_message": 10, "round_complete": 1}
+    resumed.event_file.close()
+
+
+@pytest.mark.parametrize("durability", ["none", "flush", "fsync"])
+async def test_group_writer(tmp_path, durability):
+    # a long delay, so groups are only committed when they fill up or when the index is written
+    logger = make_logger(tmp_path, clear=True, writer="group", group_max_delay=60, durability=durability)
+    await log_messages(logger, 5)
+    assert isinstance(logger.event_file, GroupCommitWriter)
+    # the index is only written once everything it covers is on disk
+    assert (tmp_path / "events.jsonl").stat().st_size == logger._aof_size
+
+    await logger.log_event(events.RoundComplete(session_id="session"))
+    logger.event_file.close()
+    assert [e["type"] for e in read_jsonl(tmp_path / "events.jsonl")] == ["kani_message"] * 5 + ["round_complete"] * 2
+    resumed = reopen(tmp_path)
+    assert resumed.event_count == {"kani_message": 5, "round_complete": 2}
+    resumed.event_file.close()
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from kani import ChatRole
+
+import events
+from dispatch import BoundedEventQueue, QueuePolicy
+from state import RunState
+
+
+def round_complete(session_id: str) -> events.RoundComplete:
+    return events.RoundComplete(session_id=session_id)
+
+
+def delta(kani_id: str, text: str) -> events.StreamDelta:
+    return events.StreamDelta(id=kani_id, delta=text, role=ChatRole.ASSISTANT)
+
+
+async def drain(queue: BoundedEventQueue) -> list[events.BaseEvent]:
+    out = []
+    while queue.qsize():
+        out.append(await queue.get())
+        queue.task_done()
+    return out
+
+
+async def test_unbounded_queue_is_fifo():
+    queue = BoundedEventQueue()
+    for i in range(100):
+        queue.put_nowait(round_complete(str(i)))
+    assert not queue.full()
+    assert [e.session_id for e in await drain(queue)] == [str(i) for i in range(100)]
+    await asyncio.wait_for(queue.join(), 1)
+
+
+async def test_block_accepts_events_and_applies_backpressure():
+    queue = BoundedEventQueue(2)
+    for i in range(3):
+        queue.put_nowait(round_complete(str(i)))
+    assert queue.qsize() == 3 and queue.metrics().n_blocked == 1
+
+    waiter = asyncio.create_task(queue.wait_for_room())
+    await asyncio.sleep(0.01)
+    assert not waiter.done()
+    await queue.get()
+    await queue.get()
+    await asyncio.wait_for(waiter, 1)
+
+
+async def test_spill_keeps_order():
+    queue = BoundedEventQueue(2, default_policy=QueuePolicy.SPILL)
+    for i in range(10):
+        queue.put_nowait(round_complete(str(i)))
+    metrics = queue.metrics()
+    assert (metrics.depth, metrics.spilled_depth, metrics.n_spilled) == (2, 8, 8)
+    # events dispatched after a spill are spilled too, whatever their policy, so they stay in order
+    queue.policies[events.SessionClose] = QueuePolicy.BLOCK
+    queue.put_nowait(events.SessionClose(session_id="end"))
+    out = await drain(queue)
+    assert [getattr(e, "session_id") for e in out] == [str(i) for i in range(10)] + ["end"]
+    assert isinstance(out[-1], events.SessionClose)
+    await asyncio.wait_for(queue.join(), 1)
+
+
+async def test_drop():
+    queue = BoundedEventQueue(1, policies={events.RoundComplete: QueuePolicy.DROP})
+    queue.put_nowait(round_complete("kept"))
+    queue.put_nowait(round_complete("dropped"))
+    assert queue.metrics().dropped == {"round_complete": 1}
+    assert [e.session_id for e in await drain(queue)] == ["kept"]
+    await asyncio.wait_for(queue.join(), 1)
+
+
+async def test_merge_stream_deltas_and_state_changes():
+    queue = BoundedEventQueue(1)
+    queue.put_nowait(delta("a", "the "))
+    queue.put_nowait(delta("a", "answer"))
+    queue.put_nowait(events.KaniStateChange(id="a", state=RunState.RUNNING))
+    queue.put_nowait(events.KaniStateChange(id="a", state=RunState.WAITING))
+    queue.put_nowait(events.KaniStateChange(id="a", state=RunState.STOPPED))
+    # a delta after another event of the same kani can't be merged without reordering, and deltas aren't logged
+    queue.put_nowait(delta("a", " is 42"))
+
+    out = await drain(queue)
+    assert [(e.type, getattr(e, "delta", None) or getattr(e, "state", None)) for e in out] == [
+        ("stream_delta", "the answer"),
+        ("kani_state_change", RunState.STOPPED),
+    ]
+    metrics = queue.metrics()
+    assert metrics.merged == {"stream_delta": 1, "kani_state_change": 2}
+    assert metrics.dropped == {"stream_delta": 1}
+    await asyncio.wait_for(queue.join(), 1)
+
+
+async def test_task_done_too_many_times():
+    queue = BoundedEventQueue()
+    with pytest.raises(ValueError):
+        queue.task_done()
@@ -0,0 +1,89 @@
+from kani import ChatMessage
+from kani.models import ToolCall
+
+import events
+from base_kani import ELIDED_EXCERPT_CHARS, ELIDED_PREFIX
+
+
+def tool_round(i: int, result: str) -> list[ChatMessage]:
+    call = ToolCall.from_function("search", query=f"apples {i}")
+    return [ChatMessage.assistant(None, tool_calls=[call]), ChatMessage.function("search", result, call.id)]
+
+
+def long_history(n_results: int, result_chars: int = 4000) -> list[ChatMessage]:
+    history = [ChatMessage.user("count the apples")]
+    for i in range(n_results):
+        history.extend(tool_round(i, f"result {i}: " + "apple " * (result_chars // 6)))
+    history.extend(tool_round(n_results, "short result"))
+    return history
+
+
+async def test_old_function_results_are_elided(make_app):
+    app = make_app()
+    compacted = []
+
+    async def on_compacted(event):
+        compacted.append(event)
+
+    app.subscribe(on_compacted, events.HistoryCompacted)
+    root = await app.ensure_init()
+    helper = await root.create_delegate_kani("count the apples")
+    helper.chat_history = long_history(5)
+    originals = list(helper.chat_history)
+    before = sum(n for _, n in await helper.history_token_lens())
+
+    # 5 results of ~1000 tokens; compacting to 2500 tokens elides the oldest 3, even though the 4th is still long
+    assert await helper.compact_history(max_tokens=4000, target_tokens=2500) == 3
+    after = sum(n for _, n in await helper.history_token_lens())
+    assert after <= 2500 < before
+    elided = [m for m in helper.chat_history if (m.text or "").startswith(ELIDED_PREFIX)]
+    assert [helper.chat_history.index(m) for m in elided] == [2, 4, 6]
+    assert elided[0].tool_call_id == originals[2].tool_call_id
+    assert originals[2].text[:ELIDED_EXCERPT_CHARS] in elided[0].text
+    # everything but the elided results is untouched
+    assert [m for m in helper.chat_history if m not in elided] == [
+        m for i, m in enumerate(originals) if i not in (2, 4, 6)
+    ]
+
+    # under the threshold, nothing happens
+    assert await helper.compact_history(max_tokens=4000) == 0
+    await app.drain()
+    (event,) = compacted
+    assert (event.id, event.message_idxs, event.tokens_before, event.tokens_after) == (
+        helper.id,
+        [2, 4, 6],
+        before,
+        after,
+    )
+    await app.close()
+
+
+async def test_recent_and_short_results_are_kept(make_app):
+    app = make_app()
+    root = await app.ensure_init()
+    helper = await root.create_delegate_kani("count the apples")
+    helper.chat_history = long_history(2)
+    assert await helper.compact_history(max_tokens=100, keep_recent=2) == 0
+    # short results are never elided, and don't count towards the recent results that are kept
+    helper.chat_history.extend(tool_round(3, "short result"))
+    assert await helper.compact_history(max_tokens=100, keep_recent=2) == 0
+    helper.chat_history.extend(long_history(1)[1:3])
+    assert await helper.compact_history(max_tokens=100, keep_recent=2) == 1
+    assert helper.chat_history[2].text.startswith(ELIDED_PREFIX)
+    await app.close()
+
+
+async def test_helpers_compact_before_each_request(make_app):
+    app = make_app(helper_history_token_limit=2000)
+    root = await app.ensure_init()
+    helper = await root.create_delegate_kani("count the apples")
+    root_history = long_history(5)
+    root.chat_history = list(root_history)
+    helper.chat_history = long_history(5)
+
+    prompt = await helper.get_prompt()
+    assert any((m.text or "").startswith(ELIDED_PREFIX) for m in prompt)
+    # the root's history is never compacted
+    await root.get_prompt()
+    assert root.chat_history == root_history
+    await app.close()
@@ -0,0 +1,63 @@
+import json
+
+from kani import ChatMessage
+
+from historystore import HistoryStore
+
+
+def test_store_round_trip(tmp_path):
+    store = HistoryStore(tmp_path / "spilled")
+    messages = [ChatMessage.user("count the apples"), ChatMessage.assistant("there are 42")]
+    store.save("k", messages, [5, 4])
+    assert store.spilled_bytes == (tmp_path / "spilled" / "k.json").stat().st_size
+    assert store.load("k") == (messages, [5, 4])
+
+    assert store.rehydrate("k") == (messages, [5, 4])
+    assert not (tmp_path / "spilled" / "k.json").exists()
+    assert (store.n_spills, store.n_rehydrations, store.spilled_bytes) == (1, 1, 0)
+
+
+async def test_idle_helpers_are_spilled_and_rehydrated(make_app):
+    app = make_app(spill_idle_histories=True)
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    await delegator.wait("all")
+    name, helper = next(iter(delegator.helpers.items()))
+
+    assert helper.history_spilled and helper.history_fingerprint()[0] == 2
+    stats = app.get_memory_stats()
+    assert (stats.n_kanis, stats.n_spilled, stats.n_spills, stats.n_rehydrations) == (2, 1, 1, 0)
+    assert stats.spilled_bytes == app.history_store.spilled_bytes > 0
+
+    # the state file is written from the store, without reading the history back into memory
+    await app.logger.write_state()
+    with open(app.logger.state_path, encoding="utf-8") as f:
+        saved = {k["id"]: k for k in json.load(f)["state"]}
+    assert [m["content"] for m in saved[helper.id]["chat_history"]] == ["count the apples", "the answer is 42"]
+    assert helper.history_spilled
+
+    # giving the helper another task reads its history back, and it is spilled again once the task is done
+    await delegator.delegate("now count the pears", who=name)
+    await delegator.wait("all")
+    stats = app.get_memory_stats()
+    assert (stats.n_spills, stats.n_rehydrations) == (2, 1)
+    # reading the history makes it resident again
+    assert [m.text for m in helper.chat_history] == [
+        "count the apples",
+        "the answer is 42",
+        "now count the pears",
+        "the answer is 42",
+    ]
+    assert not helper.history_spilled and app.history_store.n_rehydrations == 2
+    await app.close()
+
+
+async def test_no_spilling_by_default(make_app):
+    app = make_app()
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    await delegator.wait("all")
+    assert app.history_store is None
+    stats = app.get_memory_stats()
+    assert stats.n_spilled == stats.spilled_bytes == 0 and stats.resident_messages > 0
+    await app.close()
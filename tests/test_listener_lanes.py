@@ -0,0 +1,80 @@
+import asyncio
+
+import events
+from dispatch import BoundedEventQueue, ListenerLane
+
+
+def round_complete(session_id: str) -> events.RoundComplete:
+    return events.RoundComplete(session_id=session_id)
+
+
+async def test_lane_delivers_in_order_and_survives_errors():
+    received = []
+
+    async def listener(event):
+        received.append(event.session_id)
+        if event.session_id == "1":
+            raise RuntimeError("listener bug")
+
+    lane = ListenerLane(listener, BoundedEventQueue(), name="listener")
+    for i in range(5):
+        lane.put_nowait(round_complete(str(i)))
+    await asyncio.wait_for(lane.queue.join(), 1)
+
+    assert received == ["0", "1", "2", "3", "4"]
+    stats = lane.stats()
+    assert (stats.name, stats.depth, stats.n_delivered) == ("listener", 0, 5)
+    assert stats.max_lag >= stats.last_lag >= 0
+    lane.close()
+
+
+async def test_slow_listener_does_not_stall_others(make_app):
+    app = make_app()
+    release = asyncio.Event()
+    fast_received, slow_received = [], []
+
+    async def slow(event):
+        await release.wait()
+        slow_received.append(event)
+
+    async def fast(event):
+        fast_received.append(event)
+
+    await app.ensure_init()
+    app.subscribe(slow, events.RoundComplete)
+    app.subscribe(fast, events.RoundComplete)
+    for i in range(3):
+        app.dispatch(round_complete(str(i)))
+
+    async def fast_done():
+        while len(fast_received) < 3:
+            await asyncio.sleep(0.001)
+
+    await asyncio.wait_for(fast_done(), 1)
+    assert not slow_received
+    stats = {s.name.rsplit(".", 1)[-1]: s for s in app.get_listener_stats()}
+    assert stats["fast"].n_delivered == 3 and stats["slow"].n_delivered == 0
+
+    release.set()
+    await asyncio.wait_for(app.drain(), 1)
+    assert [e.session_id for e in slow_received] == ["0", "1", "2"]
+    await app.close()
+
+
+async def test_listener_can_remove_itself(make_app):
+    app = make_app()
+    received = []
+
+    async def once(event):
+        received.append(event)
+        app.remove_listener(once)
+
+    await app.ensure_init()
+    app.subscribe(once, events.RoundComplete)
+    app.dispatch(round_complete("0"))
+    await app.drain()
+    app.dispatch(round_complete("1"))
+    await app.drain()
+    assert len(received) == 1
+    assert all(not s.name.endswith("once") for s in app.get_listener_stats())
+    await app.close()
@@ -0,0 +1,66 @@
+import asyncio
+import types
+
+from scheduler import EngineLimiter, EngineLimits, request_priority
+from state import RunState
+
+
+def fake_kani(name: str, parent=None, state=RunState.RUNNING):
+    depth = 0 if parent is None else parent.depth + 1
+    return types.SimpleNamespace(name=name, parent=parent, state=state, depth=depth)
+
+
+ROOT = fake_kani("root")
+BUSY_PARENT = fake_kani("busy parent", ROOT)
+WAITING_PARENT = fake_kani("waiting parent", ROOT, state=RunState.WAITING)
+
+
+async def admission_order(limiter: EngineLimiter, kanis: list, after_queueing=None) -> list[str]:
+    order = []
+
+    async def request(kani):
+        await limiter.acquire(kani)
+        order.append(kani.name)
+        await asyncio.sleep(0)
+        limiter.release()
+
+    await limiter.acquire()  # hold the only slot until everything is queued
+    tasks = [asyncio.create_task(request(kani)) for kani in kanis]
+    await asyncio.sleep(0)
+    if after_queueing is not None:
+        after_queueing()
+    limiter.release()
+    await asyncio.wait_for(asyncio.gather(*tasks), 1)
+    return order
+
+
+def one_at_a_time(prioritize: bool = True) -> EngineLimiter:
+    return EngineLimiter("model", EngineLimits(initial_concurrency=1, max_concurrency=1), prioritize=prioritize)
+
+
+def test_request_priority():
+    assert request_priority(ROOT, 5) < request_priority(fake_kani("child", WAITING_PARENT), 0)
+    # a child blocking its parent goes before a shallower kani whose parent is busy
+    assert request_priority(fake_kani("child", WAITING_PARENT), 9) < request_priority(BUSY_PARENT, 0)
+    assert request_priority(None, 0) == request_priority(BUSY_PARENT, 0)[:1] + (0, 0)
+
+
+async def test_blocking_and_shallow_requests_go_first():
+    kanis = [fake_kani("deep, not blocking", BUSY_PARENT), BUSY_PARENT, fake_kani("deep, blocking", WAITING_PARENT)]
+    assert await admission_order(one_at_a_time(), kanis) == ["deep, blocking", "busy parent", "deep, not blocking"]
+    assert await admission_order(one_at_a_time(prioritize=False), kanis) == [
+        "deep, not blocking",
+        "busy parent",
+        "deep, blocking",
+    ]
+
+
+async def test_priority_is_evaluated_on_admission():
+    parent = fake_kani("parent", ROOT)
+    kanis = [fake_kani("shallow", ROOT), fake_kani("child", parent)]
+
+    def parent_starts_waiting():
+        parent.state = RunState.WAITING
+
+    order = await admission_order(one_at_a_time(), kanis, after_queueing=parent_starts_waiting)
+    assert order == ["child", "shallow"]
@@ -0,0 +1,79 @@
+import asyncio
+
+from kani import ChatMessage, ChatRole
+from kani.models import ToolCall
+
+from delegation.progress import ProgressBuffer
+
+
+def two_step_reply(messages, functions):
+    """Say something and call a tool, then give a final answer."""
+    if messages[-1].role == ChatRole.USER:
+        return ChatMessage.assistant("step one.", tool_calls=[ToolCall.from_function("wait", until="all")])
+    return ChatMessage.assistant("step two.")
+
+
+async def test_buffer_read_and_wait():
+    buffer = ProgressBuffer(max_updates=2)
+    buffer.publish("message", "a")
+    updates, cursor = buffer.read()
+    assert [u.text for u in updates] == ["a"] and cursor == 1
+
+    assert not await buffer.wait_for_update(cursor, timeout=0.01)
+    waiter = asyncio.create_task(buffer.wait_for_update(cursor, timeout=5))
+    await asyncio.sleep(0)
+    buffer.publish("tool_result", "b")
+    assert await waiter
+
+    # only the last *max_updates* are kept
+    buffer.publish("message", "c")
+    updates, cursor = buffer.read(0)
+    assert [u.render() for u in updates] == ["[tool result] b", "c"] and cursor == 3
+    assert buffer.read(cursor) == ([], 3)
+
+    buffer.close()
+    assert await buffer.wait_for_update(cursor, timeout=5)
+
+
+async def test_result_keeps_messages_and_tool_results_apart(make_app):
+    app = make_app(delegate_reply=two_step_reply)
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    name = next(iter(delegator.helpers))
+    result = await delegator.wait(name)
+    assert result.startswith(f"{name}:step one.\n")
+    assert result.endswith("\nstep two.")
+    assert len(result.splitlines()) >= 3
+    await app.close()
+
+
+async def test_check_progress_while_the_helper_works(make_app):
+    app = make_app(delegate_reply=two_step_reply)
+    app.delegate_engine.delay = 0.2
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    name = next(iter(delegator.helpers))
+
+    report = await delegator.check_progress(name, timeout=5)
+    assert report.startswith(f"{name} is still working. New progress:\nstep one.")
+    assert "step one." not in await delegator.check_progress(name)
+
+    report = await delegator.wait(name, timeout=0.01)
+    assert name in report and "step two." not in report
+    assert (await delegator.wait(name)).endswith("step two.")
+    await app.close()
+
+
+async def test_cancel_returns_progress(make_app):
+    app = make_app(delegate_reply=two_step_reply)
+    app.delegate_engine.delay = 0.2
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    name = next(iter(delegator.helpers))
+    await delegator.check_progress(name, timeout=5)
+
+    result = await delegator.cancel(name)
+    assert result.startswith(f"Cancelled {name}.")
+    assert app.task_registry.current_task(delegator.helpers[name].id).status.value == "cancelled"
+    assert await delegator.cancel(name) == f"No active helper named {name}."
+    await app.close()
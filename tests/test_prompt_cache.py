@@ -0,0 +1,72 @@
+import types
+
+from kani import ChatMessage
+from kani.engines.base import Completion
+
+import events
+from utils import get_prompt_cache_usage
+
+
+def completion_with(extra: dict, prompt_tokens: int = 1000) -> Completion:
+    return Completion(ChatMessage.assistant("the answer is 42", extra=extra), prompt_tokens=prompt_tokens)
+
+
+def test_openai_and_anthropic_usage():
+    chat = {"prompt_tokens_details": {"cached_tokens": 768}}
+    responses = {"input_tokens_details": {"cached_tokens": 0}}
+    assert get_prompt_cache_usage(completion_with({"openai_usage": chat})) == (768, 232)
+    assert get_prompt_cache_usage(completion_with({"openai_usage": responses})) == (0, 1000)
+    assert get_prompt_cache_usage(completion_with({"openai_usage": {"prompt_tokens": 1000}})) is None
+
+    usage = types.SimpleNamespace(input_tokens=10, cache_read_input_tokens=900, cache_creation_input_tokens=90)
+    anthropic = types.SimpleNamespace(usage=usage)
+    assert get_prompt_cache_usage(completion_with({"anthropic_message": anthropic})) == (900, 100)
+    usage.cache_read_input_tokens = None
+    assert get_prompt_cache_usage(completion_with({"anthropic_message": anthropic})) is None
+    assert get_prompt_cache_usage(completion_with({})) is None
+
+
+async def test_siblings_share_a_prompt_prefix(make_app):
+    app = make_app()
+    root = await app.ensure_init()
+    alpha = await root.create_delegate_kani("count the apples")
+    beta = await root.create_delegate_kani("count the pears")
+    assert list(alpha.functions) == sorted(alpha.functions) == list(beta.functions)
+
+    prompts = []
+    for helper in (alpha, beta):
+        messages = await helper.get_prompt()
+        functions = [f.json_schema for f in helper.functions.values()]
+        prompts.append((messages[0].text, functions))
+    (alpha_prompt, alpha_functions), (beta_prompt, beta_functions) = prompts
+    assert alpha_functions == beta_functions
+    prefix, _ = alpha_prompt.split(f"Your name is {alpha.name}.")
+    assert beta_prompt.startswith(prefix + f"Your name is {beta.name}.")
+    await app.close()
+
+
+def cached_usage_reply(messages, functions):
+    return ChatMessage.assistant(
+        "the answer is 42", extra={"openai_usage": {"prompt_tokens_details": {"cached_tokens": 8}}}
+    )
+
+
+async def test_cached_tokens_are_reported(make_app):
+    app = make_app(root_reply=cached_usage_reply)
+    used = []
+
+    async def on_tokens_used(event):
+        used.append(event)
+
+    app.subscribe(on_tokens_used, events.TokensUsed)
+    root = await app.ensure_init()
+    async for _ in app.query("hello"):
+        pass
+    await app.drain()
+
+    (event,) = used
+    assert event.cached_prompt_tokens == 8
+    assert event.uncached_prompt_tokens == event.prompt_tokens - 8
+    assert app.budget.get_usage(root.id).cached_prompt_tokens == 8
+    assert app.budget.session.prompt_cache_hit_rate == 8 / event.prompt_tokens
+    await app.close()
@@ -0,0 +1,62 @@
+from kani import ChatMessage, ChatRole
+from kani.models import ToolCall
+
+from replay import SessionReplay, iter_session_dirs, replay_sessions
+from state import RunState
+
+
+def delegating_reply(messages, functions):
+    """Delegate a subtask, wait for it, then answer."""
+    n_results = sum(m.role == ChatRole.FUNCTION for m in messages)
+    if n_results == 0:
+        return ChatMessage.assistant(None, tool_calls=[ToolCall.from_function("delegate", instructions="count apples")])
+    if n_results == 1:
+        return ChatMessage.assistant(None, tool_calls=[ToolCall.from_function("wait", until="all")])
+    return ChatMessage.assistant("there are 42 apples")
+
+
+async def run_session(make_app, **kwargs):
+    app = make_app(root_reply=delegating_reply, **kwargs)
+    await app.ensure_init()
+    async for _ in app.query("how many apples?"):
+        pass
+    await app.close()
+    return app
+
+
+async def test_replay_rebuilds_the_kani_tree(make_app):
+    app = await run_session(make_app)
+    replay = SessionReplay.from_log(app.logger.log_dir)
+
+    # the engine repr and the system prompt (which has the time in it) can change after the spawn event
+    fields = {"id", "depth", "parent", "children", "chat_history", "state", "name"}
+    assert [s.model_dump(include=fields) for s in replay.get_kani_states()] == [
+        ai.get_save_state().model_dump(include=fields) for ai in app.kanis.values()
+    ]
+    assert [k["id"] for k in replay.walk()] == list(app.kanis)
+    assert replay.root_id == app.root_kani.id and replay.max_depth == 1
+    assert [d["instructions"] for d in replay.delegations] == ["count apples"]
+    assert replay.n_rounds == 1 and not replay.running_kanis()
+    assert replay.completion_tokens[app.root_kani.id] == 15
+
+
+async def test_replay_until(make_app):
+    app = await run_session(make_app, log_kwargs={"catalog_path": None, "log_format": "compact"})
+    full = SessionReplay.from_log(app.logger.log_dir)
+    delegated_at = full.delegations[0]["timestamp"]
+
+    partial = SessionReplay.from_log(app.logger.log_dir, until=delegated_at)
+    assert partial.event_count.total() < full.event_count.total()
+    assert partial.root["state"] == RunState.RUNNING.value
+    assert partial.root["chat_history"][-1]["tool_calls"][0]["function"]["name"] == "delegate"
+
+    first_events = SessionReplay.from_log(app.logger.log_dir, max_events=3)
+    assert first_events.event_count.total() == 3
+
+
+async def test_replay_sessions(make_app, tmp_path):
+    apps = [await run_session(make_app) for _ in range(2)]
+    log_dirs = list(iter_session_dirs(tmp_path))
+    assert log_dirs == [app.logger.log_dir for app in apps]
+    replays = dict(replay_sessions(log_dirs, max_workers=1))
+    assert all(len(replay.kanis) == 2 for replay in replays.values())
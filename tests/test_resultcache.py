@@ -0,0 +1,70 @@
+import time
+
+import resultcache
+from resultcache import SubtaskResultCache
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    path = tmp_path / "results.sqlite3"
+    cache = SubtaskResultCache(path, max_memory_entries=1)
+    key = SubtaskResultCache.make_key("Count the apples.", ["b", "a"], "model")
+    assert key == SubtaskResultCache.make_key("count the apples", ["a", "b"], "model")
+    assert key != SubtaskResultCache.make_key("count the apples", ["a", "b"], "other-model")
+
+    assert cache.get(key) is None
+    cache.put(key, "42 apples")
+    cache.put("other", "pears")  # evicts the first result from memory
+    assert cache.get(key) == "42 apples"
+    assert cache.get(key) == "42 apples"
+    assert (cache.stats.disk_hits, cache.stats.memory_hits, cache.stats.misses) == (1, 1, 1)
+    cache.close()
+
+    # the disk tier is shared with later sessions
+    reopened = SubtaskResultCache(path)
+    assert reopened.get(key) == "42 apples"
+    reopened.close()
+
+
+def test_expired_results_are_dropped(tmp_path, monkeypatch):
+    cache = SubtaskResultCache(tmp_path / "results.sqlite3", ttl=60)
+    cache.put("key", "old")
+    now = time.time()
+    monkeypatch.setattr(resultcache.time, "time", lambda: now + 120)
+    assert cache.get("key") is None
+    assert cache._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0] == 0
+    cache.close()
+
+
+def test_disk_eviction_is_amortized(tmp_path):
+    cache = SubtaskResultCache(tmp_path / "results.sqlite3", max_memory_entries=1, max_disk_entries=10)
+    indexes = {row[1] for row in cache._conn.execute("PRAGMA index_list(results)")}
+    assert {"results_last_access", "results_created"} <= indexes
+
+    for i in range(10):
+        cache.put(f"key{i}", str(i))
+    assert cache._n_disk_entries == 10
+    cache.get("key0")  # now the most recently used
+    cache.put("key10", "10")
+    # over the limit: evict the least recently used rows, down to 90% of the limit
+    n_rows = cache._conn.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+    assert n_rows == cache._n_disk_entries == 9
+    assert cache.get("key0") == "0" and cache.get("key10") == "10"
+    assert cache.get("key1") is None
+    cache.close()
+
+
+async def test_identical_subtasks_reuse_results(make_app, tmp_path):
+    cache = SubtaskResultCache(tmp_path / "results.sqlite3")
+    app = make_app(result_cache=cache)
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    assert (await delegator.wait("all")).endswith("the answer is 42")
+    await app.close()
+
+    app = make_app(result_cache=cache)
+    delegator = (await app.ensure_init()).delegator
+    result = await delegator.delegate("Count the apples.")
+    assert result == "(cached result of an identical earlier task)\nthe answer is 42"
+    assert app.delegate_engine.n_requests == 0
+    await app.close()
+    cache.close()
@@ -0,0 +1,90 @@
+import types
+
+from kani import ChatMessage
+from kani.models import ToolCall
+
+from delegation.delegate_and_wait import DelegateWait
+from delegation.retry import RetryPolicy
+from state import TaskStatus
+
+FAST_RETRIES = RetryPolicy(base_delay=0.01)
+
+
+def failing_reply(*errors: Exception):
+    """Raise each of the given errors in turn, then answer."""
+    errors = list(errors)
+
+    def reply(messages, functions):
+        if errors:
+            return errors.pop(0)
+        return ChatMessage.assistant("the answer is 42")
+
+    return reply
+
+
+async def delegate(make_app, delegate_reply, retry_policy=FAST_RETRIES):
+    app = make_app(delegate_reply=delegate_reply, retry_policy=retry_policy)
+    delegator = (await app.ensure_init()).delegator
+    await delegator.delegate("count the apples")
+    return app, await delegator.wait("all")
+
+
+async def test_retryable_errors_resume_the_same_helper(make_app):
+    app, result = await delegate(make_app, failing_reply(ConnectionError("reset"), TimeoutError()))
+    assert result.endswith("the answer is 42") and "reassigned" not in result
+    stats = app.retry_stats
+    assert (stats.n_attempts, stats.n_retries, stats.n_reassignments, stats.n_failed) == (3, 2, 0, 0)
+
+    (helper,) = app.root_kani.delegator.helpers.values()
+    assert [m.text for m in helper.chat_history] == ["count the apples", "the answer is 42"]
+    (task,) = app.task_registry
+    assert task.status == TaskStatus.COMPLETED
+    await app.close()
+
+
+async def test_other_errors_reassign_the_task(make_app):
+    app, result = await delegate(make_app, failing_reply(ValueError("bad output")))
+    assert "(reassigned to " in result and result.endswith("the answer is 42")
+    assert (app.retry_stats.n_retries, app.retry_stats.n_reassignments) == (0, 1)
+
+    first, second = app.task_registry
+    assert first.status == TaskStatus.REASSIGNED and first.reassigned_to == second.id
+    assert second.status == TaskStatus.COMPLETED and second.reassigned_from == first.id
+    await app.close()
+
+
+async def test_task_fails_after_retries_and_reassignments(make_app):
+    policy = RetryPolicy(max_attempts=2, base_delay=0.01, max_reassignments=1)
+    app, result = await delegate(make_app, failing_reply(*[ConnectionError("reset")] * 4), retry_policy=policy)
+    assert "failed: reset" in result
+    stats = app.retry_stats
+    assert (stats.n_attempts, stats.n_retries, stats.n_reassignments, stats.n_failed) == (4, 2, 1, 1)
+    assert [t.status for t in app.task_registry] == [TaskStatus.REASSIGNED, TaskStatus.FAILED]
+    await app.close()
+
+
+def test_rewind_drops_unanswered_tool_calls():
+    call = ToolCall.from_function("search", query="apples")
+    helper = types.SimpleNamespace(
+        chat_history=[
+            ChatMessage.user("count the apples"),
+            ChatMessage.assistant("let me search", tool_calls=[call]),
+        ]
+    )
+    # the instructions are in the history, so the round resumes without a new query
+    assert DelegateWait._rewind_to_last_good_message(helper, 0, "count the apples") is None
+    assert [m.text for m in helper.chat_history] == ["count the apples"]
+
+    answered = [ChatMessage.assistant(None, tool_calls=[call]), ChatMessage.function("search", "3 results", call.id)]
+    helper.chat_history.extend(answered)
+    DelegateWait._rewind_to_last_good_message(helper, 0, "count the apples")
+    assert len(helper.chat_history) == 3
+
+    helper.chat_history.clear()
+    assert DelegateWait._rewind_to_last_good_message(helper, 0, "count the apples") == "count the apples"
+
+
+def test_backoff_delays():
+    policy = RetryPolicy(base_delay=1, multiplier=2, max_delay=5, jitter=0)
+    assert [policy.get_delay(attempt) for attempt in range(1, 5)] == [1, 2, 4, 5]
+    assert policy.is_retryable(ConnectionError()) and not policy.is_retryable(ValueError())
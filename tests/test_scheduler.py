@@ -0,0 +1,104 @@
+import asyncio
+
+from kani import ChatMessage, ChatRole
+from kani.models import ToolCall
+
+from conftest import FakeEngine
+from scheduler import EngineLimiter, EngineLimits
+
+
+class CountingEngine(FakeEngine):
+    """Records the most requests that were running at once."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def predict(self, messages, functions=None, **kwargs):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return await super().predict(messages, functions, **kwargs)
+        finally:
+            self.in_flight -= 1
+
+
+def fan_out_reply(messages, functions):
+    """Delegate four subtasks at once, wait for them, then answer."""
+    n_results = sum(m.role == ChatRole.FUNCTION for m in messages)
+    if n_results == 0:
+        calls = [ToolCall.from_function("delegate", instructions=f"count fruit {i}") for i in range(4)]
+        return ChatMessage.assistant(None, tool_calls=calls)
+    if n_results == 4:
+        return ChatMessage.assistant(None, tool_calls=[ToolCall.from_function("wait", until="all")])
+    return ChatMessage.assistant("done")
+
+
+async def test_concurrency_limit_is_shared_by_the_tree(make_app):
+    engine = CountingEngine(delay=0.02)
+    app = make_app(
+        root_engine=FakeEngine(fan_out_reply),
+        delegate_engine=engine,
+        engine_limits={"CountingEngine": EngineLimits(initial_concurrency=2, max_concurrency=2)},
+    )
+    await app.ensure_init()
+    async for _ in app.query("count all the fruit"):
+        pass
+    assert engine.n_requests == 4 and engine.max_in_flight == 2
+    stats = {s.key: s for s in app.get_concurrency_stats()}
+    assert stats["CountingEngine"].n_admitted == 4
+    assert stats["CountingEngine"].in_flight == stats["CountingEngine"].queued == 0
+    await app.close()
+
+
+async def test_aimd():
+    limiter = EngineLimiter("model", EngineLimits(initial_concurrency=4, max_concurrency=5, decrease_cooldown=60))
+    for _ in range(5):
+        await limiter.acquire()
+        limiter.release()
+    # about one full window of successes adds one slot
+    assert limiter.concurrency == 5
+
+    await limiter.acquire()
+    limiter.release(rate_limited=True)
+    assert limiter.concurrency == 2
+    # within the cooldown, more rate limit errors don't decrease the limit again
+    await limiter.acquire()
+    limiter.release(rate_limited=True)
+    assert limiter.concurrency == 2 and limiter.stats().n_rate_limited == 2
+
+    for _ in range(20):
+        await limiter.acquire()
+        limiter.release()
+    assert limiter.concurrency == 5
+
+
+async def test_queued_requests_wait_for_a_slot():
+    limiter = EngineLimiter("model", EngineLimits(initial_concurrency=1, max_concurrency=1))
+    await limiter.acquire()
+    waiter = asyncio.create_task(limiter.acquire())
+    cancelled = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    assert limiter.stats().queued == 2 and not waiter.done()
+
+    cancelled.cancel()
+    await asyncio.sleep(0)
+    assert limiter.stats().queued == 1
+    limiter.release()
+    await asyncio.wait_for(waiter, 1)
+    assert limiter.in_flight == 1
+
+
+async def test_token_bucket_throttles_admission():
+    # 6000 tokens per minute refills 100 tokens per second
+    limiter = EngineLimiter("model", EngineLimits(tokens_per_minute=6000))
+    await limiter.acquire()
+    limiter.consume(6000 + 5)
+    limiter.release()
+    waiter = asyncio.create_task(limiter.acquire())
+    await asyncio.sleep(0)
+    stats = limiter.stats()
+    assert stats.throttled == 1 and stats.n_throttled == 1 and stats.tokens_available < 0
+    await asyncio.wait_for(waiter, 1)
+    assert limiter.stats().n_admitted == 2
@@ -0,0 +1,47 @@
+import httpx
+from kani import ai_function
+
+from tools import SharedResources, ToolBase
+
+
+class Fetcher(ToolBase):
+    @ai_function()
+    async def fetch(self, url: str):
+        """Fetch a URL."""
+        return (await self.shared_http_client().get(url)).text
+
+
+async def test_resources_are_created_once_and_closed_in_reverse_order():
+    resources = SharedResources()
+    created, closed = [], []
+
+    def factory(name):
+        created.append(name)
+        return name
+
+    async def make_async():
+        return factory("async")
+
+    assert resources.get("a", lambda: factory("a"), close=closed.append) == "a"
+    assert resources.get("a", lambda: factory("a again")) == "a"
+    assert await resources.aget("b", make_async, close=closed.append) == "async"
+    assert await resources.aget("b", make_async) == "async"
+    assert created == ["a", "async"] and "a" in resources and len(resources) == 2
+
+    await resources.close()
+    assert closed == ["async", "a"] and len(resources) == 0
+
+
+async def test_tools_share_one_http_client_per_app(make_app):
+    app = make_app()
+    app.tool_configs[Fetcher] = {"always_include": True}
+    root = await app.ensure_init()
+    first = await root.create_delegate_kani("first")
+    second = await root.create_delegate_kani("second")
+    client = first.get_tool(Fetcher).shared_http_client()
+    assert isinstance(client, httpx.AsyncClient)
+    assert second.get_tool(Fetcher).shared_http_client() is client
+    assert first.get_tool(Fetcher) is not second.get_tool(Fetcher)
+
+    await app.close()
+    assert client.is_closed
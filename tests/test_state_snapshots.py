@@ -0,0 +1,40 @@
+import json
+
+from kani import ChatMessage
+
+from base_kani import BaseKani
+
+
+async def test_only_changed_kani_are_reserialized(make_app, monkeypatch):
+    app = make_app()
+    root = await app.ensure_init()
+    await root.delegator.delegate("count the apples")
+    await root.delegator.wait("all")
+
+    n_serialized = []
+    get_save_state = BaseKani.get_save_state
+
+    def counting_get_save_state(self):
+        n_serialized.append(self.id)
+        return get_save_state(self)
+
+    monkeypatch.setattr(BaseKani, "get_save_state", counting_get_save_state)
+    await app.logger.write_state()
+    assert set(n_serialized) == set(app.kanis)
+
+    n_serialized.clear()
+    await app.logger.write_state()
+    assert not n_serialized
+
+    root.chat_history.append(ChatMessage.user("and the pears?"))
+    await app.logger.write_state()
+    assert n_serialized == [root.id]
+
+    # the spliced file is the same as serializing every kani from scratch
+    with open(app.logger.state_path, encoding="utf-8") as f:
+        data = json.load(f)
+    assert data["id"] == app.logger.session_id
+    assert data["state"] == [json.loads(ai.get_save_state().model_dump_json()) for ai in app.kanis.values()]
+    assert data["state"][0]["chat_history"][-1]["content"] == "and the pears?"
+    assert not app.logger.state_path.with_suffix(".json.tmp").exists()
+    await app.close()
@@ -0,0 +1,77 @@
+import asyncio
+
+from kani import ChatRole
+
+import events
+from dispatch import StreamDeltaCoalescer
+
+
+async def stream_round(app, query: str) -> list[events.BaseEvent]:
+    received = []
+
+    async def listener(event):
+        received.append(event)
+
+    app.add_listener(listener)
+    root = await app.ensure_init()
+    async for stream in root.full_round_stream(query):
+        async for _ in stream:
+            pass
+    await app.drain()
+    return received
+
+
+async def test_coalescer_buffers_until_flush():
+    out = []
+    coalescer = StreamDeltaCoalescer(out.append, window=None, max_bytes=None)
+    for token in ("the ", "answer ", "is "):
+        coalescer.add("a", token, ChatRole.ASSISTANT)
+    coalescer.add("b", "other", ChatRole.ASSISTANT)
+    assert out == []
+
+    coalescer.flush("a")
+    assert [(e.id, e.delta) for e in out] == [("a", "the answer is ")]
+    coalescer.flush()
+    assert [(e.id, e.delta) for e in out] == [("a", "the answer is "), ("b", "other")]
+
+
+async def test_coalescer_flushes_on_size_and_window():
+    out = []
+    coalescer = StreamDeltaCoalescer(out.append, window=None, max_bytes=8)
+    coalescer.add("a", "1234", ChatRole.ASSISTANT)
+    assert out == []
+    coalescer.add("a", "5678", ChatRole.ASSISTANT)
+    assert [e.delta for e in out] == ["12345678"]
+
+    out.clear()
+    coalescer = StreamDeltaCoalescer(out.append, window=0.01, max_bytes=None)
+    coalescer.add("a", "tick", ChatRole.ASSISTANT)
+    await asyncio.sleep(0.05)
+    assert [e.delta for e in out] == ["tick"]
+
+
+async def test_app_coalesces_deltas_before_the_message(make_app):
+    app = make_app(stream_coalesce_window=10)
+    received = await stream_round(app, "hello")
+    types = [e.type for e in received if getattr(e, "id", None) == app.root_kani.id]
+    deltas = [e for e in received if e.type == "stream_delta"]
+    assert len(deltas) == 1
+    assert deltas[0].delta.strip() == "the answer is 42"
+    # the buffered deltas are flushed before the message they make up
+    assert types.index("stream_delta") < types.index("kani_message", types.index("kani_message") + 1)
+    await app.close()
+
+
+async def test_listeners_can_opt_out_of_deltas(make_app):
+    app = make_app()
+    received = []
+
+    async def listener(event):
+        received.append(event)
+
+    app.add_listener(listener, stream_deltas=False)
+    all_events = await stream_round(app, "hello")
+    assert any(e.type == "stream_delta" for e in all_events)
+    assert not any(e.type == "stream_delta" for e in received)
+    assert any(e.type == "kani_message" for e in received)
+    await app.close()
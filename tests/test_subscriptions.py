@@ -0,0 +1,75 @@
+import pytest
+from kani import ChatMessage, ChatRole
+
+import events
+from dispatch import ListenerIndex, event_type_key
+
+MESSAGE_A = events.KaniMessage(id="a", msg=ChatMessage.user("hi"))
+MESSAGE_B = events.KaniMessage(id="b", msg=ChatMessage.user("hi"))
+DELTA_A = events.StreamDelta(id="a", delta="h", role=ChatRole.ASSISTANT)
+ROUND = events.RoundComplete(session_id="s")
+
+
+def everything(event):
+    pass
+
+
+def messages(event):
+    pass
+
+
+def messages_from_a(event):
+    pass
+
+
+def no_deltas(event):
+    pass
+
+
+def test_event_type_key():
+    assert event_type_key(events.KaniMessage) == "kani_message" == event_type_key("kani_message")
+
+
+def test_listeners_are_resolved_by_type_and_kani():
+    index = ListenerIndex()
+    index.add(everything)
+    index.add(messages, [events.KaniMessage])
+    index.add(messages_from_a, ["kani_message"], kani_id="a")
+    index.add(no_deltas, exclude=[events.StreamDelta])
+
+    assert set(index.get(MESSAGE_A)) == {everything, messages, messages_from_a, no_deltas}
+    assert set(index.get(MESSAGE_B)) == {everything, messages, no_deltas}
+    assert set(index.get(DELTA_A)) == {everything}
+    assert set(index.get(ROUND)) == {everything, no_deltas}
+    assert index.has_listeners("stream_delta")
+    assert len(index) == 4
+
+    index.remove(everything)
+    assert not index.has_listeners("stream_delta", "a")
+    assert index.has_listeners("kani_message", "a")
+    assert set(index.get(MESSAGE_B)) == {messages, no_deltas}
+    with pytest.raises(ValueError):
+        index.remove(everything)
+
+
+async def test_app_delivers_only_subscribed_events(make_app):
+    app = make_app()
+    root_messages, round_ends = [], []
+
+    async def on_root_message(event):
+        root_messages.append(event)
+
+    async def on_round_end(event):
+        round_ends.append(event)
+
+    root = await app.ensure_init()
+    app.subscribe(on_root_message, events.KaniMessage, kani_id=root.id)
+    app.subscribe(on_round_end, events.RoundComplete)
+    async for _ in app.query("hello"):
+        pass
+    await app.drain()
+
+    assert [e.msg.role for e in root_messages] == [ChatRole.USER, ChatRole.ASSISTANT]
+    assert all(e.id == root.id for e in root_messages)
+    assert len(round_ends) == 1
+    await app.close()
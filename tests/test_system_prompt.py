@@ -0,0 +1,75 @@
+import datetime
+import types
+
+import pytest
+from kani import ChatMessage
+
+import kanis
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time shown in system prompts."""
+    clock = types.SimpleNamespace(now=datetime.datetime(2026, 1, 1, 9, 30))
+    monkeypatch.setattr(kanis, "datetime", types.SimpleNamespace(datetime=types.SimpleNamespace(now=lambda: clock.now)))
+    monkeypatch.setattr(kanis, "time", types.SimpleNamespace(localtime=lambda: clock.now.timetuple()))
+    return clock
+
+
+def test_session_format_matches_minute_format():
+    assert kanis.SYSTEM_PROMPT_TIME_FORMATS["session"] == kanis.SYSTEM_PROMPT_TIME_FORMATS["minute"]
+
+
+@pytest.mark.parametrize(
+    "granularity, later, changes",
+    [
+        ("minute", datetime.timedelta(seconds=20), False),
+        ("minute", datetime.timedelta(minutes=1), True),
+        ("hour", datetime.timedelta(minutes=20), False),
+        ("hour", datetime.timedelta(hours=1), True),
+        ("session", datetime.timedelta(days=1), False),
+    ],
+)
+async def test_prompt_is_rerendered_only_when_its_time_changes(make_app, clock, granularity, later, changes):
+    app = make_app(system_prompt_time_granularity=granularity)
+    root = await app.ensure_init()
+    helper = await root.create_delegate_kani("count the apples")
+    helper.refresh_system_prompt()
+    first = helper.always_included_messages[0]
+    assert "09:30AM" in first.text or "09AM" in first.text
+
+    clock.now += later
+    helper.refresh_system_prompt()
+    assert (helper.always_included_messages[0] is not first) == changes
+    await app.close()
+
+
+async def test_token_counts_are_memoized(make_app):
+    app = make_app()
+    root = await app.ensure_init()
+    helper = await root.create_delegate_kani("count the apples")
+    n_counted = 0
+    prompt_len = helper.engine.prompt_len
+
+    def counting_prompt_len(messages, functions=None, **kwargs):
+        nonlocal n_counted
+        n_counted += 1
+        return prompt_len(messages, functions, **kwargs)
+
+    helper.engine.prompt_len = counting_prompt_len
+    helper.chat_history = [ChatMessage.user("apples?"), ChatMessage.assistant("there are 42 apples")]
+    lens = await helper.history_token_lens()
+    assert [msg for msg, _ in lens] == helper.chat_history and n_counted == 2
+
+    await helper.history_token_lens()
+    assert n_counted == 2
+    helper.chat_history[1] = ChatMessage.assistant("there are 43 apples")
+    helper.chat_history.append(ChatMessage.user("and pears?"))
+    lens = await helper.history_token_lens()
+    assert [msg for msg, _ in lens] == helper.chat_history and n_counted == 4
+
+    await helper.always_token_len(None)
+    n_counted_before = n_counted
+    await helper.always_token_len(None)
+    assert n_counted == n_counted_before
+    await app.close()
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+
+import events
+from state import TaskStatus
+from tasks import TaskRegistry
+
+
+class FakeKani:
+    def __init__(self, id, name=None):
+        self.id = id
+        self.name = name or id
+
+
+def test_transitions_and_lookups():
+    registry = TaskRegistry()
+    root, alpha, beta = FakeKani("root"), FakeKani("k-alpha", "alpha"), FakeKani("k-beta", "beta")
+    task = registry.create(alpha, "count the apples", parent=root)
+    assert registry.get(task.id) is task and task.id in registry
+    assert registry.get_agent_task("alpha", task.id) is task
+    assert registry.current_task("k-alpha") is task
+
+    registry.transition(task.id, TaskStatus.RUNNING)
+    child = registry.create(beta, "count the green apples", parent=alpha)
+    assert child.parent_task_id == task.id
+    assert registry.children(task.id) == [child]
+
+    registry.transition(task.id, TaskStatus.COMPLETED)
+    assert task.started_at is not None and task.finished_at is not None
+    assert registry.with_status(TaskStatus.COMPLETED) == [task]
+    assert registry.status_counts() == {TaskStatus.COMPLETED: 1, TaskStatus.ASSIGNED: 1}
+    with pytest.raises(ValueError):
+        registry.transition(task.id, TaskStatus.RUNNING)
+
+
+async def test_compaction_archives_finished_tasks(tmp_path):
+    archive = tmp_path / "tasks.jsonl"
+    registry = TaskRegistry(archive_path=archive)
+    done = registry.create(FakeKani("a"), "done")
+    registry.transition(done.id, TaskStatus.FAILED, error="boom")
+    running = registry.create(FakeKani("b"), "running")
+    registry.transition(running.id, TaskStatus.RUNNING)
+
+    assert await registry.compact(older_than=60) == []
+    assert await registry.compact() == [done]
+    assert list(registry) == [running]
+    assert registry.get_agent_tasks("a") == [] and registry.current_task("a") is None
+    assert registry.status_counts()[TaskStatus.FAILED] == 1
+    archived = [json.loads(line) for line in archive.read_text().splitlines()]
+    assert [(t["id"], t["status"], t["error"]) for t in archived] == [(done.id, "failed", "boom")]
+
+
+async def test_task_events_are_keyed_by_kani_id(make_app):
+    app = make_app()
+    root = await app.ensure_init()
+    all_changes, scoped_changes = [], []
+
+    async def on_change(event):
+        all_changes.append(event)
+
+    async def on_scoped_change(event):
+        scoped_changes.append(event)
+
+    app.subscribe(on_change, events.TaskStateChange)
+    await root.delegator.delegate("count the apples")
+    helper = next(iter(root.delegator.helpers.values()))
+    app.subscribe(on_scoped_change, events.TaskStateChange, kani_id=helper.id)
+    await root.delegator.wait("all")
+    await app.drain()
+
+    assert all(e.id == helper.id for e in all_changes)
+    assert [(e.previous_status, e.task.status) for e in all_changes] == [
+        (None, TaskStatus.ASSIGNED),
+        (TaskStatus.ASSIGNED, TaskStatus.RUNNING),
+        (TaskStatus.RUNNING, TaskStatus.COMPLETED),
+    ]
+    # records in events are snapshots, not the live record
+    assert len({e.task.status for e in all_changes}) == 3
+    assert scoped_changes and all(e.task.kani_id == helper.id for e in scoped_changes)
+    await app.close()
@@ -0,0 +1,46 @@
+from typing import Annotated
+
+import pytest
+from kani import AIParam, ai_function
+
+from kanis import get_class_functions, get_tool_functions
+from tools import ToolBase
+
+
+class Counter(ToolBase):
+    def __init__(self, app, kani, start: int):
+        super().__init__(app, kani)
+        self.count = start
+
+    @ai_function()
+    def increment(self, by: Annotated[int, AIParam("How much to add.")] = 1):
+        """Add to the count."""
+        self.count += by
+        return self.count
+
+
+class Duplicate(ToolBase):
+    @ai_function(name="same")
+    def a(self):
+        """A."""
+
+    @ai_function(name="same")
+    def b(self):
+        """B."""
+
+
+def test_functions_are_introspected_once_per_class():
+    a, b = Counter(None, None, start=0), Counter(None, None, start=10)
+    assert get_class_functions(a) is get_class_functions(b)
+
+    fa, fb = get_tool_functions(a)["increment"], get_tool_functions(b)["increment"]
+    assert fa.json_schema is fb.json_schema
+    assert list(fa.json_schema["properties"]) == ["by"]
+    assert fa.desc == "Add to the count."
+    assert fa.inner(by=2) == 2 and fb.inner() == 11
+    assert (a.count, b.count) == (2, 11)
+
+
+def test_duplicate_function_names():
+    with pytest.raises(ValueError):
+        get_class_functions(Duplicate(None, None))